@@ -1,13 +1,26 @@
+import asyncio
 import json
+from functools import lru_cache, partial
+from os import getenv
 from pathlib import Path
+from typing import Optional
 
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import PlainTextResponse
 from loguru import logger
 
-from cont_intel.api.utils.api_utils import publish_message, write_log, handle_error
+from cont_intel.api.annotator.src.utils.annotation_cache import (
+    AnnotationCache,
+    annotation_cache_from_env,
+    perceptual_hash,
+)
+from cont_intel.api.annotator.src.utils.secret_cache import SecretCache
+from cont_intel.api.utils.api_utils import flush_clients, publish_pubsub_message_async, write_log, handle_error
+from cont_intel.api.utils.claim_check import attach_stored_result_async
 from cont_intel.api.utils.data_classes import PubSubMessage
-from cont_intel.reverse_image_search import reverse_image_search_main
+from cont_intel.api.utils.metrics import REVERSE_IMAGE_SEARCH_LATENCY, instrument_app
+from cont_intel.api.utils.topics import Topic
+from cont_intel.api.utils.tracing import enter_stage, finish_stage, traced
 from cont_intel.utils.gcp_utils import (
     download_file,
     save_to_bucket_from_string,
@@ -16,31 +29,62 @@ from cont_intel.utils.gcp_utils import (
 from cont_intel.utils.secret_management import access_secret_version
 
 app = FastAPI()
+instrument_app(app, "annotator")
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """Flush pending Pub/Sub batches and log entries before the instance is stopped."""
+    flush_clients()
+
+@lru_cache(maxsize=None)
+def get_annotation_cache(bucket_name: str) -> Optional[AnnotationCache]:
+    """Returns the process-wide annotation cache, or None if it is disabled."""
+    return annotation_cache_from_env(bucket_name)
+
+# Secrets are cached for the life of the process and refreshed ahead of expiry; the key JSON is written to disk once
+secret_cache = SecretCache(
+    access_secret_version,
+    {
+        "api_key": "GOOGLE_VISION_API_KEY",
+        "engine_id": "GOOGLE_VISION_ENGINE_ID",
+        "key_json": "GOOGLE_VISION_KEY_JSON",
+    },
+    ttl=float(getenv("SECRET_CACHE_TTL", "3600")),
+    refresh_ahead=float(getenv("SECRET_CACHE_REFRESH_AHEAD", "300")),
+    key_file_field="key_json",
+)
 
 # Helper function to access secrets
 def fetch_required_secrets():
     """Fetch necessary secrets for reverse image search."""
     try:
-        return {
-            "api_key": access_secret_version("GOOGLE_VISION_API_KEY"),
-            "engine_id": access_secret_version("GOOGLE_VISION_ENGINE_ID"),
-            "key_json": access_secret_version("GOOGLE_VISION_KEY_JSON"),
-        }
+        return secret_cache.get()
     except Exception as e:
         logger.error(f"Error fetching secrets: {e}")
         raise RuntimeError("Failed to fetch required secrets")
 
+# Helper function to load what a reverse image search needs
+def warm_up():
+    """Fetch the secrets and import the search client. Best effort: the search retries whatever failed."""
+    try:
+        fetch_required_secrets()
+        from cont_intel.reverse_image_search import reverse_image_search_main  # noqa: F401
+    except Exception as e:
+        logger.error(f"Warm-up failed: {e}")
+
 # Helper function to prepare file paths
 def prepare_file_paths(task_id: str, file_name: str = "image.png"):
     """Prepare necessary file paths for processing."""
     data_dir = Path(task_id)
-    return data_dir, data_dir / file_name, data_dir / "key.json"
+    return data_dir, data_dir / file_name
 
 # Helper function to log and publish messages
-def log_and_publish(pubsub_message_data: PubSubMessage, message: str, topic: str):
+async def log_and_publish(pubsub_message_data: PubSubMessage, message: str, topic: Topic):
     """Log a message and publish it to Pub/Sub."""
+    finish_stage(pubsub_message_data)
     write_log("api", {"message": message, "request": pubsub_message_data.to_json()})
-    publish_message(pubsub_message_data.project_id, topic, pubsub_message_data.to_json())
+    await publish_pubsub_message_async(topic, pubsub_message_data)
 
 @app.post("/", response_class=PlainTextResponse)
 async def read_root(request: Request):
@@ -52,45 +96,95 @@ async def read_root(request: Request):
 
         # Parse PubSub message
         pubsub_message_data = PubSubMessage.from_request(request_json)
-        log_and_publish(pubsub_message_data, "Annotator started", "annotator_start")
+        enter_stage(pubsub_message_data, "annotator")
+        # Only logged: "annotator_start" is this service's own input topic, publishing to it would redeliver the task
+        write_log("api", {"message": "Annotator started", "request": pubsub_message_data.to_json()})
+
+        # Downloads, the image search and the BigQuery write block, so they run off the event loop
+        loop = asyncio.get_running_loop()
 
         # Prepare file paths and download input file
-        data_dir, image_path, key_json_path = prepare_file_paths(pubsub_message_data.task_id)
-        download_file(pubsub_message_data.bucket_name, data_dir, image_path.name)
-
-        # Fetch secrets and write key JSON to file
-        secrets = fetch_required_secrets()
-        key_json_path.write_text(secrets["key_json"])
-
-        # Prepare arguments for reverse image search
-        custom_args = (
-            f"--input_image_file={image_path} "
-            f"--google_api_key={secrets['api_key']} "
-            f"--google_engine_id={secrets['engine_id']} "
-            f"--key_json_file={key_json_path} "
-        )
-
-        # Perform reverse image search
-        annotations = json.dumps(reverse_image_search_main.reverse_image_search(custom_args))
-        pubsub_message_data.results = {"annotation": annotations}
-
-        # Save annotations to bucket and store metadata in BigQuery
-        save_to_bucket_from_string(
-            bucket_name=pubsub_message_data.bucket_name,
-            bucket_dir=data_dir,
-            file_name="annotations.json",
-            contents=annotations,
-        )
-        store_annotation_info_to_bq(
-            bucket_name=pubsub_message_data.bucket_name,
-            bucket_dir=pubsub_message_data.task_id,
-            image_name=image_path.name,
-            annotation_name="annotations.json",
-            annotation_type=json.dumps(["reverse_image_search"]),
-        )
+        data_dir, image_path = prepare_file_paths(pubsub_message_data.task_id)
+        # Warm up while the image is downloaded, in case it misses the annotation cache
+        warming_up = loop.run_in_executor(None, warm_up)
+        with traced(pubsub_message_data, "annotator.download"):
+            await loop.run_in_executor(None, download_file, pubsub_message_data.bucket_name, data_dir, image_path.name)
+
+        # Reuse the annotations of the same or a near-identical image if it was annotated recently
+        annotation_cache = get_annotation_cache(pubsub_message_data.bucket_name)
+        bypass_cache = pubsub_message_data.bypass_cache or getenv("ANNOTATION_CACHE_BYPASS", "false").lower() == "true"
+        image_hash, annotations = None, None
+        if annotation_cache is not None:
+            try:
+                # Decoding the image and listing the cache are blocking, so they run off the event loop
+                image_hash = await loop.run_in_executor(None, perceptual_hash, image_path)
+                if not bypass_cache:
+                    annotations = await loop.run_in_executor(None, annotation_cache.lookup, image_hash)
+            except Exception as e:
+                logger.error(f"Annotation cache lookup failed: {e}")
+
+        if annotations is None:
+            await warming_up
+            # Fetch cached secrets; the key JSON file is shared by all requests
+            secrets = fetch_required_secrets()
+
+            # Prepare arguments for reverse image search
+            custom_args = (
+                f"--input_image_file={image_path} "
+                f"--google_api_key={secrets['api_key']} "
+                f"--google_engine_id={secrets['engine_id']} "
+                f"--key_json_file={secret_cache.key_file_path} "
+            )
+
+            # Perform reverse image search; the search client is imported off the event loop by the warm-up
+            from cont_intel.reverse_image_search import reverse_image_search_main
+
+            try:
+                with traced(pubsub_message_data, "annotator.reverse_image_search"), REVERSE_IMAGE_SEARCH_LATENCY.time():
+                    annotations = json.dumps(
+                        await loop.run_in_executor(None, reverse_image_search_main.reverse_image_search, custom_args)
+                    )
+            except Exception:
+                # The credentials may have been rotated; reload them for the next request
+                secret_cache.invalidate()
+                raise
+
+            if annotation_cache is not None and image_hash is not None:
+                try:
+                    await loop.run_in_executor(None, annotation_cache.store, image_hash, annotations)
+                except Exception as e:
+                    logger.error(f"Failed to store annotations in the cache: {e}")
+
+        with traced(pubsub_message_data, "annotator.store"):
+            # Save annotations to bucket and store metadata in BigQuery
+            await loop.run_in_executor(
+                None,
+                partial(
+                    save_to_bucket_from_string,
+                    bucket_name=pubsub_message_data.bucket_name,
+                    bucket_dir=data_dir,
+                    file_name="annotations.json",
+                    contents=annotations,
+                ),
+            )
+            # Large annotations are passed on as a reference to the saved file
+            await attach_stored_result_async(
+                pubsub_message_data, "annotation", annotations, f"{data_dir.as_posix()}/annotations.json"
+            )
+            await loop.run_in_executor(
+                None,
+                partial(
+                    store_annotation_info_to_bq,
+                    bucket_name=pubsub_message_data.bucket_name,
+                    bucket_dir=pubsub_message_data.task_id,
+                    image_name=image_path.name,
+                    annotation_name="annotations.json",
+                    annotation_type=json.dumps(["reverse_image_search"]),
+                ),
+            )
 
         # Log success and publish completion message
-        log_and_publish(pubsub_message_data, "Annotator ended", "annotator_end")
+        await log_and_publish(pubsub_message_data, "Annotator ended", Topic.ANNOTATOR_END)
         return "Task processed successfully"
 
     except Exception as e:
@@ -0,0 +1,245 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from os import getenv
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import cv2
+import numpy as np
+from google.cloud import storage
+from loguru import logger
+
+from cont_intel.api.utils.metrics import record_cache_lookup
+
+
+def perceptual_hash(image_path: Union[str, Path]) -> int:
+    """
+    64-bit DCT perceptual hash of an image: the sign of its 8x8 lowest frequencies against their median. Resized,
+    re-encoded or slightly edited copies of an image hash to values a few bits apart.
+    """
+    image = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError(f"Could not read image {image_path}")
+
+    resized = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_frequencies = cv2.dct(resized)[:8, :8].flatten()
+    # The DC term only carries the average brightness, leave it out of the median
+    bits = low_frequencies > np.median(low_frequencies[1:])
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return bin(first ^ second).count("1")
+
+
+class AnnotationCacheBackend(ABC):
+    """Storage for cached annotations, keyed by image hash."""
+
+    @abstractmethod
+    def entries(self) -> Dict[int, float]:
+        """Returns every stored hash with the time it was stored."""
+
+    @abstractmethod
+    def get(self, image_hash: int) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def put(self, image_hash: int, annotations: str) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, image_hash: int) -> None:
+        ...
+
+
+class InMemoryBackend(AnnotationCacheBackend):
+    def __init__(self):
+        self._annotations: Dict[int, str] = {}
+        self._stored_at: Dict[int, float] = {}
+
+    def entries(self) -> Dict[int, float]:
+        return dict(self._stored_at)
+
+    def get(self, image_hash: int) -> Optional[str]:
+        return self._annotations.get(image_hash)
+
+    def put(self, image_hash: int, annotations: str) -> None:
+        self._annotations[image_hash] = annotations
+        self._stored_at[image_hash] = time.time()
+
+    def delete(self, image_hash: int) -> None:
+        self._annotations.pop(image_hash, None)
+        self._stored_at.pop(image_hash, None)
+
+
+class LocalDiskBackend(AnnotationCacheBackend):
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, image_hash: int) -> Path:
+        return self.directory / f"{image_hash:016x}.json"
+
+    def entries(self) -> Dict[int, float]:
+        return {int(path.stem, 16): path.stat().st_mtime for path in self.directory.glob("*.json")}
+
+    def get(self, image_hash: int) -> Optional[str]:
+        try:
+            return self._path(image_hash).read_text()
+        except FileNotFoundError:
+            return None
+
+    def put(self, image_hash: int, annotations: str) -> None:
+        # Write to a temporary file first so a concurrent reader never sees a partial file
+        temporary_path = self._path(image_hash).with_suffix(".tmp")
+        temporary_path.write_text(annotations)
+        temporary_path.replace(self._path(image_hash))
+
+    def delete(self, image_hash: int) -> None:
+        self._path(image_hash).unlink(missing_ok=True)
+
+
+class GCSBackend(AnnotationCacheBackend):
+    def __init__(self, bucket_name: str, prefix: str = "annotation_cache"):
+        self.bucket = storage.Client().bucket(bucket_name)
+        self.prefix = prefix.strip("/")
+
+    def _name(self, image_hash: int) -> str:
+        return f"{self.prefix}/{image_hash:016x}.json"
+
+    def entries(self) -> Dict[int, float]:
+        return {
+            int(Path(blob.name).stem, 16): blob.updated.timestamp()
+            for blob in self.bucket.list_blobs(prefix=f"{self.prefix}/")
+            if blob.name.endswith(".json")
+        }
+
+    def get(self, image_hash: int) -> Optional[str]:
+        blob = self.bucket.get_blob(self._name(image_hash))
+        return blob.download_as_text() if blob is not None else None
+
+    def put(self, image_hash: int, annotations: str) -> None:
+        self.bucket.blob(self._name(image_hash)).upload_from_string(annotations, content_type="application/json")
+
+    def delete(self, image_hash: int) -> None:
+        blob = self.bucket.blob(self._name(image_hash))
+        if blob.exists():
+            blob.delete()
+
+
+class AnnotationCache:
+    """
+    Reverse image search results keyed by the perceptual hash of the annotated image.
+
+    A lookup matches the closest stored hash within `max_distance` bits. Entries older than `ttl` seconds are not
+    returned and are deleted; beyond `max_entries`, the least recently used entry is deleted. The hash index is kept
+    in memory and reloaded from the backend every `refresh_interval` seconds, so entries written by other instances
+    to a shared backend are picked up.
+    """
+
+    def __init__(
+        self,
+        backend: AnnotationCacheBackend,
+        max_distance: int = 4,
+        ttl: float = 24 * 3600,
+        max_entries: int = 10000,
+        refresh_interval: float = 300,
+    ):
+        self.backend = backend
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh_interval = refresh_interval
+        self.hits = 0
+        self.misses = 0
+
+        self._index: "OrderedDict[int, float]" = OrderedDict()
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _refresh_index(self) -> None:
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_interval:
+            return
+        stored = sorted(self.backend.entries().items(), key=lambda entry: entry[1])
+        for image_hash, stored_at in stored:
+            if image_hash not in self._index:
+                self._index[image_hash] = stored_at
+        self._loaded_at = time.monotonic()
+
+    def _evict(self, image_hash: int) -> None:
+        self._index.pop(image_hash, None)
+        self.backend.delete(image_hash)
+
+    def lookup(self, image_hash: int) -> Optional[str]:
+        """Returns the annotations of the closest cached image, or None."""
+        with self._lock:
+            self._refresh_index()
+            now = time.time()
+            for expired_hash in [h for h, stored_at in self._index.items() if now - stored_at > self.ttl]:
+                self._evict(expired_hash)
+
+            best_hash, best_distance = None, self.max_distance + 1
+            for cached_hash in self._index:
+                distance = hamming_distance(image_hash, cached_hash)
+                if distance < best_distance:
+                    best_hash, best_distance = cached_hash, distance
+                    if distance == 0:
+                        break
+
+            annotations = self.backend.get(best_hash) if best_hash is not None else None
+            if annotations is None:
+                if best_hash is not None:
+                    # Deleted from a shared backend by another instance
+                    self._index.pop(best_hash, None)
+                self.misses += 1
+                record_cache_lookup("annotation", False)
+                return None
+
+            self._index.move_to_end(best_hash)
+            self.hits += 1
+            record_cache_lookup("annotation", True)
+            logger.info(f"Annotation cache hit for {image_hash:016x} (distance {best_distance})")
+            return annotations
+
+    def store(self, image_hash: int, annotations: str) -> None:
+        with self._lock:
+            self.backend.put(image_hash, annotations)
+            self._index[image_hash] = time.time()
+            self._index.move_to_end(image_hash)
+            while len(self._index) > self.max_entries:
+                self._evict(next(iter(self._index)))
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def annotation_cache_from_env(bucket_name: str) -> Optional[AnnotationCache]:
+    """
+    Builds the annotation cache configured by the environment, or returns None if it is disabled:
+    - ANNOTATION_CACHE_BACKEND: "memory" (default), "disk", "gcs" or "none"
+    - ANNOTATION_CACHE_DIR: directory of the disk backend (default /tmp/annotation_cache)
+    - ANNOTATION_CACHE_PREFIX: object prefix of the GCS backend in `bucket_name` (default annotation_cache)
+    - ANNOTATION_CACHE_MAX_DISTANCE, ANNOTATION_CACHE_TTL (seconds), ANNOTATION_CACHE_MAX_ENTRIES
+    """
+    backend_name = getenv("ANNOTATION_CACHE_BACKEND", "memory").lower()
+    if backend_name == "none":
+        return None
+    if backend_name == "memory":
+        backend = InMemoryBackend()
+    elif backend_name == "disk":
+        backend = LocalDiskBackend(getenv("ANNOTATION_CACHE_DIR", "/tmp/annotation_cache"))
+    elif backend_name == "gcs":
+        backend = GCSBackend(bucket_name, getenv("ANNOTATION_CACHE_PREFIX", "annotation_cache"))
+    else:
+        raise ValueError(f"Unknown annotation cache backend {backend_name}")
+
+    return AnnotationCache(
+        backend,
+        max_distance=int(getenv("ANNOTATION_CACHE_MAX_DISTANCE", "4")),
+        ttl=float(getenv("ANNOTATION_CACHE_TTL", str(24 * 3600))),
+        max_entries=int(getenv("ANNOTATION_CACHE_MAX_ENTRIES", "10000")),
+    )
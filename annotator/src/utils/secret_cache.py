@@ -0,0 +1,99 @@
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from loguru import logger
+
+from cont_intel.api.utils.metrics import record_cache_lookup
+
+
+class SecretCache:
+    """
+    Process-level cache of Secret Manager secrets.
+
+    `secrets` maps the keys callers use to secret ids, which are read with `fetch`. Values are reloaded when they are
+    `ttl` seconds old; once they are older than `ttl - refresh_ahead` seconds, a background reload is started so
+    requests do not wait on Secret Manager. A reload that returns different values is logged as a rotation.
+
+    If `key_file_field` is set, that secret is written once to a private temporary file (`key_file_path`) and only
+    rewritten when it rotates.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str], str],
+        secrets: Dict[str, str],
+        ttl: float = 3600,
+        refresh_ahead: float = 300,
+        key_file_field: Optional[str] = None,
+    ):
+        self.fetch = fetch
+        self.secrets = secrets
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl)
+        self.key_file_field = key_file_field
+        self.key_file_path: Optional[Path] = None
+
+        self._values: Optional[Dict[str, str]] = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self) -> Dict[str, str]:
+        with self._lock:
+            age = time.monotonic() - self._fetched_at
+            expired = self._values is None or age >= self.ttl
+            record_cache_lookup("secret", not expired)
+            if expired:
+                self._reload()
+            elif age >= self.ttl - self.refresh_ahead and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._reload_in_background, name="secret-refresh", daemon=True).start()
+            return self._values
+
+    def invalidate(self) -> None:
+        """Forces a reload on the next `get`, e.g. after the secrets were rejected."""
+        with self._lock:
+            self._fetched_at = 0.0
+
+    def _reload_in_background(self) -> None:
+        try:
+            values = self._fetch_all()
+            with self._lock:
+                self._store(values)
+        except Exception as e:  # NOSONAR
+            # Keep serving the current values; `get` reloads synchronously once they expire
+            logger.error(f"Background secret refresh failed: {e}")
+        finally:
+            self._refreshing = False
+
+    def _reload(self) -> None:
+        self._store(self._fetch_all())
+
+    def _fetch_all(self) -> Dict[str, str]:
+        return {key: self.fetch(secret_id) for key, secret_id in self.secrets.items()}
+
+    def _store(self, values: Dict[str, str]) -> None:
+        if self._values is not None and values != self._values:
+            logger.info("Secret rotation detected, reloaded secrets")
+        if self.key_file_field and (
+            self.key_file_path is None or values[self.key_file_field] != self._values[self.key_file_field]
+        ):
+            self._write_key_file(values[self.key_file_field])
+        self._values = values
+        self._fetched_at = time.monotonic()
+
+    def _write_key_file(self, contents: str) -> None:
+        # mkstemp creates the file readable by the current user only
+        file_descriptor, temporary_name = tempfile.mkstemp(prefix="key-", suffix=".json")
+        with os.fdopen(file_descriptor, "w") as key_file:
+            key_file.write(contents)
+        if self.key_file_path is None:
+            self.key_file_path = Path(temporary_name)
+        else:
+            # Swap the file in atomically so a concurrent reader never sees a partial key
+            os.replace(temporary_name, self.key_file_path)
+
@@ -0,0 +1,572 @@
+"""
+End-to-end throughput and latency benchmark of the whole system.
+
+All services run in this process, connected by the in-memory message bus (utils/message_bus.py) instead of Pub/Sub.
+Requests go to the real Endpoints app and the real handlers of every stage process them; only the edges are
+replaced: GCS by an in-memory store, Cloud Logging by a discarding client, Secret Manager, BigQuery, the reverse image
+search and the ML pipeline by stand-ins with configurable latency, and the client webhooks by a recorder. Input files
+are served over HTTP by a local server, so the downloader's DataTransferHandler runs its real transfer path.
+
+The harness replays a mix of annotation, inference and training requests with one of three load shapes:
+- steady: --rate requests per second for --duration seconds
+- bursty: the same average rate, sent in bursts every --burst-interval seconds
+- ramp: the rate rises linearly from 0 to --rate over --duration seconds
+
+It reports, as JSON, the end-to-end latency percentiles per request type (from the request to Endpoints until the
+webhook is received), the Endpoints response time, the queue wait and handler time of every stage, throughput, the
+peak RSS of the process and, with --trace-memory, the peak memory held by allocations from each service's code. The
+report is meant to be kept per release and compared, e.g. to catch regressions in api_utils, the DataTransferHandler
+or the annotator path.
+
+Run from the directory that contains the cont_intel package, with the services' requirements installed:
+
+    python -m cont_intel.api.benchmarks.end_to_end --mix annotation=6 inference=3 training=1 --shape bursty \\
+        --rate 20 --duration 30 --output e2e.json
+
+Caches that would turn repeated requests into hits are disabled unless set otherwise in the environment
+(INPUT_CACHE_ENABLED, ANNOTATION_CACHE_BACKEND); service logs below --log-level are not emitted. Tracing allocations
+slows every stage down several times, so take latencies and per-service memory from separate runs.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from collections import defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+SERVICES = ["endpoints", "controller", "downloader", "pipeline", "annotator", "output", "error-handler"]
+PROJECT_ID = "benchmark-project"
+WEBHOOK_HOST = "client.example"
+REQUEST_TYPES = {
+    # type: (Endpoints route, extra request fields)
+    "annotation": ("/annotation/initiate", {}),
+    "inference": ("/inference/initiate", {"model_id": "benchmark-model"}),
+    "training": ("/training/initiate", {}),
+}
+
+
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.content_type: Optional[str] = None
+
+    @property
+    def size(self) -> Optional[int]:
+        data = self.bucket.objects.get(self.name)
+        return None if data is None else len(data)
+
+    def upload_from_string(self, data, content_type: Optional[str] = None, **kwargs) -> None:
+        self.bucket.objects[self.name] = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+
+    def download_as_bytes(self, **kwargs) -> bytes:
+        return self.bucket.objects[self.name]
+
+    def exists(self, **kwargs) -> bool:
+        return self.name in self.bucket.objects
+
+    def reload(self, **kwargs) -> None:
+        pass
+
+    def delete(self, **kwargs) -> None:
+        self.bucket.objects.pop(self.name, None)
+
+    def compose(self, sources: List["FakeBlob"], **kwargs) -> None:
+        self.bucket.objects[self.name] = b"".join(self.bucket.objects[source.name] for source in sources)
+
+    def open(self, mode: str = "rb", **kwargs):
+        blob = self
+
+        class Writer:
+            def __init__(self):
+                self.chunks: List[bytes] = []
+
+            def write(self, chunk: bytes) -> int:
+                self.chunks.append(bytes(chunk))
+                return len(chunk)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                if exc_info[0] is None:
+                    blob.bucket.objects[blob.name] = b"".join(self.chunks)
+
+        return Writer()
+
+
+class FakeBucket:
+    def __init__(self, name: str):
+        self.name = name
+        self.objects: Dict[str, bytes] = {}
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def delete_blobs(self, blobs: List[FakeBlob], on_error=None) -> None:
+        for blob in blobs:
+            blob.delete()
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeStorageClient:
+    """In-memory stand-in for google.cloud.storage.Client. Objects are read and written with single dict operations."""
+
+    def __init__(self, *args, **kwargs):
+        self.buckets: Dict[str, FakeBucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, name: str) -> FakeBucket:
+        with self._lock:
+            return self.buckets.setdefault(name, FakeBucket(name))
+
+    def stored_bytes(self) -> int:
+        return sum(len(data) for bucket in self.buckets.values() for data in list(bucket.objects.values()))
+
+
+class FakeLoggingClient:
+    """Accepts log batches like google.cloud.logging.Client and discards them."""
+
+    def logger(self, name: str):
+        return self
+
+    def batch(self):
+        return self
+
+    def log_struct(self, *args, **kwargs) -> None:
+        pass
+
+    def log_text(self, *args, **kwargs) -> None:
+        pass
+
+    def commit(self) -> None:
+        pass
+
+
+class FakeUrlSigner:
+    async def sign_many_async(self, objects, exp=None) -> List[str]:
+        return [f"https://storage.example/{bucket}/{name}?X-Goog-Signature=benchmark" for bucket, name in objects]
+
+
+class SourceServer(ThreadingHTTPServer):
+    """Serves every path as a file of `file_size` bytes, with HEAD and byte range support like GCS signed URLs."""
+
+    daemon_threads = True
+
+    def __init__(self, file_size: int):
+        self.content = (bytes(range(256)) * (file_size // 256 + 1))[:file_size]
+        super().__init__(("127.0.0.1", 0), SourceHandler)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class SourceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self._respond(include_body=False)
+
+    def do_GET(self):
+        self._respond(include_body=True)
+
+    def _respond(self, include_body: bool):
+        content = self.server.content
+        start, end, status = 0, len(content) - 1, 200
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            first, _, last = range_header[len("bytes=") :].partition("-")
+            start, end, status = int(first), min(int(last or end), end), 206
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", '"benchmark"')
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+        self.end_headers()
+        if include_body:
+            self.wfile.write(content[start : end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+def register_module(name: str, **attributes) -> types.ModuleType:
+    """Puts a module with `attributes` in sys.modules under `name`, creating missing parent packages."""
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    parent_name, _, child_name = name.rpartition(".")
+    parent = sys.modules.get(parent_name)
+    if parent is None:
+        try:
+            parent = importlib.import_module(parent_name)
+        except ImportError:
+            parent = register_module(parent_name)
+            parent.__path__ = []
+    setattr(parent, child_name, module)
+    return module
+
+
+def parse_custom_args(custom_args: str) -> Dict[str, str]:
+    return dict(arg[2:].partition("=")[::2] for arg in custom_args.split() if arg.startswith("--"))
+
+
+def install_fakes(args: argparse.Namespace, storage: FakeStorageClient) -> None:
+    """Replaces the modules that talk to GCP outside this repository. Must run before the services are imported."""
+
+    def download_file(bucket_name, data_dir, file_name):
+        data = storage.bucket(bucket_name).blob(f"{data_dir}/input_data/{file_name}").download_as_bytes()
+        Path(data_dir).mkdir(parents=True, exist_ok=True)
+        (Path(data_dir) / file_name).write_bytes(data)
+
+    def save_to_bucket_from_string(bucket_name, bucket_dir, file_name, contents):
+        storage.bucket(bucket_name).blob(f"{bucket_dir}/{file_name}").upload_from_string(contents)
+
+    def reverse_image_search(custom_args):
+        time.sleep(args.search_latency)
+        image = parse_custom_args(custom_args)["input_image_file"]
+        return {"matches": [{"url": f"https://images.example/{image}/{i}", "score": 1 / (i + 1)} for i in range(10)]}
+
+    def pipeline_main(custom_args, project_id=None):
+        time.sleep(args.pipeline_latency)
+        pipeline_args = parse_custom_args(custom_args)
+        bucket_name, task_id = pipeline_args["bucket_name"], pipeline_args["bucket_dir"]
+        if pipeline_args["task_name"].startswith("TRAINING"):
+            return {
+                "training": {
+                    "bucket_name": bucket_name,
+                    "model_id": f"model-{task_id}",
+                    "explanations": f"{task_id}/explanations.json",
+                }
+            }
+        return {
+            "inference": {
+                "bucket_name": bucket_name,
+                "predictions": f"{task_id}/predictions.json",
+                "metrics": f"{task_id}/metrics.json",
+            }
+        }
+
+    register_module(
+        "cont_intel.utils.gcp_utils",
+        download_file=download_file,
+        save_to_bucket_from_string=save_to_bucket_from_string,
+        store_annotation_info_to_bq=lambda **kwargs: None,
+        store_message_id_to_bq=lambda message_id, project_id=None: None,
+    )
+    register_module(
+        "cont_intel.utils.secret_management",
+        access_secret_version=lambda secret_id, *args, **kwargs: "{}" if "JSON" in secret_id else "benchmark-secret",
+    )
+    register_module(
+        "cont_intel.reverse_image_search.reverse_image_search_main", reverse_image_search=reverse_image_search
+    )
+    register_module("cont_intel.wrapper.main_new", main=pipeline_main)
+
+
+def patch_services(apps: Dict[str, types.ModuleType], storage: FakeStorageClient, webhook_transport) -> None:
+    """Points the imported services at the fakes."""
+    import httpx
+
+    from cont_intel.api.downloader.src.utils import data_transfer_handler
+    from cont_intel.api.endpoints.src import api_handler
+    from cont_intel.api.utils import claim_check, log_writer, webhook
+
+    api_handler.get_project = lambda: PROJECT_ID
+    apps["downloader"].get_project = lambda: PROJECT_ID
+    data_transfer_handler.storage = types.SimpleNamespace(Client=lambda *args, **kwargs: storage, Blob=FakeBlob)
+    claim_check.get_storage_client = lambda project_id=None: storage
+    apps["output"].get_url_signer = FakeUrlSigner
+
+    writer = log_writer.get_log_writer()
+    writer._client = FakeLoggingClient()
+
+    webhook_client = webhook.WebhookClient.from_env()
+    fake_client = httpx.AsyncClient(transport=httpx.MockTransport(webhook_transport))
+    webhook_client._client_for = lambda host: fake_client
+    webhook._webhook_client = webhook_client
+
+
+def arrival_times(shape: str, rate: float, duration: float, burst_interval: float) -> List[float]:
+    """Send times, in seconds from the start, of the requests of a load shape."""
+    if shape == "steady":
+        return [i / rate for i in range(int(rate * duration))]
+    if shape == "bursty":
+        per_burst = max(1, round(rate * burst_interval))
+        return [burst * burst_interval for burst in range(int(duration / burst_interval)) for _ in range(per_burst)]
+    if shape == "ramp":
+        # The rate rises linearly from 0 to `rate`, so i requests have been sent by sqrt(2 * duration * i / rate)
+        return [math.sqrt(2 * duration * i / rate) for i in range(int(rate * duration / 2))]
+    raise ValueError(f"Unknown load shape {shape}")
+
+
+class MemorySampler:
+    """
+    Samples the peak RSS of the process and, if enabled, the memory held by allocations made from each service's code:
+    an allocation counts for the innermost service whose code is on its stack.
+    """
+
+    def __init__(self, services: List[str], trace: bool, interval: float = 2.0, frames: int = 8):
+        self.services = services
+        self.trace = trace
+        self.interval = interval
+        self.frames = frames
+        self.peaks: Dict[str, int] = dict.fromkeys(services, 0)
+        self._directories = {f"{os.sep}cont_intel{os.sep}api{os.sep}{service}{os.sep}": service for service in services}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.trace:
+            tracemalloc.start(self.frames)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self.sample()
+            tracemalloc.stop()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.sample()
+
+    def _service_of(self, filename: str) -> Optional[str]:
+        for directory, service in self._directories.items():
+            if directory in filename:
+                return service
+        return None
+
+    def sample(self) -> None:
+        held: Dict[str, int] = defaultdict(int)
+        for statistic in tracemalloc.take_snapshot().statistics("traceback"):
+            for frame in statistic.traceback:
+                service = self._service_of(frame.filename)
+                if service is not None:
+                    held[service] += statistic.size
+                    break
+        for service, size in held.items():
+            self.peaks[service] = max(self.peaks[service], size)
+
+    def report(self) -> dict:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        report = {"process_peak_rss_mb": round(peak_rss / 2**20, 1)}
+        if self.trace:
+            report["service_peak_traced_mb"] = {
+                service: round(peak / 2**20, 2) for service, peak in self.peaks.items()
+            }
+        return report
+
+
+async def run(args: argparse.Namespace) -> dict:
+    import httpx
+
+    from cont_intel.api.utils.message_bus import InMemoryBus, Route, percentiles, set_message_bus
+    from cont_intel.api.utils.topics import SUBSCRIPTIONS
+
+    storage = FakeStorageClient()
+    install_fakes(args, storage)
+    apps = {service: importlib.import_module(f"cont_intel.api.{service}.src.api") for service in SERVICES}
+
+    # Webhook deliveries by request index (the last segment of the output URL): time and response status
+    completed: Dict[int, Tuple[float, str]] = {}
+    all_completed = asyncio.Event()
+    sent: Dict[int, Tuple[str, float]] = {}
+    sending_ended: Optional[float] = None
+
+    async def webhook_transport(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(args.webhook_latency)
+        index = int(request.url.path.rsplit("/", 1)[-1])
+        completed.setdefault(index, (time.perf_counter(), json.loads(request.content).get("status", "")))
+        if sending_ended is not None and len(completed) >= len(sent):
+            all_completed.set()
+        return httpx.Response(200)
+
+    patch_services(apps, storage, webhook_transport)
+
+    bus = InMemoryBus(
+        [
+            Route(
+                topic=subscription.topic,
+                path=subscription.path,
+                app=apps[subscription.service].app,
+                workers=args.workers,
+            )
+            for subscription in SUBSCRIPTIONS
+        ],
+        queue_size=args.queue_size,
+    )
+    source = SourceServer(args.file_size)
+    threading.Thread(target=source.serve_forever, daemon=True).start()
+
+    for module in apps.values():
+        await module.app.router.startup()
+    await bus.start()
+    set_message_bus(bus)
+    memory = MemorySampler(SERVICES, args.trace_memory)
+    memory.start()
+
+    rng = random.Random(args.seed)
+    weights = dict(mix.split("=") for mix in args.mix)
+    request_types = rng.choices(list(weights), [float(weight) for weight in weights.values()], k=10**6)
+    schedule = arrival_times(args.shape, args.rate, args.duration, args.burst_interval)
+
+    response_times: Dict[str, List[float]] = defaultdict(list)
+    rejected: Dict[str, int] = defaultdict(int)
+
+    async def send(client: httpx.AsyncClient, index: int, request_type: str) -> None:
+        route, fields = REQUEST_TYPES[request_type]
+        payload = {
+            "signed_file_url": f"{source.url}/files/{request_type}-{index}",
+            "output_url": f"http://{WEBHOOK_HOST}/hook/{index}",
+            **fields,
+        }
+        started = time.perf_counter()
+        try:
+            response = await client.post(route, json=payload)
+            accepted = response.status_code == 201
+        except Exception:  # NOSONAR
+            accepted = False
+        response_times[request_type].append(time.perf_counter() - started)
+        if accepted:
+            sent[index] = (request_type, started)
+        else:
+            rejected[request_type] += 1
+
+    transport = httpx.ASGITransport(app=apps["endpoints"].app)
+    with tempfile.TemporaryDirectory() as work_dir:
+        # The annotator writes its working files relative to the current directory
+        previous_dir = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://endpoints", timeout=None) as client:
+                started = time.perf_counter()
+                senders = []
+                for index, send_at in enumerate(schedule):
+                    delay = started + send_at - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    senders.append(asyncio.create_task(send(client, index, request_types[index])))
+                await asyncio.gather(*senders)
+                sending_ended = time.perf_counter()
+
+                if len(completed) < len(sent):
+                    try:
+                        await asyncio.wait_for(all_completed.wait(), args.timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                ended = max([sending_ended] + [completed_at for completed_at, _ in completed.values()])
+        finally:
+            os.chdir(previous_dir)
+
+        await memory.stop()
+        stages = bus.stats()
+        await bus.stop(timeout=5)
+        set_message_bus(None)
+        for module in apps.values():
+            await module.app.router.shutdown()
+        source.shutdown()
+
+    end_to_end: Dict[str, List[float]] = defaultdict(list)
+    outcomes: Dict[str, Dict[str, int]] = defaultdict(lambda: {"succeeded": 0, "failed": 0, "timed_out": 0})
+    for index, (request_type, sent_at) in sent.items():
+        if index not in completed:
+            outcomes[request_type]["timed_out"] += 1
+            continue
+        completed_at, status = completed[index]
+        if status == "success":
+            outcomes[request_type]["succeeded"] += 1
+            end_to_end[request_type].append(completed_at - sent_at)
+        else:
+            outcomes[request_type]["failed"] += 1
+    succeeded = sum(outcome["succeeded"] for outcome in outcomes.values())
+
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        },
+        "requests": {
+            "sent": len(schedule),
+            "accepted": len(sent),
+            "rejected": dict(rejected),
+            "outcomes": dict(outcomes),
+        },
+        "throughput": {
+            "offered_per_s": round(len(schedule) / max(sending_ended - started, 1e-9), 2),
+            "completed_per_s": round(succeeded / max(ended - started, 1e-9), 2),
+            "duration_s": round(ended - started, 2),
+        },
+        "endpoints_response_ms": {request_type: percentiles(times) for request_type, times in response_times.items()},
+        "end_to_end_ms": {request_type: percentiles(times) for request_type, times in end_to_end.items()},
+        "stages": {key: stages[key] for key in ("wait_ms", "handler_ms", "processed", "failed")},
+        "memory": {**memory.report(), "fake_gcs_mb": round(storage.stored_bytes() / 2**20, 2)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--mix", nargs="+", default=["annotation=1", "inference=1", "training=1"], help="Weights, e.g. annotation=6"
+    )
+    parser.add_argument("--shape", choices=["steady", "bursty", "ramp"], default="steady")
+    parser.add_argument("--rate", type=float, default=10, help="Requests per second (peak rate for ramp)")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds of load")
+    parser.add_argument("--burst-interval", type=float, default=5, help="Seconds between bursts")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for outstanding tasks")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent handlers per topic")
+    parser.add_argument("--queue-size", type=int, default=1000, help="Capacity of each topic's queue")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="Bytes per input file")
+    parser.add_argument("--search-latency", type=float, default=0.5, help="Seconds per reverse image search")
+    parser.add_argument("--pipeline-latency", type=float, default=1.0, help="Seconds per pipeline run")
+    parser.add_argument("--webhook-latency", type=float, default=0.05, help="Seconds per client webhook")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true", help="Attribute memory to services (slow)")
+    parser.add_argument("--log-level", default="WARNING", help="Minimum level of the services' logs")
+    parser.add_argument("--output", default="", help="File the JSON report is written to")
+    args = parser.parse_args()
+
+    for name, value in {
+        "INPUT_CACHE_ENABLED": "false",
+        "ANNOTATION_CACHE_BACKEND": "none",
+        "IDEMPOTENCY_BACKEND": "sqlite",
+        "USE_VERTEX": "false",
+    }.items():
+        os.environ.setdefault(name, value)
+
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level.upper())
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Load test of the Endpoints service's /annotation/initiate route.
+
+Runs the real FastAPI app under uvicorn in this process, with Pub/Sub publishing replaced by a fake whose futures
+resolve after --publish-latency seconds (a typical publish round trip), then measures requests per second at
+increasing client concurrency. With the handler's thread pool the throughput should grow with concurrency until
+ENDPOINTS_MAX_WORKERS requests are in flight; run with ENDPOINTS_MAX_WORKERS=1 to see the serialized baseline.
+
+Run from the directory that contains the cont_intel package, with the endpoints requirements and httpx installed:
+
+    python -m cont_intel.api.benchmarks.endpoints_load --concurrency 1 4 16 64 --requests 400
+"""
+import argparse
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+import httpx
+import uvicorn
+
+import cont_intel.api.endpoints.src.api_handler as api_handler
+from cont_intel.api.endpoints.src.api import app
+
+
+def patch_side_effects(publish_latency: float) -> None:
+    """Replaces the GCP calls of the Endpoints service with local fakes."""
+
+    def publish_pubsub_message(topic_id, pubsub_message) -> Future:
+        future: Future = Future()
+        threading.Timer(publish_latency, future.set_result, args=("message-id",)).start()
+        return future
+
+    api_handler.get_project = lambda: "benchmark-project"
+    api_handler.get_bucket_name = lambda project_id: "benchmark-bucket"
+    api_handler.publish_pubsub_message = publish_pubsub_message
+    api_handler.write_log = lambda *args, **kwargs: None
+
+
+async def run_level(url: str, concurrency: int, total_requests: int) -> float:
+    """Sends `total_requests` requests with `concurrency` in flight, returns the requests per second."""
+    payload = {"signed_file_url": "https://example.com/creative.png", "output_url": "https://example.com/hook"}
+    remaining = iter(range(total_requests))
+
+    async def worker(client: httpx.AsyncClient):
+        for _ in remaining:
+            response = await client.post(url, json=payload)
+            response.raise_for_status()
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        return total_requests / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--requests", type=int, default=400, help="Requests per concurrency level")
+    parser.add_argument("--publish-latency", type=float, default=0.05, help="Seconds per fake publish")
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+
+    patch_side_effects(args.publish_latency)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    url = f"http://127.0.0.1:{args.port}/annotation/initiate"
+    print(f"{'concurrency':>11} {'req/s':>10}")
+    try:
+        for concurrency in args.concurrency:
+            rps = asyncio.run(run_level(url, concurrency, args.requests))
+            print(f"{concurrency:>11} {rps:>10.1f}")
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()
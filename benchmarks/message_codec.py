@@ -0,0 +1,136 @@
+"""
+Micro-benchmark of the PubSubMessage codec.
+
+Compares the previous encoding (json.dumps of the instance __dict__, decoded with json.loads and copied field by
+field) with the current one, with and without zstd compression and with the results passed by claim check, for a
+bare message and for messages carrying results of increasing size. Reports encode and decode throughput (messages
+per second, including the base64 step of the push envelope) and the size of the published body.
+
+    python -m cont_intel.api.benchmarks.message_codec --iterations 2000
+"""
+import argparse
+import base64
+import json
+import os
+import timeit
+from copy import deepcopy
+
+from cont_intel.api.utils import data_classes
+from cont_intel.api.utils.data_classes import PubSubMessage, ResultsRef
+
+
+def make_message(predictions: int) -> PubSubMessage:
+    message = PubSubMessage(
+        project_id="x-contentintelligence-wpp-dev",
+        task_id="0f3c8e0bb1a84d8f9a3d7c2b5e6f1a2b",
+        signed_file_url="https://storage.googleapis.com/api-input-dev/input.json?X-Goog-Signature=abcdef",
+        bucket_name="api-input-dev",
+        task_type="INFERENCE",
+        output_url="https://example.com/hook",
+        dataset_reference="dataset-1",
+        model_id="model-1",
+        explainability=["shap"],
+    )
+    if predictions:
+        message.results = {
+            "inference": {
+                "bucket_name": "api-input-dev",
+                "predictions": [
+                    {"id": i, "label": f"label-{i % 17}", "score": round(1 / (i + 1), 6), "features": [0.25] * 8}
+                    for i in range(predictions)
+                ],
+            }
+        }
+    return message
+
+
+def legacy_encode(message: PubSubMessage) -> bytes:
+    values = {
+        name: getattr(message, name)
+        for name in data_classes._FIELD_NAMES
+        if name not in ("schema_version", "results_ref", "trace_id", "spans", "tenant")
+    }
+    return json.dumps(values, sort_keys=True).encode("utf-8")
+
+
+def legacy_decode(envelope: dict) -> dict:
+    message_data = json.loads(base64.b64decode(envelope["message"]["data"]).decode("utf-8").strip())
+    # The previous from_request copied every field into a new object
+    return {name: message_data.get(name) for name in data_classes._FIELD_NAMES}
+
+
+def envelope(data: bytes, attributes: dict) -> dict:
+    return {"message": {"data": base64.b64encode(data).decode("ascii"), "attributes": attributes, "message_id": "1"}}
+
+
+def bench(label: str, message: PubSubMessage, iterations: int) -> None:
+    rows = []
+
+    legacy_data = legacy_encode(message)
+    legacy_envelope = envelope(legacy_data, {})
+    rows.append(
+        (
+            "legacy json",
+            iterations / timeit.timeit(lambda: base64.b64encode(legacy_encode(message)), number=iterations),
+            iterations / timeit.timeit(lambda: legacy_decode(legacy_envelope), number=iterations),
+            len(legacy_data),
+        )
+    )
+
+    for codec, compression in (("current", "none"), ("current+zstd", "zstd")):
+        os.environ["PUBSUB_COMPRESSION"] = compression
+        os.environ["PUBSUB_COMPRESSION_THRESHOLD"] = "0"
+        data, attributes = message.encode()
+        current_envelope = envelope(data, attributes)
+        rows.append(
+            (
+                codec,
+                iterations / timeit.timeit(lambda: base64.b64encode(message.encode()[0]), number=iterations),
+                iterations / timeit.timeit(lambda: PubSubMessage.from_request(current_envelope), number=iterations),
+                len(data),
+            )
+        )
+
+    if message.results is not None:
+        # With the claim check the message only carries a reference to the stored results
+        referenced = deepcopy(message)
+        referenced.results = None
+        referenced.results_ref = ResultsRef(
+            bucket_name=message.bucket_name, object_name=f"{message.task_id}/results.json", size=0, sha256="0" * 64
+        )
+        data, attributes = referenced.encode()
+        referenced_envelope = envelope(data, attributes)
+        rows.append(
+            (
+                "claim-check",
+                iterations / timeit.timeit(lambda: base64.b64encode(referenced.encode()[0]), number=iterations),
+                iterations / timeit.timeit(lambda: PubSubMessage.from_request(referenced_envelope), number=iterations),
+                len(data),
+            )
+        )
+
+    print(f"\n{label}")
+    print(f"{'codec':<14} {'encode msg/s':>13} {'decode msg/s':>13} {'bytes':>10}")
+    for codec, encode_rate, decode_rate, size in rows:
+        print(f"{codec:<14} {encode_rate:>13.0f} {decode_rate:>13.0f} {size:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--predictions", type=int, nargs="+", default=[0, 100, 5000])
+    args = parser.parse_args()
+
+    print(f"orjson: {data_classes.orjson is not None}, zstandard: {data_classes.zstandard is not None}")
+    environment = deepcopy(dict(os.environ))
+    try:
+        for predictions in args.predictions:
+            iterations = max(10, args.iterations // max(1, predictions // 100))
+            bench(f"{predictions} predictions ({iterations} iterations)", make_message(predictions), iterations)
+    finally:
+        os.environ.clear()
+        os.environ.update(environment)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Cold-start benchmark of the Cloud Run services.
+
+Every service is measured in a fresh interpreter, as on a new instance: the time to import its app module, to run
+its startup events, and to answer its first request. By default the first request is POST / with an empty body,
+which exercises the framework and the error path without touching GCP. Pass --payload with a Pub/Sub push envelope
+to measure a full first request; it then creates the real clients and talks to the project the credentials point at.
+
+Run from the directory that contains the cont_intel package, with the services' requirements installed:
+
+    python -m cont_intel.api.benchmarks.startup_time --runs 3 --output startup.json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+SERVICES = ["controller", "downloader", "pipeline", "annotator", "output", "error-handler", "endpoints"]
+
+
+def measure(service: str, payload: dict) -> dict:
+    """Measures one cold start of `service` in this interpreter. Only meaningful in a fresh process."""
+    import importlib
+
+    started = time.perf_counter()
+    module = importlib.import_module(f"cont_intel.api.{service}.src.api")
+    imported = time.perf_counter()
+
+    from fastapi.testclient import TestClient
+
+    with TestClient(module.app, raise_server_exceptions=False) as client:
+        ready = time.perf_counter()
+        response = client.post("/", json=payload)
+        answered = time.perf_counter()
+
+    return {
+        "import_s": imported - started,
+        "startup_s": ready - imported,
+        "first_request_s": answered - ready,
+        "status_code": response.status_code,
+    }
+
+
+def run_child(service: str, payload_path: str) -> dict:
+    command = [sys.executable, "-m", __spec__.name, "--child", service]
+    if payload_path:
+        command += ["--payload", payload_path]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--services", nargs="+", default=SERVICES)
+    parser.add_argument("--runs", type=int, default=3, help="Cold starts measured per service")
+    parser.add_argument("--payload", default="", help="JSON file sent as the first request")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    payload = {}
+    if args.payload:
+        with open(args.payload) as f:
+            payload = json.load(f)
+
+    if args.child:
+        print(json.dumps(measure(args.child, payload)))
+        return
+
+    results = {}
+    print(f"{'service':<14} {'import ms':>10} {'startup ms':>11} {'first req ms':>13} {'total ms':>9}")
+    for service in args.services:
+        runs = [run_child(service, args.payload) for _ in range(args.runs)]
+        failed = [run for run in runs if "error" in run]
+        if failed:
+            results[service] = {"error": failed[0]["error"]}
+            print(f"{service:<14} failed: {failed[0]['error']}")
+            continue
+
+        medians = {
+            key: statistics.median(run[key] for run in runs) for key in ("import_s", "startup_s", "first_request_s")
+        }
+        medians["total_s"] = sum(medians.values())
+        results[service] = {"runs": runs, "median": medians}
+        print(
+            f"{service:<14} {medians['import_s'] * 1000:>10.0f} {medians['startup_s'] * 1000:>11.0f} "
+            f"{medians['first_request_s'] * 1000:>13.0f} {medians['total_s'] * 1000:>9.0f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,89 @@
+import asyncio
+import base64
+from os import getenv
+
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import PlainTextResponse
 from loguru import logger
 
-from cont_intel.api.utils.api_utils import handle_error, publish_message, write_log
+from cont_intel.api.controller.src.scheduler import Scheduler, scheduler_config_source, stage_of
+from cont_intel.api.utils.api_utils import flush_clients, handle_error, publish_pubsub_message_async, write_log
 from cont_intel.api.utils.data_classes import PubSubMessage, TaskType
+from cont_intel.api.utils.message_bus import InMemoryBus, bus_for
+from cont_intel.api.utils.metrics import instrument_app
+from cont_intel.api.utils.topics import Topic
+from cont_intel.api.utils.tracing import enter_stage, finish_stage
 
 app = FastAPI()
+instrument_app(app, "controller")
+
+# Messages logged when a task is dispatched to a stage
+DISPATCH_MESSAGES = {
+    Topic.DOWNLOADER_START: "Triggering downloader",
+    Topic.PIPELINE_START: "Data download ended, continuing pipeline",
+    Topic.ANNOTATOR_START: "Data download ended, starting annotation",
+}
+
+# The stage each task type continues with once its data is downloaded. The output service picks the task up from that
+# stage's end topic. Task types without one stop after the download.
+NEXT_STAGES = {
+    TaskType.TRAINING.value: Topic.PIPELINE_START,
+    TaskType.INFERENCE.value: Topic.PIPELINE_START,
+    TaskType.INFERENCE_EXPLAINABILITY.value: Topic.PIPELINE_START,
+    TaskType.TRAINING_EXPLAINABILITY.value: Topic.PIPELINE_START,
+    TaskType.ANNOTATION.value: Topic.ANNOTATOR_START,
+}
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Dispatch the tasks still waiting for a stage that Pub/Sub does not redeliver, then flush pending Pub/Sub batches
+    and log entries.
+    """
+    await scheduler.dispatch_all()
+    flush_clients()
 
 # Helper function to log and publish messages in a more centralized manner
-def log_and_publish(pubsub_message_data: PubSubMessage, message: str, topic: str):
+async def log_and_publish(pubsub_message_data: PubSubMessage, message: str, topic: Topic):
     """Log the message and publish to the specified Pub/Sub topic."""
+    finish_stage(pubsub_message_data)
     logger.info(message)
     write_log("api", {"message": message, "request": pubsub_message_data.to_json()})
-    publish_message(pubsub_message_data.project_id, topic, pubsub_message_data.to_json())
+    await publish_pubsub_message_async(topic, pubsub_message_data)
+
+
+async def dispatch(topic: Topic, pubsub_message_data: PubSubMessage):
+    message = DISPATCH_MESSAGES.get(topic, f"Triggering {stage_of(topic)}")
+    await log_and_publish(pubsub_message_data, message, topic)
+
+
+async def report_failure(pubsub_message_data: PubSubMessage, error: Exception):
+    """Reports a task that failed after its push was acknowledged, e.g. while it waited for a stage."""
+    data, attributes = pubsub_message_data.encode()
+    request_json = {"message": {"data": base64.b64encode(data).decode("ascii"), "attributes": attributes}}
+    await asyncio.get_running_loop().run_in_executor(None, handle_error, request_json, error, 204)
+
+
+async def schedule(pubsub_message_data: PubSubMessage, topic: Topic, delivered_on: Topic) -> bool:
+    """
+    Submits the task to the scheduler for `topic`. Returns False if the push that delivered it on `delivered_on`
+    must be left unacknowledged: the task waits for a place, and Pub/Sub keeps it and redelivers it until it has
+    been dispatched. Pushes from the in-process bus are acknowledged either way, as it lives in the same memory.
+    """
+    redelivered = not isinstance(bus_for(delivered_on), InMemoryBus)
+    dispatched = await scheduler.submit(pubsub_message_data, topic, redelivered)
+    return dispatched or not redelivered
+
+
+# Configured from the environment:
+# - SCHEDULER_CONFIG: path or gs:// URL of the JSON config (see SchedulerConfig). Without it no stage is limited.
+# - SCHEDULER_CONFIG_REFRESH: seconds between reloads of the config (default 30)
+scheduler = Scheduler(
+    scheduler_config_source(getenv("SCHEDULER_CONFIG"), float(getenv("SCHEDULER_CONFIG_REFRESH", "30"))),
+    dispatch,
+    report_failure,
+)
 
 @app.post("/", response_class=PlainTextResponse)
 async def read_root(request: Request):
@@ -22,11 +93,12 @@ async def read_root(request: Request):
         logger.info(f"Controller received a request: {request_json}")
         
         pubsub_message_data = PubSubMessage.from_request(request_json)
+        enter_stage(pubsub_message_data, "controller")
         logger.info(f"PubSubMessage created: {pubsub_message_data}")
 
-        # Log the initial request and publish message to "downloader_start"
-        log_and_publish(pubsub_message_data, "Triggering downloader", "downloader_start")
-        return "Request successfully received and processed"
+        # Dispatch the task to the downloader, now or once the downloader has room
+        if await schedule(pubsub_message_data, Topic.DOWNLOADER_START, Topic.CONTROLLER_START):
+            return "Request successfully received and processed"
 
     except Exception as e:
         # Handle any error that occurs during the request processing
@@ -34,29 +106,48 @@ async def read_root(request: Request):
         handle_error(request_json, e, 204)
         raise HTTPException(status_code=204, detail="Error processing the request")
 
+    # Not acknowledged while the task waits, so Pub/Sub redelivers it with backoff until it is dispatched
+    raise HTTPException(status_code=429, detail="Waiting for the downloader")
+
 @app.post("/downloader_end", response_class=PlainTextResponse)
 async def read_downloader_end(request: Request):
     request_json = await request.json()
 
     try:
         pubsub_message_data = PubSubMessage.from_request(request_json)
+        enter_stage(pubsub_message_data, "controller")
         logger.info(f"PubSubMessage created: {pubsub_message_data}")
 
-        # Process based on task type and proceed with the next pipeline step
-        if pubsub_message_data.task_type in [
-            TaskType.TRAINING.value,
-            TaskType.INFERENCE.value,
-            TaskType.INFERENCE_EXPLAINABILITY.value,
-            TaskType.TRAINING_EXPLAINABILITY.value,
-        ]:
-            log_and_publish(pubsub_message_data, "Data download ended, continuing pipeline", "pipeline_start")
-        
-        elif pubsub_message_data.task_type == TaskType.ANNOTATION.value:
-            log_and_publish(pubsub_message_data, "Data download ended, starting annotation", "annotator_start")
-        
-        return "Data download process completed successfully"
+        # The download is done: free its place and proceed with the next stage of the task type
+        scheduler.release(pubsub_message_data.task_id, [stage_of(Topic.DOWNLOADER_START)])
+        next_stage, waiting_for = NEXT_STAGES.get(pubsub_message_data.task_type), None
+        if next_stage is None:
+            logger.warning(f"No stage follows the download for task type {pubsub_message_data.task_type}")
+        elif not await schedule(pubsub_message_data, next_stage, Topic.DOWNLOADER_END):
+            waiting_for = stage_of(next_stage)
+        if waiting_for is None:
+            return "Data download process completed successfully"
 
     except Exception as e:
         logger.exception("Error occurred in downloader_end processing")
         handle_error(request_json, e, 204)
         raise HTTPException(status_code=204, detail="Error processing downloader_end request")
+
+    raise HTTPException(status_code=429, detail=f"Waiting for the {waiting_for}")
+
+
+@app.post("/task_end", response_class=PlainTextResponse)
+async def read_task_end(request: Request):
+    """The task has finished or failed: free its places in the stage budgets."""
+    request_json = await request.json()
+
+    try:
+        pubsub_message_data = PubSubMessage.from_request(request_json)
+        scheduler.release(pubsub_message_data.task_id)
+        return "Task end recorded"
+
+    except Exception as e:
+        # Not reported to the error handler: the task has ended already, and its lease frees its place in time
+        logger.exception(f"Error occurred in task_end processing: {e}")
+        return "Task end ignored"
+
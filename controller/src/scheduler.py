@@ -0,0 +1,411 @@
+import asyncio
+import math
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Iterable, Optional, Set, Tuple
+
+from loguru import logger
+
+from cont_intel.api.utils.config_source import ConfigSource
+from cont_intel.api.utils.data_classes import PubSubMessage, TaskType
+from cont_intel.api.utils.metrics import SCHEDULER_IN_FLIGHT, SCHEDULER_QUEUED, SCHEDULER_WAIT
+from cont_intel.api.utils.topics import Topic, topic_name
+
+# Seconds after which a dispatched task no longer counts against its stage's budget if no end was seen for it
+DEFAULT_LEASES: Dict[str, float] = {"downloader": 1800, "pipeline": 24 * 3600, "annotator": 900}
+DEFAULT_LEASE = 3600
+
+# Tasks without a tenant (e.g. published before tenants existed) share one
+DEFAULT_TENANT = "anonymous"
+
+# Seconds a task dispatched while its push was still unacknowledged is remembered, so the push's redelivery is
+# acknowledged instead of dispatching the task again. Longer than Pub/Sub's maximum retry delay (600 s).
+DEFAULT_REDELIVERY_WINDOW = 3600
+
+
+def stage_of(topic: Topic) -> str:
+    """The stage a topic starts, which budgets and leases are configured by, e.g. "downloader" for downloader_start."""
+    name = topic_name(topic)
+    return name[: -len("_start")] if name.endswith("_start") else name
+
+
+@dataclass(frozen=True)
+class PriorityClass:
+    """
+    Task types scheduled together. A stage serves the class with the highest `priority` first; a class whose oldest
+    task has waited `promote_after` seconds is served before all others, so low priority work is not starved.
+    """
+
+    name: str
+    priority: int
+    task_types: Tuple[str, ...]
+    promote_after: Optional[float] = None
+
+
+DEFAULT_CLASSES: Tuple[PriorityClass, ...] = (
+    PriorityClass("interactive", 2, (TaskType.ANNOTATION.value,)),
+    PriorityClass("standard", 1, (TaskType.INFERENCE.value, TaskType.INFERENCE_EXPLAINABILITY.value)),
+    PriorityClass(
+        "batch",
+        0,
+        (TaskType.TRAINING.value, TaskType.TRAINING_EXPLAINABILITY.value, TaskType.TRAINING_INFERENCE.value),
+        promote_after=3600,
+    ),
+)
+
+
+@dataclass(frozen=True)
+class SchedulerConfig:
+    """
+    Scheduling settings, read from JSON such as:
+
+        {
+            "budgets": {"downloader": 20, "pipeline": 4, "annotator": 50},
+            "leases": {"pipeline": 86400},
+            "classes": {
+                "interactive": {"priority": 2, "task_types": ["ANNOTATION"]},
+                "standard": {"priority": 1, "task_types": ["INFERENCE", "INFERENCE_EXPLAINABILITY"]},
+                "batch": {"priority": 0, "task_types": ["TRAINING", "TRAINING_EXPLAINABILITY"], "promote_after": 3600}
+            },
+            "tenants": {"acme": 3}
+        }
+
+    `budgets` caps the tasks each stage works on at once; stages without a budget are not limited. `leases` bounds
+    how long a dispatched task counts against its stage's budget (see `DEFAULT_LEASES`). `tenants` weighs the
+    tenants' shares of a class; tenants not listed weigh `default_weight`. Task types of no class belong to the one
+    with the lowest priority.
+    """
+
+    budgets: Dict[str, int] = field(default_factory=dict)
+    leases: Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_LEASES))
+    classes: Tuple[PriorityClass, ...] = DEFAULT_CLASSES
+    tenants: Dict[str, float] = field(default_factory=dict)
+    default_weight: float = 1
+
+    @classmethod
+    def from_dict(cls, config: Dict) -> "SchedulerConfig":
+        classes = tuple(
+            PriorityClass(
+                name=name,
+                priority=int(settings["priority"]),
+                task_types=tuple(settings.get("task_types", ())),
+                promote_after=settings.get("promote_after"),
+            )
+            for name, settings in config["classes"].items()
+        ) if config.get("classes") else DEFAULT_CLASSES
+        return cls(
+            budgets={stage: int(budget) for stage, budget in (config.get("budgets") or {}).items()},
+            leases={**DEFAULT_LEASES, **{stage: float(lease) for stage, lease in (config.get("leases") or {}).items()}},
+            classes=classes,
+            tenants={tenant: float(weight) for tenant, weight in (config.get("tenants") or {}).items()},
+            default_weight=float(config.get("default_weight", 1)),
+        )
+
+    def class_of(self, task_type: str) -> PriorityClass:
+        for priority_class in self.classes:
+            if task_type in priority_class.task_types:
+                return priority_class
+        return min(self.classes, key=lambda priority_class: priority_class.priority)
+
+    def weight_of(self, tenant: str) -> float:
+        return max(self.tenants.get(tenant, self.default_weight), 1e-6)
+
+
+@dataclass
+class _Entry:
+    pubsub_message: PubSubMessage
+    topic: Topic
+    priority_class: str
+    enqueued_at: float
+    # Whether the push that brought the task was left unacknowledged, so its source redelivers it
+    redelivered: bool = False
+
+
+class _TenantQueue:
+    """A tenant's queued tasks of one class, one queue per task type, served in turn."""
+
+    def __init__(self):
+        self.by_task_type: Dict[str, Deque[_Entry]] = {}
+        self.turns: Deque[str] = deque()
+        self.pass_value = 0.0
+        self.size = 0
+
+    def push(self, entry: _Entry) -> None:
+        task_type = entry.pubsub_message.task_type
+        if task_type not in self.by_task_type:
+            self.by_task_type[task_type] = deque()
+            self.turns.append(task_type)
+        self.by_task_type[task_type].append(entry)
+        self.size += 1
+
+    def pop(self) -> _Entry:
+        task_type = self.turns[0]
+        queue = self.by_task_type[task_type]
+        entry = queue.popleft()
+        self.turns.rotate(-1)
+        if not queue:
+            del self.by_task_type[task_type]
+            self.turns.remove(task_type)
+        self.size -= 1
+        return entry
+
+    def oldest(self) -> float:
+        return min(queue[0].enqueued_at for queue in self.by_task_type.values())
+
+
+class _ClassQueue:
+    """
+    The queued tasks of one priority class for one stage. Tenants share the stage by stride scheduling: the tenant
+    with the lowest pass value goes next, and every task it starts advances its pass by 1 / its weight. A tenant that
+    becomes busy starts from the class' current pass, so idle time earns it no credit.
+    """
+
+    def __init__(self):
+        self.tenants: Dict[str, _TenantQueue] = {}
+        self.virtual_time = 0.0
+        self.size = 0
+
+    def push(self, tenant: str, entry: _Entry) -> None:
+        tenant_queue = self.tenants.get(tenant)
+        if tenant_queue is None:
+            tenant_queue = self.tenants[tenant] = _TenantQueue()
+            tenant_queue.pass_value = self.virtual_time
+        tenant_queue.push(entry)
+        self.size += 1
+
+    def pop(self, weight_of: Callable[[str], float]) -> _Entry:
+        tenant, tenant_queue = min(self.tenants.items(), key=lambda item: item[1].pass_value)
+        self.virtual_time = tenant_queue.pass_value
+        tenant_queue.pass_value += 1 / weight_of(tenant)
+        entry = tenant_queue.pop()
+        if tenant_queue.size == 0:
+            del self.tenants[tenant]
+        self.size -= 1
+        return entry
+
+    def oldest(self) -> float:
+        return min(tenant_queue.oldest() for tenant_queue in self.tenants.values())
+
+
+class Scheduler:
+    """
+    Dispatches tasks to the stages within the stages' budgets, serving priority classes in order and the tenants of a
+    class in proportion to their weights (see `SchedulerConfig`).
+
+    A task counts against a stage's budget from its dispatch until `release` is called for it, when the stage's end
+    message or the task's end reaches the Controller, or until its lease expires. Tasks that find their stage's
+    budget used up wait in the Controller's memory and are dispatched in the background as places free up. Without
+    budgets every task is dispatched straight away.
+
+    A waiting task submitted with `redelivered=True` is not the only copy: the push that brought it is answered with
+    an error, so Pub/Sub keeps the message and redelivers it with backoff until the task has been dispatched. If the
+    instance stops or crashes, the tasks waiting in its memory are not lost; they are queued again on redelivery.
+    A task dispatched from memory is remembered for `redelivery_window` seconds, and its next redelivery is
+    acknowledged rather than dispatched again. A task can still be dispatched twice if the instance stops between
+    dispatching it and acknowledging its redelivery.
+
+    The state is per process, so the budgets only hold when a single Controller instance runs. Everything runs on
+    the event loop, so it needs no locks.
+    """
+
+    def __init__(
+        self,
+        config_source: ConfigSource[SchedulerConfig],
+        publish: Callable[[Topic, PubSubMessage], Awaitable[None]],
+        on_failure: Callable[[PubSubMessage, Exception], Awaitable[None]],
+        tick: float = 5,
+        redelivery_window: float = DEFAULT_REDELIVERY_WINDOW,
+    ):
+        self.config_source = config_source
+        self.publish = publish
+        self.on_failure = on_failure
+        self.tick = tick
+        self.redelivery_window = redelivery_window
+        # stage -> priority class -> queued tasks
+        self._queues: Dict[str, Dict[str, _ClassQueue]] = defaultdict(dict)
+        # stage -> task_id -> lease expiry (monotonic time)
+        self._leases: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self._queued_ids: Dict[str, Set[str]] = defaultdict(set)
+        # stage -> task_id -> when it was dispatched, of the tasks dispatched while their push awaited redelivery
+        self._dispatched_unacked: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self._dispatches: Set[asyncio.Task] = set()
+        self._ticker: Optional[asyncio.Task] = None
+        self._draining = False
+
+    def queued(self, stage: str) -> int:
+        return len(self._queued_ids[stage])
+
+    def in_flight(self, stage: str) -> int:
+        return len(self._leases[stage])
+
+    def _has_room(self, stage: str, config: SchedulerConfig) -> bool:
+        if self._draining:
+            return True
+        budget = config.budgets.get(stage)
+        return budget is None or len(self._leases[stage]) < budget
+
+    async def submit(self, pubsub_message: PubSubMessage, topic: Topic, redelivered: bool = False) -> bool:
+        """
+        Dispatches `pubsub_message` to `topic` now if its stage has room and no task is waiting for it, raising if
+        the publish fails, or queues it. Returns whether the task has been dispatched, now or before: while it waits,
+        False, and a push with `redelivered` should be answered so that its source redelivers it.
+        """
+        self._ensure_ticker()
+        config = self.config_source.get()
+        stage, task_id = stage_of(topic), pubsub_message.task_id
+        if task_id in self._queued_ids[stage]:
+            logger.info(f"Task {task_id} is still waiting for the {stage}")
+            return False
+        if task_id in self._leases[stage] or self._dispatched_unacked[stage].pop(task_id, None) is not None:
+            logger.warning(f"Task {task_id} was already dispatched to the {stage}, ignoring the duplicate")
+            return True
+
+        priority_class = config.class_of(pubsub_message.task_type).name
+        entry = _Entry(pubsub_message, topic, priority_class, time.monotonic(), redelivered)
+        if not self._queued_ids[stage] and self._has_room(stage, config):
+            self._acquire(stage, entry, config)
+            await self._publish(stage, entry)
+            return True
+
+        self._queues[stage].setdefault(priority_class, _ClassQueue()).push(
+            pubsub_message.tenant or DEFAULT_TENANT, entry
+        )
+        self._queued_ids[stage].add(task_id)
+        logger.info(f"Task {task_id} queued for the {stage} ({self.queued(stage)} waiting)")
+        self._pump(stage, config)
+        self._record(stage)
+        if task_id in self._queued_ids[stage]:
+            return False
+        # Dispatched by the pump straight away; the push is acknowledged, so there is no redelivery to wait for
+        self._dispatched_unacked[stage].pop(task_id, None)
+        return True
+
+    def release(self, task_id: str, stages: Optional[Iterable[str]] = None) -> None:
+        """Frees the place of `task_id` in the budgets of `stages` (default: all) and dispatches waiting tasks."""
+        config = self.config_source.get()
+        for stage in stages or list(self._leases):
+            if self._leases[stage].pop(task_id, None) is not None:
+                self._pump(stage, config)
+                self._record(stage)
+
+    async def dispatch_all(self) -> None:
+        """
+        Used on shutdown: dispatches every waiting task whose push was acknowledged, and from then on every submitted
+        one, regardless of the budgets, and waits for the publishes. Tasks whose push awaits redelivery are left to
+        it, as dispatching them here would run them again in the instance they are redelivered to.
+        """
+        self._draining = True
+        if self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+        config = self.config_source.get()
+        for stage in list(self._queued_ids):
+            while self._queued_ids[stage]:
+                entry = self._pop(stage, config)
+                if not entry.redelivered:
+                    self._start_dispatch(stage, entry, config)
+            self._record(stage)
+        await asyncio.gather(*self._dispatches, return_exceptions=True)
+
+    def _ensure_ticker(self) -> None:
+        # Started on first use rather than on startup: in monolith mode the Controller's startup hooks do not run
+        if self._ticker is None and not self._draining:
+            self._ticker = asyncio.get_running_loop().create_task(self._run_ticker(), name="scheduler-ticker")
+
+    async def _run_ticker(self) -> None:
+        """Reclaims expired leases, forgets redeliveries that never came and applies budget changes."""
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                config, now = self.config_source.get(), time.monotonic()
+                for stage, leases in list(self._leases.items()):
+                    for task_id in [task_id for task_id, expiry in leases.items() if expiry <= now]:
+                        logger.warning(f"Lease of task {task_id} in the {stage} expired before its end was seen")
+                        del leases[task_id]
+                    self._pump(stage, config)
+                    self._record(stage)
+                for dispatched in self._dispatched_unacked.values():
+                    for task_id in [
+                        task_id
+                        for task_id, dispatched_at in dispatched.items()
+                        if now - dispatched_at > self.redelivery_window
+                    ]:
+                        del dispatched[task_id]
+            except Exception as e:  # NOSONAR
+                logger.error(f"Scheduler tick failed: {e}")
+
+    def _pop(self, stage: str, config: SchedulerConfig) -> _Entry:
+        """The next task for `stage`: from the class with the highest priority, or a class that waited too long."""
+        now = time.monotonic()
+        priorities = {priority_class.name: priority_class for priority_class in config.classes}
+
+        def rank(item: Tuple[str, _ClassQueue]) -> Tuple[float, float]:
+            name, class_queue = item
+            priority_class = priorities.get(name)
+            waited = now - class_queue.oldest()
+            if priority_class is None or (
+                priority_class.promote_after is not None and waited >= priority_class.promote_after
+            ):
+                return math.inf, waited
+            return priority_class.priority, waited
+
+        name, class_queue = max(
+            ((name, class_queue) for name, class_queue in self._queues[stage].items() if class_queue.size),
+            key=rank,
+        )
+        entry = class_queue.pop(config.weight_of)
+        if class_queue.size == 0:
+            del self._queues[stage][name]
+        self._queued_ids[stage].discard(entry.pubsub_message.task_id)
+        return entry
+
+    def _pump(self, stage: str, config: SchedulerConfig) -> None:
+        while self._queued_ids[stage] and self._has_room(stage, config):
+            self._start_dispatch(stage, self._pop(stage, config), config)
+
+    def _start_dispatch(self, stage: str, entry: _Entry, config: SchedulerConfig) -> None:
+        self._acquire(stage, entry, config)
+        if entry.redelivered:
+            self._dispatched_unacked[stage][entry.pubsub_message.task_id] = time.monotonic()
+        task = asyncio.get_running_loop().create_task(self._dispatch_in_background(stage, entry))
+        self._dispatches.add(task)
+        task.add_done_callback(self._dispatches.discard)
+
+    def _acquire(self, stage: str, entry: _Entry, config: SchedulerConfig) -> None:
+        """Counts the task against the stage's budget, before it is published so later picks see the place taken."""
+        now = time.monotonic()
+        self._leases[stage][entry.pubsub_message.task_id] = now + config.leases.get(stage, DEFAULT_LEASE)
+        SCHEDULER_WAIT.labels(stage=stage, priority_class=entry.priority_class).observe(now - entry.enqueued_at)
+        self._record(stage)
+
+    async def _publish(self, stage: str, entry: _Entry) -> None:
+        try:
+            await self.publish(entry.topic, entry.pubsub_message)
+        except Exception:
+            self.release(entry.pubsub_message.task_id, [stage])
+            raise
+
+    async def _dispatch_in_background(self, stage: str, entry: _Entry) -> None:
+        task_id = entry.pubsub_message.task_id
+        try:
+            await self._publish(stage, entry)
+        except Exception as e:  # NOSONAR
+            if self._dispatched_unacked[stage].pop(task_id, None) is not None:
+                # The push is still unacknowledged: its redelivery queues the task again
+                logger.warning(f"Failed to dispatch task {task_id} to the {stage}, leaving it to redelivery: {e}")
+                return
+            logger.error(f"Failed to dispatch task {task_id} to the {stage}: {e}")
+            await self.on_failure(entry.pubsub_message, e)
+
+    def _record(self, stage: str) -> None:
+        SCHEDULER_IN_FLIGHT.labels(stage=stage).set(len(self._leases[stage]))
+        for priority_class in self.config_source.get().classes:
+            class_queue = self._queues[stage].get(priority_class.name)
+            SCHEDULER_QUEUED.labels(stage=stage, priority_class=priority_class.name).set(
+                class_queue.size if class_queue is not None else 0
+            )
+
+
+def scheduler_config_source(location: Optional[str], refresh_interval: float = 30) -> ConfigSource[SchedulerConfig]:
+    return ConfigSource(location, SchedulerConfig.from_dict, SchedulerConfig(), refresh_interval=refresh_interval)
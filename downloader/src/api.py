@@ -1,3 +1,5 @@
+import asyncio
+from functools import lru_cache
 from os import getenv
 
 from fastapi import FastAPI, Request, HTTPException
@@ -5,23 +7,44 @@ from fastapi.responses import PlainTextResponse
 from loguru import logger
 
 from cont_intel.api.downloader.src.utils.data_transfer_handler import DataTransferHandler
-from cont_intel.api.utils.api_utils import get_bucket_name, get_project, handle_error, publish_message, write_log
+from cont_intel.api.utils.api_utils import (
+    flush_clients,
+    get_bucket_name,
+    get_project,
+    handle_error,
+    publish_pubsub_message_async,
+    write_log,
+)
 from cont_intel.api.utils.data_classes import PubSubMessage
+from cont_intel.api.utils.metrics import instrument_app
+from cont_intel.api.utils.topics import Topic
+from cont_intel.api.utils.tracing import enter_stage, finish_stage, traced
 
 # Constants and initialization
 app = FastAPI()
-project_id = get_project()
-bucket_name = get_bucket_name(project_id)
-data_transfer_handler = DataTransferHandler(bucket_name)
+instrument_app(app, "downloader")
 SERVICE_NAME = getenv("K_SERVICE")
 
 
+@lru_cache(maxsize=None)
+def get_data_transfer_handler() -> DataTransferHandler:
+    """Built on the first request rather than at import, so the instance can serve as soon as uvicorn is up."""
+    return DataTransferHandler(get_bucket_name(get_project()))
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """Flush pending Pub/Sub batches and log entries before the instance is stopped."""
+    flush_clients()
+
+
 # Helper function to log and publish messages
-def log_and_publish(pubsub_message_data: PubSubMessage, message: str, topic: str):
+async def log_and_publish(pubsub_message_data: PubSubMessage, message: str, topic: Topic):
     """Log the message and publish to the specified Pub/Sub topic."""
+    finish_stage(pubsub_message_data)
     logger.info(message)
     write_log("api", {"message": message, "request": pubsub_message_data.to_json()})
-    publish_message(pubsub_message_data.project_id, topic, pubsub_message_data.to_json())
+    await publish_pubsub_message_async(topic, pubsub_message_data)
 
 
 @app.post("/", response_class=PlainTextResponse)
@@ -32,25 +55,34 @@ async def read_root(request: Request):
         logger.info(f"{SERVICE_NAME} received a request: {request_json}")
         
         pubsub_message_data = PubSubMessage.from_request(request_json)
+        enter_stage(pubsub_message_data, "downloader")
         logger.info(f"PubSubMessage created: {pubsub_message_data}")
 
-        # Log the initial request and publish message to "downloader_start"
+        # Log the initial request. Nothing is published here: "downloader_start" is this service's own input topic,
+        # and publishing to it would deliver the task back to the downloader.
         write_log("api", {"message": f"{SERVICE_NAME} received a request", "request": pubsub_message_data.to_json()})
-        log_and_publish(pubsub_message_data, "Downloader started", "downloader_start")
+        logger.info("Downloader started")
 
         # Extract necessary information from PubSub message
         task_id = pubsub_message_data.task_id
         dataset_reference = pubsub_message_data.dataset_reference
         signed_url = pubsub_message_data.signed_file_url
 
-        # Start the file transfer process
-        data_transfer_handler.transfer_file_to_gcs(
-            task_id, dataset_reference, signed_url, pubsub_message_data.task_type, pubsub_message_data.input_data_type
-        )
+        # Start the file transfer process; it blocks, so it runs off the event loop
+        with traced(pubsub_message_data, "downloader.transfer"):
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                get_data_transfer_handler().transfer_file_to_gcs,
+                task_id,
+                dataset_reference,
+                signed_url,
+                pubsub_message_data.task_type,
+                pubsub_message_data.input_data_type,
+            )
 
         # Log the completion of the download process and publish the "downloader_end" message
         write_log("api", {"message": "Downloader ended"})
-        log_and_publish(pubsub_message_data, "Downloader ended", "downloader_end")
+        await log_and_publish(pubsub_message_data, "Downloader ended", Topic.DOWNLOADER_END)
         
         return "200"
 
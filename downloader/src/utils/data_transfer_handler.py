@@ -1,17 +1,82 @@
+import hashlib
 import pathlib
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from os import getenv
+from typing import List, Optional, Tuple
+
 import requests
 from google.cloud import storage
 from loguru import logger
 
+from cont_intel.api.downloader.src.utils.input_cache import InputCache
 from cont_intel.api.utils.data_classes import TaskType
 from cont_intel.api.utils.api_utils import handle_error
+from cont_intel.api.utils.metrics import TRANSFERRED_BYTES
+
+# GCS resumable uploads require chunk sizes that are multiples of 256 KiB
+GCS_CHUNK_ALIGNMENT = 256 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_PART_SIZE = 32 * 1024 * 1024
+DEFAULT_PARALLEL_THRESHOLD = 64 * 1024 * 1024
+# GCS compose accepts at most 32 source objects per call
+MAX_COMPOSE_SOURCES = 32
+CONTENT_RANGE_PATTERN = re.compile(r"bytes \d+-\d+/(\d+)")
 
 
 class DataTransferHandler:
-    def __init__(self, bucket_name):
+    def __init__(
+        self,
+        bucket_name,
+        chunk_size: Optional[int] = None,
+        streaming: Optional[bool] = None,
+        timeout: float = 60,
+        parallelism: Optional[int] = None,
+        part_size: Optional[int] = None,
+        parallel_threshold: Optional[int] = None,
+        input_cache: Optional[InputCache] = None,
+    ):
+        """
+        :param bucket_name: the GCS bucket the input files are written to
+        :param chunk_size: bytes read from the HTTP response and sent per resumable upload request.
+            Defaults to TRANSFER_CHUNK_SIZE (bytes) or 8 MiB; rounded up to a multiple of 256 KiB.
+        :param streaming: pipe the download into the upload chunk by chunk, so memory use does not depend on the
+            file size. Defaults to TRANSFER_STREAMING, which defaults to "true".
+        :param timeout: connect/read timeout in seconds for the source server
+        :param parallelism: number of byte ranges fetched concurrently when the source supports range requests.
+            Defaults to TRANSFER_PARALLELISM or 8; 1 disables ranged downloads.
+        :param part_size: bytes per range request. Defaults to TRANSFER_PART_SIZE or 32 MiB.
+        :param parallel_threshold: files smaller than this many bytes use a single stream.
+            Defaults to TRANSFER_PARALLEL_THRESHOLD or 64 MiB.
+        :param input_cache: content-addressed store of earlier downloads. By default one is created in the input
+            bucket unless INPUT_CACHE_ENABLED is "false"; its TTL is INPUT_CACHE_TTL seconds (default 7 days).
+        """
         self.gcs_client = storage.Client()
-        # gcs
-        self.bucket_gcs = self.gcs_client.get_bucket(bucket_name)
+        # gcs; the bucket is addressed directly, without a metadata request
+        self.bucket_gcs = self.gcs_client.bucket(bucket_name)
+
+        if chunk_size is None:
+            chunk_size = int(getenv("TRANSFER_CHUNK_SIZE", str(DEFAULT_CHUNK_SIZE)))
+        self.chunk_size = max(1, -(-chunk_size // GCS_CHUNK_ALIGNMENT)) * GCS_CHUNK_ALIGNMENT
+
+        if streaming is None:
+            streaming = getenv("TRANSFER_STREAMING", "true").lower() == "true"
+        self.streaming = streaming
+        self.timeout = timeout
+
+        self.parallelism = parallelism or int(getenv("TRANSFER_PARALLELISM", "8"))
+        self.part_size = part_size or int(getenv("TRANSFER_PART_SIZE", str(DEFAULT_PART_SIZE)))
+        if parallel_threshold is None:
+            parallel_threshold = int(getenv("TRANSFER_PARALLEL_THRESHOLD", str(DEFAULT_PARALLEL_THRESHOLD)))
+        self.parallel_threshold = parallel_threshold
+
+        if input_cache is None and getenv("INPUT_CACHE_ENABLED", "true").lower() == "true":
+            input_cache = InputCache(
+                self.bucket_gcs, ttl=timedelta(seconds=int(getenv("INPUT_CACHE_TTL", str(7 * 24 * 3600))))
+            )
+        self.input_cache = input_cache
 
     def transfer_file_to_gcs(self, task_id: str, dataset_reference: str, signed_url: str, task_type: str, input_data_type: str):
         try:
@@ -22,12 +87,45 @@ class DataTransferHandler:
                 file_name = f"data.{input_data_type}"  # "json" or "csv"
                 content_type = "application/json"
 
-            logger.info(f"Downloading file {file_name} from {signed_url}")
-            # note: eventually this might need optimization to split into stream/chunks
-            with requests.get(signed_url) as r:
-                r.raise_for_status()
-                logger.info("Downloading finished, proceeding to upload")
-                return self._upload_file_to_gcs(r.text, task_id, dataset_reference, file_name, content_type)
+            upload_path = self._get_upload_path(task_id, dataset_reference, file_name)
+
+            total_size, validator = None, None
+            if self.parallelism > 1 or self.input_cache is not None:
+                total_size, validator = self._probe_source(signed_url)
+
+            if self.input_cache is not None:
+                digest = self.input_cache.lookup(signed_url, validator)
+                if digest is not None:
+                    try:
+                        return self.input_cache.materialize(digest, upload_path)
+                    except Exception as e:  # NOSONAR
+                        # E.g. the payload was evicted since the lookup; download it as if it had missed
+                        logger.error(f"Failed to copy {digest} from the input cache, downloading instead: {e}")
+
+            hasher = hashlib.sha256()
+            if total_size is not None and total_size >= self.parallel_threshold:
+                logger.info(f"Downloading file {file_name} ({total_size} bytes) from {signed_url} in byte ranges")
+                self._parallel_transfer_to_gcs(signed_url, upload_path, content_type, total_size, hasher)
+            else:
+                logger.info(f"Downloading file {file_name} from {signed_url}")
+                with requests.get(signed_url, stream=self.streaming, timeout=self.timeout) as r:
+                    r.raise_for_status()
+                    if self.streaming:
+                        self._stream_file_to_gcs(r, upload_path, content_type, hasher)
+                    else:
+                        logger.info("Downloading finished, proceeding to upload")
+                        hasher.update(r.content)
+                        TRANSFERRED_BYTES.labels(mode="single").inc(len(r.content))
+                        # Keep the raw bytes: decoding to text corrupts binary files such as images
+                        uploaded = self._upload_file_to_gcs(
+                            r.content, task_id, dataset_reference, file_name, content_type
+                        )
+                        if uploaded is None:
+                            return None
+
+            if self.input_cache is not None:
+                self.input_cache.store(upload_path, hasher.hexdigest(), signed_url, validator)
+            return upload_path
 
         except requests.exceptions.RequestException as e:
             # Handle any issues with downloading the file
@@ -37,17 +135,158 @@ class DataTransferHandler:
             # Catch other exceptions during file transfer
             handle_error({'task_id': task_id, 'dataset_reference': dataset_reference, 'signed_url': signed_url}, e, 500)
 
+    @staticmethod
+    def _get_upload_path(task_id: str, dataset_reference: str, file_name: str) -> str:
+        if dataset_reference:
+            return str(pathlib.Path(task_id) / "input_data" / dataset_reference / file_name)
+        return str(pathlib.Path(task_id) / "input_data" / file_name)
+
+    def _stream_file_to_gcs(
+        self, response: requests.Response, upload_path: str, content_type: str, hasher: Optional["hashlib._Hash"] = None
+    ) -> str:
+        """
+        Pipes the HTTP response into a GCS resumable upload. At most one chunk is held in memory at a time.
+        """
+        logger.info(f"Streaming file {upload_path} to bucket {self.bucket_gcs} in {self.chunk_size} byte chunks")
+        blob = self.bucket_gcs.blob(upload_path)
+        total_bytes = 0
+        transferred_bytes = TRANSFERRED_BYTES.labels(mode="stream")
+        with blob.open("wb", chunk_size=self.chunk_size, content_type=content_type, ignore_flush=True) as writer:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                writer.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                total_bytes += len(chunk)
+                transferred_bytes.inc(len(chunk))
+        logger.info(f"File uploaded ({total_bytes} bytes)")
+        return upload_path
+
+    def _probe_source(self, signed_url: str) -> Tuple[Optional[int], Optional[str]]:
+        """
+        Returns the size of the source file if the server accepts byte range requests (otherwise None), and the
+        validator (ETag or Last-Modified) the server reports for it, if any.
+        """
+        try:
+            with requests.head(signed_url, allow_redirects=True, timeout=self.timeout) as r:
+                if r.ok:
+                    validator = r.headers.get("ETag") or r.headers.get("Last-Modified")
+                    if r.headers.get("Accept-Ranges", "").lower() == "bytes" and r.headers.get("Content-Length"):
+                        return int(r.headers["Content-Length"]), validator
+                    if validator:
+                        return None, validator
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+
+        # Signed URLs are usually signed for GET only, in which case HEAD is rejected. Ask for the first byte instead.
+        try:
+            with requests.get(signed_url, headers={"Range": "bytes=0-0"}, stream=True, timeout=self.timeout) as r:
+                validator = r.headers.get("ETag") or r.headers.get("Last-Modified") if r.ok else None
+                if r.status_code == 206:
+                    match = CONTENT_RANGE_PATTERN.fullmatch(r.headers.get("Content-Range", ""))
+                    if match:
+                        return int(match.group(1)), validator
+                return None, validator
+        except requests.exceptions.RequestException:
+            pass
+        return None, None
+
+    def _parallel_transfer_to_gcs(
+        self,
+        signed_url: str,
+        upload_path: str,
+        content_type: str,
+        total_size: int,
+        hasher: Optional["hashlib._Hash"] = None,
+    ) -> str:
+        """
+        Downloads the file in `part_size` byte ranges, `parallelism` at a time, uploads every range as a temporary
+        part object and composes the parts into `upload_path`. At most `parallelism` parts are held in memory.
+        Parts are collected in order, so `hasher` sees the bytes of the whole file in sequence.
+        """
+        ranges = [
+            (start, min(start + self.part_size, total_size) - 1) for start in range(0, total_size, self.part_size)
+        ]
+        temporary_blobs: List[storage.Blob] = []
+        try:
+            part_blobs: List[storage.Blob] = []
+            with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+                try:
+                    pending = deque()
+                    for index, byte_range in enumerate(ranges):
+                        part_name = f"{upload_path}.parts/{index:05d}"
+                        # Recorded before the upload starts, so a part is deleted even if another part fails
+                        temporary_blobs.append(self.bucket_gcs.blob(part_name))
+                        pending.append(executor.submit(self._transfer_part, signed_url, part_name, byte_range))
+                        # Keep a bounded window of parts in flight
+                        if len(pending) >= self.parallelism:
+                            part_blobs.append(self._collect_part(pending.popleft(), hasher))
+                    while pending:
+                        part_blobs.append(self._collect_part(pending.popleft(), hasher))
+                except BaseException:
+                    # Let the parts being uploaded finish, so the cleanup below sees them, and drop the rest
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise
+
+            blob = self._compose(part_blobs, upload_path, content_type, temporary_blobs)
+            blob.reload()
+            if blob.size != total_size:
+                raise ValueError(f"Transferred {blob.size} bytes to {upload_path}, expected {total_size}")
+
+            logger.info(f"File uploaded ({total_size} bytes in {len(ranges)} parts)")
+            return upload_path
+        finally:
+            self.bucket_gcs.delete_blobs(temporary_blobs, on_error=lambda blob: None)
+
+    @staticmethod
+    def _collect_part(future, hasher: Optional["hashlib._Hash"]) -> storage.Blob:
+        blob, content = future.result()
+        if hasher is not None:
+            hasher.update(content)
+        return blob
+
+    def _transfer_part(
+        self, signed_url: str, part_name: str, byte_range: Tuple[int, int]
+    ) -> Tuple[storage.Blob, bytes]:
+        start, end = byte_range
+        with requests.get(signed_url, headers={"Range": f"bytes={start}-{end}"}, timeout=self.timeout) as r:
+            r.raise_for_status()
+            if r.status_code != 206 or len(r.content) != end - start + 1:
+                raise ValueError(f"Invalid response for byte range {start}-{end}: status {r.status_code}")
+            blob = self.bucket_gcs.blob(part_name)
+            blob.upload_from_string(r.content, content_type="application/octet-stream")
+            TRANSFERRED_BYTES.labels(mode="ranged").inc(len(r.content))
+            return blob, r.content
+
+    def _compose(
+        self, sources: List[storage.Blob], upload_path: str, content_type: str, temporary_blobs: List[storage.Blob]
+    ) -> storage.Blob:
+        """
+        Composes `sources` into `upload_path`, going through intermediate objects when there are more than 32.
+        """
+        level = 0
+        while len(sources) > MAX_COMPOSE_SOURCES:
+            intermediates = []
+            for index in range(0, len(sources), MAX_COMPOSE_SOURCES):
+                intermediate = self.bucket_gcs.blob(f"{upload_path}.parts/compose-{level}-{index:05d}")
+                temporary_blobs.append(intermediate)
+                intermediate.compose(sources[index : index + MAX_COMPOSE_SOURCES])
+                intermediates.append(intermediate)
+            sources = intermediates
+            level += 1
+
+        blob = self.bucket_gcs.blob(upload_path)
+        blob.content_type = content_type
+        blob.compose(sources)
+        return blob
+
     def _upload_file_to_gcs(
-        self, content: str, task_id: str, dataset_reference: str, file_name: str, content_type: str
+        self, content: bytes, task_id: str, dataset_reference: str, file_name: str, content_type: str
     ):
         """
         Uploads the file to Google Cloud bucket
         """
         try:
-            if dataset_reference:
-                upload_path = str(pathlib.Path(task_id) / "input_data" / dataset_reference / file_name)
-            else:
-                upload_path = str(pathlib.Path(task_id) / "input_data" / file_name)
+            upload_path = self._get_upload_path(task_id, dataset_reference, file_name)
 
             logger.info(f"Uploading file {upload_path} to bucket {self.bucket_gcs}")
             blob = self.bucket_gcs.blob(upload_path)
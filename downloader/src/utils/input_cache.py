@@ -0,0 +1,169 @@
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from google.cloud import storage
+from loguru import logger
+
+from cont_intel.api.utils.metrics import record_cache_lookup
+
+# Query parameters that sign a URL rather than name the file (GCS V2/V4, S3 SigV2/V4, CloudFront and Azure SAS
+# signatures). They change every time a URL is signed, so they are left out of the cache key; every other parameter
+# can select a different file and is kept.
+SIGNATURE_PARAMETER_PREFIXES = ("x-goog-", "x-amz-")
+SIGNATURE_PARAMETERS = frozenset(
+    {
+        "googleaccessid", "awsaccesskeyid", "expires", "signature", "policy", "key-pair-id",
+        "sig", "se", "st", "sp", "sv", "sr", "ss", "srt", "spr", "si", "skoid", "sktid", "skt", "ske", "sks", "skv",
+    }
+)
+
+
+def is_signature_parameter(name: str) -> bool:
+    name = name.lower()
+    return name in SIGNATURE_PARAMETERS or name.startswith(SIGNATURE_PARAMETER_PREFIXES)
+
+
+class InputCache:
+    """
+    Content-addressed store for downloaded input files, kept in the input bucket.
+
+    - `{prefix}/sha256/{digest}` holds one copy of every distinct payload, keyed by the SHA-256 of its bytes.
+    - `{prefix}/sources/{key}` maps a source URL (without its signature parameters, so re-signed URLs match) and
+      the validator the source server returned for it (ETag, or Last-Modified) to a payload digest.
+
+    A source that is found in the index is copied server-side into the task folder instead of being downloaded and
+    uploaded again. Entries expire `ttl` after they were last used (tracked in the objects' custom time, so a
+    `daysSinceCustomTime` lifecycle rule on the bucket can do the same job); expired entries are removed by
+    `evict_expired`, which runs in the background at most once per `eviction_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        bucket: storage.Bucket,
+        prefix: str = "input_cache",
+        ttl: timedelta = timedelta(days=7),
+        eviction_interval: float = 3600,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.ttl = ttl
+        self.eviction_interval = eviction_interval
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._last_eviction = time.monotonic()
+
+    @staticmethod
+    def source_key(source_url: str, validator: str) -> str:
+        parts = urlsplit(source_url)
+        query = sorted(
+            (name, value)
+            for name, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not is_signature_parameter(name)
+        )
+        source = f"{parts.scheme}://{parts.netloc}{parts.path}?{urlencode(query)}|{validator}"
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    def _content_path(self, digest: str) -> str:
+        return f"{self.prefix}/sha256/{digest}"
+
+    def _source_path(self, source_url: str, validator: str) -> str:
+        return f"{self.prefix}/sources/{self.source_key(source_url, validator)}"
+
+    def _is_expired(self, blob: storage.Blob) -> bool:
+        last_used = blob.custom_time or blob.time_created
+        return last_used is None or datetime.now(timezone.utc) - last_used > self.ttl
+
+    def _touch(self, blob: storage.Blob) -> None:
+        blob.custom_time = datetime.now(timezone.utc)
+        blob.patch()
+
+    def _count(self, hit: bool) -> None:
+        record_cache_lookup("input", hit)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def lookup(self, source_url: str, validator: Optional[str]) -> Optional[str]:
+        """
+        Returns the digest of the payload last downloaded from `source_url` with the same validator, if it is still
+        in the store. Every call counts as a hit or a miss.
+        """
+        digest = None
+        try:
+            if validator:
+                index_blob = self.bucket.get_blob(self._source_path(source_url, validator))
+                if index_blob is not None and not self._is_expired(index_blob):
+                    indexed_digest = (index_blob.metadata or {}).get("sha256")
+                    content_blob = self.bucket.get_blob(self._content_path(indexed_digest)) if indexed_digest else None
+                    if content_blob is not None and not self._is_expired(content_blob):
+                        digest = indexed_digest
+                        self._touch(index_blob)
+        except Exception as e:  # NOSONAR
+            # The cache is an optimisation; a failing lookup falls back to downloading
+            logger.error(f"Input cache lookup failed: {e}")
+
+        self._count(digest is not None)
+        return digest
+
+    def materialize(self, digest: str, upload_path: str) -> str:
+        """Copies the stored payload to `upload_path` server-side and refreshes its TTL."""
+        content_blob = self.bucket.blob(self._content_path(digest))
+        self.bucket.copy_blob(content_blob, self.bucket, upload_path)
+        self._touch(content_blob)
+        logger.info(f"Input cache hit: copied {digest} to {upload_path}")
+        return upload_path
+
+    def store(self, upload_path: str, digest: str, source_url: str, validator: Optional[str]) -> None:
+        """
+        Records a freshly downloaded payload, already uploaded to `upload_path`, under its digest and indexes the
+        source it came from.
+        """
+        try:
+            content_blob = self.bucket.get_blob(self._content_path(digest))
+            if content_blob is None:
+                content_blob = self.bucket.copy_blob(
+                    self.bucket.blob(upload_path), self.bucket, self._content_path(digest)
+                )
+            self._touch(content_blob)
+
+            if validator:
+                index_blob = self.bucket.blob(self._source_path(source_url, validator))
+                index_blob.metadata = {"sha256": digest}
+                index_blob.custom_time = datetime.now(timezone.utc)
+                index_blob.upload_from_string(digest, content_type="text/plain")
+        except Exception as e:  # NOSONAR
+            logger.error(f"Failed to store {upload_path} in the input cache: {e}")
+
+        self._maybe_evict()
+
+    def _maybe_evict(self) -> None:
+        with self._lock:
+            if time.monotonic() - self._last_eviction < self.eviction_interval:
+                return
+            self._last_eviction = time.monotonic()
+        threading.Thread(target=self.evict_expired, name="input-cache-eviction", daemon=True).start()
+
+    def evict_expired(self) -> int:
+        """Deletes every entry that has not been used within the TTL. Returns the number of deleted objects."""
+        try:
+            expired = [blob for blob in self.bucket.list_blobs(prefix=f"{self.prefix}/") if self._is_expired(blob)]
+            self.bucket.delete_blobs(expired, on_error=lambda blob: None)
+            if expired:
+                logger.info(f"Input cache evicted {len(expired)} expired entries")
+            return len(expired)
+        except Exception as e:  # NOSONAR
+            logger.error(f"Input cache eviction failed: {e}")
+            return 0
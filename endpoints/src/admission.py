@@ -0,0 +1,283 @@
+import hashlib
+import math
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from os import getenv
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from loguru import logger
+
+from cont_intel.api.utils.config_source import ConfigSource
+from cont_intel.api.utils.message_bus import get_message_bus
+from cont_intel.api.utils.metrics import ADMISSION_REJECTIONS
+
+# Requests without an API key (e.g. when the gateway is bypassed) share one set of buckets
+ANONYMOUS_KEY = "anonymous"
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """`rate` tasks per second on average, with bursts of up to `burst` tasks."""
+
+    rate: float
+    burst: float
+
+    @classmethod
+    def from_dict(cls, limit: Dict) -> "RateLimit":
+        rate = float(limit["rate"])
+        return cls(rate=rate, burst=float(limit.get("burst", max(rate, 1))))
+
+
+@dataclass(frozen=True)
+class ApiKeyConfig:
+    """The limits of one API key, and the tenant its tasks are scheduled as by the Controller."""
+
+    default: Optional[RateLimit] = None
+    task_types: Dict[str, RateLimit] = field(default_factory=dict)
+    tenant: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class AdmissionConfig:
+    """
+    Admission limits, read from JSON such as:
+
+        {
+            "max_in_flight": 2000,
+            "retry_after": 5,
+            "default": {"rate": 20, "burst": 40},
+            "task_types": {"annotation": {"rate": 50, "burst": 100}},
+            "api_keys": {
+                "<key>": {"tenant": "acme", "default": {"rate": 5}, "task_types": {"training": {"rate": 0.1}}}
+            }
+        }
+
+    Every API key has its own bucket per task type. Its limit is the first one set of: the key's limit for the task
+    type, the key's default, the task type's limit and the default. Without any, the key is not rate limited.
+    `max_in_flight` caps the tasks in flight (see `AdmissionController`), and `retry_after` is the Retry-After, in
+    seconds, of requests rejected because that budget is used up. `tenant` names the key in the tasks it initiates.
+    """
+
+    default: Optional[RateLimit] = None
+    task_types: Dict[str, RateLimit] = field(default_factory=dict)
+    api_keys: Dict[str, ApiKeyConfig] = field(default_factory=dict)
+    max_in_flight: Optional[int] = None
+    retry_after: float = 5
+
+    @classmethod
+    def from_dict(cls, config: Dict) -> "AdmissionConfig":
+        def limits(by_task_type: Optional[Dict]) -> Dict[str, RateLimit]:
+            return {task_type.lower(): RateLimit.from_dict(limit) for task_type, limit in (by_task_type or {}).items()}
+
+        def optional_limit(limit: Optional[Dict]) -> Optional[RateLimit]:
+            return RateLimit.from_dict(limit) if limit is not None else None
+
+        max_in_flight = config.get("max_in_flight")
+        return cls(
+            default=optional_limit(config.get("default")),
+            task_types=limits(config.get("task_types")),
+            api_keys={
+                api_key: ApiKeyConfig(
+                    default=optional_limit(key_config.get("default")),
+                    task_types=limits(key_config.get("task_types")),
+                    tenant=key_config.get("tenant"),
+                )
+                for api_key, key_config in (config.get("api_keys") or {}).items()
+            },
+            max_in_flight=int(max_in_flight) if max_in_flight is not None else None,
+            retry_after=float(config.get("retry_after", 5)),
+        )
+
+    def limit_for(self, api_key: str, task_type: str) -> Optional[RateLimit]:
+        key_config = self.api_keys.get(api_key) or ApiKeyConfig()
+        return (
+            key_config.task_types.get(task_type) or key_config.default or self.task_types.get(task_type) or self.default
+        )
+
+    def tenant_for(self, api_key: Optional[str]) -> str:
+        """
+        The tenant of `api_key`: the one configured for it, or else one derived from the key, which is not put in
+        messages and logs as it is.
+        """
+        if not api_key:
+            return ANONYMOUS_KEY
+        key_config = self.api_keys.get(api_key)
+        if key_config is not None and key_config.tenant:
+            return key_config.tenant
+        return "key-" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+class TokenBucket:
+    """
+    Holds up to `limit.burst` tokens and gains `limit.rate` tokens per second. A request is admitted while the bucket
+    holds at least one token and takes one token per task, which can leave the bucket in debt: a batch is admitted
+    whole, and the key then waits until the debt is paid off.
+    """
+
+    def __init__(self, limit: RateLimit):
+        self.limit = limit
+        self.tokens = limit.burst
+        self.updated = time.monotonic()
+
+    def set_limit(self, limit: RateLimit) -> None:
+        self.limit = limit
+        self.tokens = min(self.tokens, limit.burst)
+
+    def take(self, tasks: int) -> float:
+        """Takes tokens for `tasks` tasks and returns 0, or returns the seconds until a request can be admitted."""
+        now = time.monotonic()
+        self.tokens = min(self.limit.burst, self.tokens + (now - self.updated) * self.limit.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= tasks
+            return 0
+        return (1 - self.tokens) / self.limit.rate if self.limit.rate > 0 else math.inf
+
+
+class BacklogMonitor:
+    """
+    Polls Cloud Monitoring every `interval` seconds for the number of undelivered messages of Pub/Sub
+    `subscriptions`, so the admission check reads a cached number instead of calling an API per request. Pub/Sub
+    reports the metric about once a minute.
+    """
+
+    def __init__(self, project_id: str, subscriptions: List[str], interval: float = 30):
+        self.project_id = project_id
+        self.subscriptions = subscriptions
+        self.interval = interval
+        self.backlog = 0
+        threading.Thread(target=self._run, name="backlog-monitor", daemon=True).start()
+
+    def _run(self) -> None:
+        # Imported here: only instances that watch a backlog need the Monitoring client
+        from google.cloud import monitoring_v3
+
+        client = monitoring_v3.MetricServiceClient()
+        subscription_ids = ", ".join(f'"{subscription}"' for subscription in self.subscriptions)
+        metric_filter = (
+            'metric.type = "pubsub.googleapis.com/subscription/num_undelivered_messages" AND '
+            f"resource.labels.subscription_id = one_of({subscription_ids})"
+        )
+        while True:
+            try:
+                now = int(time.time())
+                series = client.list_time_series(
+                    request={
+                        "name": f"projects/{self.project_id}",
+                        "filter": metric_filter,
+                        "interval": {"start_time": {"seconds": now - 300}, "end_time": {"seconds": now}},
+                        "view": monitoring_v3.ListTimeSeriesRequest.TimeSeriesView.FULL,
+                    }
+                )
+                # Points are returned newest first
+                self.backlog = sum(
+                    time_series.points[0].value.int64_value for time_series in series if time_series.points
+                )
+            except Exception as e:  # NOSONAR
+                logger.error(f"Failed to read the Pub/Sub backlog: {e}")
+            time.sleep(self.interval)
+
+
+class AdmissionController:
+    """
+    Decides whether Endpoints accepts a request before it publishes anything, and rejects it with 429 and
+    Retry-After when:
+    - the tasks in flight would exceed `max_in_flight`: the tasks this instance is publishing, plus `load()`, such as
+      the tasks the monolith's message bus is carrying or the backlog of the downstream subscriptions, or
+    - the token bucket of the request's API key and task type is empty.
+
+    Buckets and counters are only used from the event loop, so they need no locks.
+    """
+
+    def __init__(self, config_source: ConfigSource[AdmissionConfig], load: Optional[Callable[[], int]] = None):
+        self.config_source = config_source
+        self.load = load
+        self.in_flight = 0
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+    @classmethod
+    def from_env(cls, project_id: str) -> "AdmissionController":
+        """
+        Configured from the environment:
+        - ADMISSION_CONFIG: path or gs:// URL of the JSON config (see `AdmissionConfig`). Without it nothing is limited.
+        - ADMISSION_CONFIG_REFRESH: seconds between reloads of the config (default 30)
+        - ADMISSION_BACKLOG_SUBSCRIPTIONS: comma-separated Pub/Sub subscriptions whose backlog counts as in flight
+          (e.g. the controller_start subscription); requires google-cloud-monitoring. Outside monolith mode
+          `max_in_flight` has no effect without it, and a warning is logged the first time it is checked.
+        """
+        config_source = ConfigSource(
+            getenv("ADMISSION_CONFIG"),
+            AdmissionConfig.from_dict,
+            AdmissionConfig(),
+            refresh_interval=float(getenv("ADMISSION_CONFIG_REFRESH", "30")),
+        )
+        subscriptions = [name for name in getenv("ADMISSION_BACKLOG_SUBSCRIPTIONS", "").split(",") if name]
+        backlog_monitor = BacklogMonitor(project_id, subscriptions) if subscriptions else None
+
+        warned = False
+
+        def load() -> int:
+            nonlocal warned
+            tracked = get_message_bus().in_flight_tasks()
+            if tracked is None and backlog_monitor is None and not warned:
+                # Only called when max_in_flight is set. Outside monolith mode the bus does not track tasks, so without
+                # a backlog the budget only covers the few milliseconds this instance spends publishing.
+                warned = True
+                logger.warning(
+                    "max_in_flight is configured but nothing downstream is counted; set "
+                    "ADMISSION_BACKLOG_SUBSCRIPTIONS (e.g. the controller_start subscription) to enforce it"
+                )
+            return (tracked or 0) + (backlog_monitor.backlog if backlog_monitor else 0)
+
+        return cls(config_source, load)
+
+    def _bucket(self, api_key: str, task_type: str, limit: RateLimit) -> TokenBucket:
+        bucket = self._buckets.get((api_key, task_type))
+        if bucket is None:
+            bucket = self._buckets[(api_key, task_type)] = TokenBucket(limit)
+        elif bucket.limit != limit:
+            bucket.set_limit(limit)
+        return bucket
+
+    def check(self, api_key: Optional[str], task_type: str, tasks: int = 1) -> Optional[Tuple[str, float]]:
+        """Admits `tasks` tasks and returns None, or returns why they are rejected and the seconds to retry after."""
+        config = self.config_source.get()
+        api_key = api_key or ANONYMOUS_KEY
+
+        if config.max_in_flight is not None:
+            in_flight = self.in_flight + (self.load() if self.load is not None else 0)
+            # When nothing is in flight a request is admitted even if it is larger than the budget, so it can run
+            if in_flight + tasks > config.max_in_flight and in_flight > 0:
+                return "saturated", config.retry_after
+
+        limit = config.limit_for(api_key, task_type)
+        if limit is not None:
+            wait = self._bucket(api_key, task_type, limit).take(tasks)
+            if wait > 0:
+                return "rate_limited", min(wait, 3600)
+        return None
+
+    @contextmanager
+    def admit(self, api_key: Optional[str], task_type: str, tasks: int = 1) -> Iterator[str]:
+        """
+        Admits `tasks` tasks of `task_type` for the duration of the block, which gets the tenant of `api_key`, or
+        raises a 429 HTTPException with Retry-After.
+        """
+        rejection = self.check(api_key, task_type, tasks)
+        if rejection is not None:
+            reason, retry_after = rejection
+            ADMISSION_REJECTIONS.labels(task_type=task_type, reason=reason).inc()
+            detail = "Too many requests for this API key" if reason == "rate_limited" else "The service is saturated"
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"{detail}, retry later",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+        self.in_flight += tasks
+        try:
+            yield self.config_source.get().tenant_for(api_key)
+        finally:
+            self.in_flight -= tasks
@@ -2,14 +2,18 @@ from fastapi import FastAPI, HTTPException
 from fastapi.responses import PlainTextResponse
 from loguru import logger
 
+from cont_intel.api.endpoints.src.admission import AdmissionController
+from cont_intel.api.endpoints.src.api_handler import APIHandler
 from cont_intel.api.endpoints.src.routes import (
     AnnotationRoutes,
     InferenceRoutes,
     TrainingRoutes,
 )
-from cont_intel.api.utils.api_utils import handle_error
+from cont_intel.api.utils.api_utils import flush_clients, handle_error
+from cont_intel.api.utils.metrics import instrument_app
 
 app = FastAPI()
+instrument_app(app, "endpoints")
 
 # Include routers for different routes (inference, training, annotation)
 @app.on_event("startup")
@@ -18,13 +22,27 @@ async def startup_event():
     Event triggered on startup to configure routes.
     """
     try:
-        app.include_router(InferenceRoutes().inference_routes, prefix="/inference", tags=["inference"])
-        app.include_router(TrainingRoutes().training_routes, prefix="/training", tags=["training"])
-        app.include_router(AnnotationRoutes().annotation_routes, prefix="/annotation", tags=["annotation"])
+        api_handler = APIHandler()
+        admission = AdmissionController.from_env(api_handler.project_id)
+        app.include_router(
+            InferenceRoutes(api_handler, admission).inference_routes, prefix="/inference", tags=["inference"]
+        )
+        app.include_router(
+            TrainingRoutes(api_handler, admission).training_routes, prefix="/training", tags=["training"]
+        )
+        app.include_router(
+            AnnotationRoutes(api_handler, admission).annotation_routes, prefix="/annotation", tags=["annotation"]
+        )
     except Exception as e:
         logger.exception("Error occurred during startup event")
         handle_error(None, e, 500)
 
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """Flush pending Pub/Sub batches and log entries before the instance is stopped."""
+    flush_clients()
+
 @app.get("/", response_class=PlainTextResponse)
 def read_root():
     """
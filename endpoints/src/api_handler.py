@@ -1,39 +1,59 @@
+import asyncio
+import functools
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from typing import Callable, Dict, List, Optional, Type
+
 from loguru import logger
+from pydantic import BaseModel, ValidationError
+
 import cont_intel.api.endpoints.src.schemas as schemas
-from cont_intel.api.endpoints.src.shallow_validation import validate_request
-from cont_intel.api.utils.api_utils import get_bucket_name, get_project, publish_message, write_log
+from cont_intel.api.endpoints.src.shallow_validation import collect_request_errors, validate_request
+from cont_intel.api.utils.api_utils import (
+    get_bucket_name,
+    get_project,
+    publish_pubsub_message,
+    publish_pubsub_message_async,
+    write_log,
+)
 from cont_intel.api.utils.data_classes import PubSubMessage, TaskType
 from cont_intel.api.utils.api_utils import handle_error
+from cont_intel.api.utils.topics import Topic
+from cont_intel.api.utils.tracing import enter_stage, finish_stage, start_trace
 
 
 class APIHandler:
     """
     Handler to execute internal API logic for initiating different types of tasks.
+
+    The initiate_* methods block on Pub/Sub and error reporting calls; async routes run them through `run_blocking`,
+    which uses a thread pool of ENDPOINTS_MAX_WORKERS threads so they never hold up the event loop.
     """
 
     def __init__(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(getenv("ENDPOINTS_MAX_WORKERS", "32")), thread_name_prefix="endpoints-io"
+        )
         try:
             self.project_id = get_project()
             self.bucket_name = get_bucket_name(self.project_id)
         except Exception as e:
             logger.exception("Error occurred during APIHandler initialization")
             handle_error(None, e, 500)
-            
 
-    def initiate_inference(self, request: schemas.InferenceRequest, task_id: str):
+    async def run_blocking(self, func: Callable, *args):
+        """Runs `func(*args)` on the handler's bounded thread pool and returns its result."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(func, *args))
+
+    def initiate_inference(self, request: schemas.InferenceRequest, task_id: str, tenant: Optional[str] = None):
         """
         Initiates inference request and sends it to the controller.
         """
         try:
             validate_request(request)
-            task_type = self._get_task_type(request.explainability, TaskType.INFERENCE, TaskType.INFERENCE_EXPLAINABILITY)
-            
-            controller_request = self._create_pubsub_message(
-                task_id=task_id,
-                task_type=task_type,
-                request=request
-            )
-            
+            controller_request = self.build_inference_message(request, task_id, tenant)
+
             logger.info(f"Initiating inference with request: {controller_request}")
             self._create_pubsub_for_controller(controller_request)
         except Exception as e:
@@ -41,19 +61,13 @@ class APIHandler:
             handle_error(request, e, 500)
             
 
-    def initiate_training(self, request: schemas.TrainRequest, task_id: str):
+    def initiate_training(self, request: schemas.TrainRequest, task_id: str, tenant: Optional[str] = None):
         """
         Initiates training request and sends it to the controller.
         """
         try:
             validate_request(request)
-            task_type = self._get_task_type(request.explainability, TaskType.TRAINING, TaskType.TRAINING_EXPLAINABILITY)
-
-            controller_request = self._create_pubsub_message(
-                task_id=task_id,
-                task_type=task_type,
-                request=request
-            )
+            controller_request = self.build_training_message(request, task_id, tenant)
 
             logger.info(f"Initiating training with request: {controller_request}")
             self._create_pubsub_for_controller(controller_request)
@@ -62,21 +76,12 @@ class APIHandler:
             handle_error(request, e, 500)
             
 
-    def initiate_annotation(self, request: schemas.AnnotationRequest, task_id: str):
+    def initiate_annotation(self, request: schemas.AnnotationRequest, task_id: str, tenant: Optional[str] = None):
         """
         Initiates annotation request and sends it to the controller.
         """
         try:
-            controller_request = PubSubMessage(
-                task_id=task_id,
-                project_id=self.project_id,
-                task_type=str(TaskType.ANNOTATION.value),
-                signed_file_url=request.signed_file_url,
-                output_url=request.output_url,
-                model_id=None,
-                dataset_reference=None,
-                bucket_name=self.bucket_name,
-            )
+            controller_request = self.build_annotation_message(request, task_id, tenant)
 
             logger.info(f"Initiating annotation with request: {controller_request}")
             self._create_pubsub_for_controller(controller_request)
@@ -84,49 +89,160 @@ class APIHandler:
             logger.exception("Error occurred while initiating annotation")
             handle_error(request, e, 500)
 
+    def build_inference_message(
+        self, request: schemas.InferenceRequest, task_id: str, tenant: Optional[str] = None
+    ) -> PubSubMessage:
+        task_type = self._get_task_type(request.explainability, TaskType.INFERENCE, TaskType.INFERENCE_EXPLAINABILITY)
+        return self._create_pubsub_message(task_id=task_id, task_type=task_type, request=request, tenant=tenant)
+
+    def build_training_message(
+        self, request: schemas.TrainRequest, task_id: str, tenant: Optional[str] = None
+    ) -> PubSubMessage:
+        task_type = self._get_task_type(request.explainability, TaskType.TRAINING, TaskType.TRAINING_EXPLAINABILITY)
+        return self._create_pubsub_message(task_id=task_id, task_type=task_type, request=request, tenant=tenant)
+
+    def build_annotation_message(
+        self, request: schemas.AnnotationRequest, task_id: str, tenant: Optional[str] = None
+    ) -> PubSubMessage:
+        pubsub_message = PubSubMessage(
+            task_id=task_id,
+            project_id=self.project_id,
+            task_type=str(TaskType.ANNOTATION.value),
+            signed_file_url=request.signed_file_url,
+            output_url=request.output_url,
+            model_id=None,
+            dataset_reference=None,
+            bucket_name=self.bucket_name,
+            bypass_cache=request.bypass_cache,
+            tenant=tenant,
+        )
+        return self._traced(pubsub_message)
+
+    @staticmethod
+    def _traced(pubsub_message: PubSubMessage) -> PubSubMessage:
+        """Starts the trace of a new task; the Endpoints stage lasts until the message is published."""
+        start_trace(pubsub_message)
+        enter_stage(pubsub_message, "endpoints")
+        return pubsub_message
+
+    async def initiate_batch(
+        self,
+        items: List[Dict],
+        request_schema: Type[BaseModel],
+        build_message: Callable[[BaseModel, str, Optional[str]], PubSubMessage],
+        tenant: Optional[str] = None,
+    ) -> schemas.BatchResponse:
+        """
+        Validates every item of a batch on its own, assigns a task_id to each valid one and publishes them to the
+        controller together. Items that fail validation, message building or publishing are rejected without
+        affecting the others.
+        """
+        results: List[schemas.BatchItemResult] = []
+        controller_requests: List[PubSubMessage] = []
+        for index, item in enumerate(items):
+            try:
+                request = request_schema.parse_obj(item)
+            except ValidationError as e:
+                errors = [f"{'.'.join(str(loc) for loc in error['loc'])}: {error['msg']}" for error in e.errors()]
+                results.append(schemas.BatchItemResult(index=index, status="rejected", errors=errors))
+                continue
+
+            errors = collect_request_errors(request)
+            if errors:
+                results.append(schemas.BatchItemResult(index=index, status="rejected", errors=errors))
+                continue
+
+            try:
+                controller_request = build_message(request, uuid.uuid4().hex, tenant)
+            except Exception as e:
+                logger.exception(f"Error occurred while building the message for batch item {index}")
+                results.append(
+                    schemas.BatchItemResult(index=index, status="rejected", errors=[f"Failed to build task: {e}"])
+                )
+                continue
+            controller_requests.append(controller_request)
+            results.append(
+                schemas.BatchItemResult(index=index, status="accepted", task_id=controller_request.task_id)
+            )
+
+        if controller_requests:
+            for controller_request in controller_requests:
+                finish_stage(controller_request)
+            write_log(
+                "api",
+                {
+                    "message": "Batch API request in Endpoints, start Controller",
+                    "task_ids": [controller_request.task_id for controller_request in controller_requests],
+                },
+            )
+            # The publisher batches messages published together, so the whole batch goes out in a few requests
+            publish_results = await asyncio.gather(
+                *(
+                    publish_pubsub_message_async(Topic.CONTROLLER_START, controller_request)
+                    for controller_request in controller_requests
+                ),
+                return_exceptions=True,
+            )
+            failures = {
+                controller_request.task_id: str(result)
+                for controller_request, result in zip(controller_requests, publish_results)
+                if isinstance(result, Exception)
+            }
+            for result in results:
+                if result.task_id in failures:
+                    logger.error(f"Error while publishing message to controller: {failures[result.task_id]}")
+                    result.status, result.errors = "rejected", [f"Failed to submit task: {failures[result.task_id]}"]
+                    result.task_id = None
+
+        accepted = sum(result.status == "accepted" for result in results)
+        logger.info(f"Batch of {len(items)} requests: {accepted} accepted, {len(items) - accepted} rejected")
+        return schemas.BatchResponse(accepted=accepted, rejected=len(items) - accepted, results=results)
+
     def _get_task_type(self, explainability: list, default_task_type: TaskType, explainability_task_type: TaskType) -> str:
         """
         Determines the appropriate task type based on whether explainability is enabled.
         """
-        try:
-            return str(explainability_task_type if len(explainability) > 0 else default_task_type)
-        except Exception as e:
-            logger.exception("Error occurred while determining task type")
-            handle_error(None, e, 500)
+        return (explainability_task_type if len(explainability) > 0 else default_task_type).value
 
-    def _create_pubsub_message(self, task_id: str, task_type: str, request: schemas.InferenceRequest | schemas.TrainRequest) -> PubSubMessage:
+    def _create_pubsub_message(
+        self,
+        task_id: str,
+        task_type: str,
+        request: schemas.InferenceRequest | schemas.TrainRequest,
+        tenant: Optional[str] = None,
+    ) -> PubSubMessage:
         """
-        Creates a PubSubMessage from the provided request details.
+        Creates a PubSubMessage from the provided request details. Errors are raised to the caller, which reports
+        them for its request (initiate_*) or rejects just that item (initiate_batch).
         """
-        try:
-            return PubSubMessage(
-                task_id=task_id,
-                project_id=self.project_id,
-                task_type=task_type,
-                signed_file_url=request.signed_file_url,
-                output_url=request.output_url,
-                model_id=request.model_id if hasattr(request, 'model_id') else None,
-                dataset_reference=request.dataset_reference if hasattr(request, 'dataset_reference') else None,
-                bucket_name=self.bucket_name,
-                input_data_type=request.input_data_type,
-                csv_data_config=request.csv_data_config if hasattr(request, 'csv_data_config') else None,
-                explainability=request.explainability if hasattr(request, 'explainability') else None,
-            )
-        except Exception as e:
-            logger.exception("Error occurred while creating PubSub message")
-            handle_error(None, e, 500)
+        pubsub_message = PubSubMessage(
+            task_id=task_id,
+            project_id=self.project_id,
+            task_type=task_type,
+            signed_file_url=request.signed_file_url,
+            output_url=request.output_url,
+            model_id=request.model_id if hasattr(request, 'model_id') else None,
+            dataset_reference=request.dataset_reference if hasattr(request, 'dataset_reference') else None,
+            bucket_name=self.bucket_name,
+            input_data_type=request.input_data_type,
+            csv_data_config=request.csv_data_config if hasattr(request, 'csv_data_config') else None,
+            explainability=request.explainability if hasattr(request, 'explainability') else None,
+            tenant=tenant,
+        )
+        return self._traced(pubsub_message)
 
     def _create_pubsub_for_controller(self, pubsub_request: PubSubMessage):
         """
         Creates a PubSub message for the controller and publishes it.
         """
         try:
+            finish_stage(pubsub_request)
             json_payload = {
                 "message": "API request in Endpoints, start Controller",
                 "pipe_request": pubsub_request.to_json(),
             }
             write_log("api", json_payload)
-            publish_message(pubsub_request.project_id, "controller_start", pubsub_request.to_json())
+            publish_pubsub_message(Topic.CONTROLLER_START, pubsub_request).result()
             logger.info(f"PubSub message sent to controller: {pubsub_request}")
         except Exception as e:
             logger.error(f"Error while publishing message to controller: {e}")
@@ -1,85 +1,164 @@
 import uuid
-from fastapi import APIRouter, status
+from os import getenv
+from typing import Callable, Optional, Type
+
+from fastapi import APIRouter, Header, HTTPException, status
 from loguru import logger
+from pydantic import BaseModel
 
 import cont_intel.api.endpoints.src.schemas as schemas
+from cont_intel.api.endpoints.src.admission import AdmissionController
 from cont_intel.api.endpoints.src.api_handler import APIHandler
 from cont_intel.api.utils.api_utils import handle_error
+from cont_intel.api.utils.data_classes import PubSubMessage
+
+MAX_BATCH_SIZE = int(getenv("ENDPOINTS_MAX_BATCH_SIZE", "1000"))
+
+
+def add_batch_route(
+    router: APIRouter,
+    api_handler: APIHandler,
+    admission: AdmissionController,
+    request_schema: Type[BaseModel],
+    build_message: Callable[[BaseModel, str, Optional[str]], PubSubMessage],
+    task_type: str,
+    name: str,
+):
+    """
+    Adds the POST /initiate_batch route, which initiates a list of `request_schema` requests in one call and reports
+    per item whether it was accepted (with its task_id) or rejected (with the reasons). A batch is admitted or
+    rejected as a whole, and counts as one task per request.
+    """
+    @router.post(
+        "/initiate_batch", status_code=status.HTTP_201_CREATED, response_model=schemas.BatchResponse, name=name
+    )
+    async def initiate_batch(
+        batch: schemas.BatchRequest, x_api_key: Optional[str] = Header(None)
+    ) -> schemas.BatchResponse:
+        if len(batch.requests) > MAX_BATCH_SIZE:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"At most {MAX_BATCH_SIZE} requests can be initiated per batch",
+            )
+        with admission.admit(x_api_key, task_type, len(batch.requests)) as tenant:
+            return await api_handler.initiate_batch(batch.requests, request_schema, build_message, tenant)
 
 
 class InferenceRoutes:
     """
     Inference-specific routes for initiating an inference task.
     """
-    def __init__(self, api_handler: APIHandler):
+    def __init__(self, api_handler: APIHandler, admission: AdmissionController):
         self.inference_routes = APIRouter()
         self.api_handler = api_handler
+        self.admission = admission
         self._init_routes()
 
     def _init_routes(self):
         """
-        Initializes the POST route for initiating an inference task.
+        Initializes the POST routes for initiating one or a batch of inference tasks.
         """
         @self.inference_routes.post(
             "/initiate", status_code=status.HTTP_201_CREATED, response_model=schemas.InferenceRequest
         )
-        async def initiate_inference(request: schemas.InferenceRequest) -> schemas.InferenceRequest:
+        async def initiate_inference(
+            request: schemas.InferenceRequest, x_api_key: Optional[str] = Header(None)
+        ) -> schemas.InferenceRequest:
             task_id = uuid.uuid4().hex
-            try:
-                self.api_handler.initiate_inference(request, task_id)
-                return request
-            except Exception as e:
-                logger.exception("Error occurred while initiating inference")
-                handle_error(request, e, 500)
+            with self.admission.admit(x_api_key, "inference") as tenant:
+                try:
+                    await self.api_handler.run_blocking(self.api_handler.initiate_inference, request, task_id, tenant)
+                    return request
+                except Exception as e:
+                    logger.exception("Error occurred while initiating inference")
+                    handle_error(request, e, 500)
+
+        add_batch_route(
+            self.inference_routes,
+            self.api_handler,
+            self.admission,
+            schemas.InferenceRequest,
+            self.api_handler.build_inference_message,
+            "inference",
+            "initiate_inference_batch",
+        )
 
 
 class TrainingRoutes:
     """
     Training-specific routes for initiating a training task.
     """
-    def __init__(self, api_handler: APIHandler):
+    def __init__(self, api_handler: APIHandler, admission: AdmissionController):
         self.training_routes = APIRouter()
         self.api_handler = api_handler
+        self.admission = admission
         self._init_routes()
 
     def _init_routes(self):
         """
-        Initializes the POST route for initiating a training task.
+        Initializes the POST routes for initiating one or a batch of training tasks.
         """
         @self.training_routes.post(
             "/initiate", status_code=status.HTTP_201_CREATED, response_model=schemas.TrainRequest
         )
-        async def initiate_training(request: schemas.TrainRequest) -> schemas.TrainRequest:
+        async def initiate_training(
+            request: schemas.TrainRequest, x_api_key: Optional[str] = Header(None)
+        ) -> schemas.TrainRequest:
             task_id = uuid.uuid4().hex
-            try:
-                self.api_handler.initiate_training(request, task_id)
-                return request
-            except Exception as e:
-                logger.exception("Error occurred while initiating training")
-                handle_error(request, e, 500)
+            with self.admission.admit(x_api_key, "training") as tenant:
+                try:
+                    await self.api_handler.run_blocking(self.api_handler.initiate_training, request, task_id, tenant)
+                    return request
+                except Exception as e:
+                    logger.exception("Error occurred while initiating training")
+                    handle_error(request, e, 500)
+
+        add_batch_route(
+            self.training_routes,
+            self.api_handler,
+            self.admission,
+            schemas.TrainRequest,
+            self.api_handler.build_training_message,
+            "training",
+            "initiate_training_batch",
+        )
 
 
 class AnnotationRoutes:
     """
     Annotation-specific routes for initiating an annotation task.
     """
-    def __init__(self, api_handler: APIHandler):
+    def __init__(self, api_handler: APIHandler, admission: AdmissionController):
         self.annotation_routes = APIRouter()
         self.api_handler = api_handler
+        self.admission = admission
         self._init_routes()
 
     def _init_routes(self):
         """
-        Initializes the POST route for initiating an annotation task.
+        Initializes the POST routes for initiating one or a batch of annotation tasks.
         """
         @self.annotation_routes.post(
             "/initiate", status_code=status.HTTP_201_CREATED, response_model=schemas.AnnotationRequest
         )
-        async def initiate_annotation(request: schemas.AnnotationRequest) -> schemas.AnnotationRequest:
+        async def initiate_annotation(
+            request: schemas.AnnotationRequest, x_api_key: Optional[str] = Header(None)
+        ) -> schemas.AnnotationRequest:
             task_id = uuid.uuid4().hex
-            try:
-                self.api_handler.initiate_annotation(request, task_id)
-                return request
-            except Exception as e:
-                logger.exception("Error occurred while initiating annotation")
-                handle_error(request, e, 500)
+            with self.admission.admit(x_api_key, "annotation") as tenant:
+                try:
+                    await self.api_handler.run_blocking(self.api_handler.initiate_annotation, request, task_id, tenant)
+                    return request
+                except Exception as e:
+                    logger.exception("Error occurred while initiating annotation")
+                    handle_error(request, e, 500)
+
+        add_batch_route(
+            self.annotation_routes,
+            self.api_handler,
+            self.admission,
+            schemas.AnnotationRequest,
+            self.api_handler.build_annotation_message,
+            "annotation",
+            "initiate_annotation_batch",
+        )
@@ -1,4 +1,4 @@
-from typing import List, Optional, Dict
+from typing import Any, List, Optional, Dict
 
 from pydantic import BaseModel, constr, Field
 
@@ -6,6 +6,7 @@ from pydantic import BaseModel, constr, Field
 class AnnotationRequest(BaseModel):
     signed_file_url: constr(regex=r"^https?://[^\s/$.?#].[^\s]*$")  # Ensure the URL is valid
     output_url: constr(regex=r"^https?://[^\s/$.?#].[^\s]*$")  # Ensure the URL is valid
+    bypass_cache: bool = False  # Recompute annotations even if a similar image was annotated recently
 
     class Config:
         orm_mode = True
@@ -40,3 +41,21 @@ class TrainRequest(BaseModel):
         orm_mode = True
         min_anystr_length = 1  # Ensure all string fields are non-empty
         anystr_strip_whitespace = True  # Strip whitespaces in string fields
+
+
+class BatchRequest(BaseModel):
+    # Items are validated one by one, so an invalid item is rejected on its own instead of failing the whole batch
+    requests: List[Dict[str, Any]] = Field(..., min_items=1, description="Task requests to initiate")
+
+
+class BatchItemResult(BaseModel):
+    index: int  # Position of the item in the submitted batch
+    status: str  # "accepted" or "rejected"
+    task_id: Optional[str] = None
+    errors: Optional[List[str]] = None
+
+
+class BatchResponse(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[BatchItemResult]
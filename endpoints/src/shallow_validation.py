@@ -1,5 +1,5 @@
 from fastapi import HTTPException
-from typing import Union
+from typing import List, Union
 from loguru import logger
 
 import cont_intel.api.endpoints.src.schemas as schemas
@@ -26,5 +26,22 @@ def validate_dataset(request: Union[schemas.InferenceRequest, schemas.TrainReque
     :raises HTTPException: If dataset reference is invalid
     """
     dataset = request.dataset_reference
-    if not dataset or dataset.strip() == "":
+    if not is_valid_dataset(dataset):
         handle_error(request, Exception(f"Invalid dataset reference: '{dataset}' provided."), 400)
+
+
+def is_valid_dataset(dataset: str) -> bool:
+    return bool(dataset) and dataset.strip() != ""
+
+
+def collect_request_errors(request) -> List[str]:
+    """
+    Runs the same checks as validate_request but returns the failures instead of reporting them, so batch items can
+    be accepted or rejected one by one.
+    :param request: The request object (InferenceRequest, TrainRequest or AnnotationRequest)
+    :return: The validation failures, empty if the request is valid
+    """
+    errors = []
+    if hasattr(request, "dataset_reference") and not is_valid_dataset(request.dataset_reference):
+        errors.append(f"Invalid dataset reference: '{request.dataset_reference}' provided.")
+    return errors
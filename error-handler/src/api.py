@@ -1,18 +1,27 @@
-import requests
 from os import getenv
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import PlainTextResponse
 from loguru import logger
 from typing import Dict
 
-from cont_intel.api.utils.api_utils import write_log
+from cont_intel.api.utils.api_utils import flush_clients, publish_task_end, write_log
 from cont_intel.api.utils.data_classes import PubSubMessage
+from cont_intel.api.utils.metrics import instrument_app
+from cont_intel.api.utils.webhook import close_webhook_client, get_webhook_client
 
 app = FastAPI()
+instrument_app(app, "error-handler")
 
 SERVICE_NAME = getenv("K_SERVICE")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close pooled webhook connections and flush pending log entries before the instance is stopped."""
+    await close_webhook_client()
+    flush_clients()
+
+
 @app.post("/", response_class=PlainTextResponse)
 async def read_root(request: Request):
     try:
@@ -23,22 +32,23 @@ async def read_root(request: Request):
         # Parse the PubSubMessage
         pubsub_message_data = PubSubMessage.from_request(request_json)
 
+        # The task has failed; the Controller can start another in its place
+        await publish_task_end(pubsub_message_data)
+
         output_url = pubsub_message_data.output_url
         error_message = pubsub_message_data.error_message
 
         # Construct response object
         response_obj = {"status": "Error", "data": {"Reason": error_message}}
-        headers = {"Content-Type": "application/json"}
 
         # Log the response being posted
         write_log("api", {"message": f"Posting response to {output_url}", "response": response_obj})
 
         # Send the error response to the output URL
         try:
-            response = requests.post(output_url, headers=headers, json=response_obj)
-            response.raise_for_status()  # Raise an exception for HTTP errors
+            await get_webhook_client().post_json(output_url, response_obj, task_id=pubsub_message_data.task_id)
             write_log("api", {"message": "Error response posted successfully"})
-        except requests.exceptions.RequestException as e:
+        except Exception as e:
             logger.error(f"Failed to post error response: {e}")
             write_log("api", {"message": f"Failed to post error response: {e}"})
             raise HTTPException(status_code=500, detail="Failed to send error response")
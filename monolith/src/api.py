@@ -0,0 +1,64 @@
+import importlib
+from os import getenv
+
+from fastapi.responses import JSONResponse
+from loguru import logger
+
+from cont_intel.api.controller.src.api import scheduler as controller_scheduler
+from cont_intel.api.endpoints.src.api import app
+from cont_intel.api.utils.api_utils import flush_clients
+from cont_intel.api.utils.message_bus import InMemoryBus, Route, set_message_bus
+from cont_intel.api.utils.topics import subscriptions_for
+from cont_intel.api.utils.webhook import close_webhook_client
+
+# Serves the Endpoints API and runs the annotation tier's stages in the same process. The topics these services
+# subscribe to are delivered in-process; other topics (e.g. pipeline_start for inference and training) still go
+# through Pub/Sub to the distributed services.
+SERVICES = ("controller", "downloader", "annotator", "output", "error-handler")
+
+
+def build_message_bus() -> InMemoryBus:
+    """
+    Configured from the environment:
+    - MONOLITH_QUEUE_SIZE: capacity of each topic's queue (default 100)
+    - MONOLITH_WORKERS: workers per topic (default 4), overridden per topic by MONOLITH_WORKERS_<TOPIC>, e.g.
+      MONOLITH_WORKERS_ANNOTATOR_START=16
+    """
+    default_workers = int(getenv("MONOLITH_WORKERS", "4"))
+    routes = [
+        Route(
+            topic=topic,
+            path=subscription.path,
+            app=importlib.import_module(f"cont_intel.api.{subscription.service}.src.api").app,
+            workers=int(getenv(f"MONOLITH_WORKERS_{topic.value.upper()}", str(default_workers))),
+        )
+        for topic, subscription in subscriptions_for(SERVICES).items()
+    ]
+    return InMemoryBus(routes, queue_size=int(getenv("MONOLITH_QUEUE_SIZE", "100")))
+
+
+message_bus = build_message_bus()
+
+
+@app.on_event("startup")
+async def start_message_bus():
+    await message_bus.start()
+    set_message_bus(message_bus)
+
+
+@app.on_event("shutdown")
+async def stop_message_bus():
+    """Finish the queued work, then close the clients the stages share."""
+    # The Controller's own shutdown hook does not run here: its waiting tasks are dispatched before the bus drains
+    await controller_scheduler.dispatch_all()
+    await message_bus.stop(timeout=float(getenv("MONOLITH_DRAIN_TIMEOUT", "30")))
+    set_message_bus(None)
+    await close_webhook_client()
+    flush_clients()
+    logger.info("In-process stages stopped")
+
+
+@app.get("/monolith/stats")
+def monolith_stats():
+    """Queue depths, handled message counts and end-to-end task latency percentiles."""
+    return JSONResponse(message_bus.stats())
@@ -2,15 +2,25 @@ from datetime import timedelta
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import PlainTextResponse
 from loguru import logger
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
-import requests
-
-from cont_intel.api.utils.api_utils import handle_error, write_log
+from cont_intel.api.utils.api_utils import flush_clients, handle_error, publish_task_end, write_log
+from cont_intel.api.utils.claim_check import resolve_results_async
 from cont_intel.api.utils.data_classes import PubSubMessage
-from cont_intel.utils.gcp_utils import make_signed_download_url
+from cont_intel.api.utils.metrics import instrument_app
+from cont_intel.api.utils.signing import get_url_signer
+from cont_intel.api.utils.tracing import enter_stage, finish_trace, timing_breakdown, traced
+from cont_intel.api.utils.webhook import close_webhook_client, get_webhook_client
 
 app = FastAPI()
+instrument_app(app, "output")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close pooled webhook connections and flush pending Pub/Sub batches and log entries before the instance stops."""
+    await close_webhook_client()
+    flush_clients()
 
 
 @app.post("/", response_class=PlainTextResponse)
@@ -21,11 +31,12 @@ async def read_root(request: Request):
         logger.info("Output received a request")
 
         pubsub_message_data = PubSubMessage.from_request(request_json)
+        enter_stage(pubsub_message_data, "output")
 
         logger.info(f"PubSubMessage data extracted: {pubsub_message_data}")
 
         output_url = pubsub_message_data.output_url
-        results = pubsub_message_data.results
+        results = await resolve_results_async(pubsub_message_data)
 
         # Process inference or training results
         if "inference" in results:
@@ -42,36 +53,39 @@ async def read_root(request: Request):
             raise HTTPException(status_code=400, detail="Unexpected output")
 
         # Send the response to the output URL
-        send_output(output_url, response_obj)
+        with traced(pubsub_message_data, "output.webhook"):
+            await send_output(output_url, response_obj, pubsub_message_data.task_id)
+        await complete_task(pubsub_message_data)
 
     except Exception as e:
         handle_error(request_json, e, 204)
 
 
-async def process_inference(inference_results: Dict) -> Dict:
-    bucket_name = inference_results["bucket_name"]
-    signed_url_predictions = make_signed_download_url(
-        bucket_name, inference_results["predictions"], exp=timedelta(hours=12)
+async def sign_result_urls(bucket_name: str, results: Dict, keys: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Signs the result objects named under `keys` in `results` concurrently. Keys that are missing or empty map to None.
+    """
+    present_keys = [key for key in keys if results.get(key)]
+    urls = await get_url_signer().sign_many_async(
+        [(bucket_name, results[key]) for key in present_keys], exp=timedelta(hours=12)
     )
+    signed_urls = dict.fromkeys(keys)
+    signed_urls.update(zip(present_keys, urls))
+    return signed_urls
 
-    signed_url_metrics = None
-    if inference_results.get("metrics"):
-        signed_url_metrics = make_signed_download_url(
-            bucket_name, inference_results["metrics"], exp=timedelta(hours=12)
-        )
 
-    signed_url_explanations = None
-    if inference_results.get("explanations"):
-        signed_url_explanations = make_signed_download_url(
-            bucket_name, inference_results["explanations"], exp=timedelta(hours=12)
-        )
+async def process_inference(inference_results: Dict) -> Dict:
+    bucket_name = inference_results["bucket_name"]
+    if not inference_results.get("predictions"):
+        raise ValueError("Inference results contain no predictions")
+    signed_urls = await sign_result_urls(bucket_name, inference_results, ["predictions", "metrics", "explanations"])
 
     response_obj = {
         "status": "success",
         "data": {
-            "predictions": signed_url_predictions,
-            "metrics": signed_url_metrics,
-            "explanations": signed_url_explanations,
+            "predictions": signed_urls["predictions"],
+            "metrics": signed_urls["metrics"],
+            "explanations": signed_urls["explanations"],
         },
     }
 
@@ -81,17 +95,13 @@ async def process_inference(inference_results: Dict) -> Dict:
 
 async def process_training(training_results: Dict) -> Dict:
     bucket_name = training_results["bucket_name"]
-    signed_url_explanations = None
-    if training_results.get("explanations"):
-        signed_url_explanations = make_signed_download_url(
-            bucket_name, training_results["explanations"], exp=timedelta(hours=12)
-        )
+    signed_urls = await sign_result_urls(bucket_name, training_results, ["explanations"])
 
     response_obj = {
         "status": "success",
         "data": {
             "model_id": training_results["model_id"],
-            "explanations": signed_url_explanations,
+            "explanations": signed_urls["explanations"],
         },
     }
 
@@ -107,8 +117,9 @@ async def read_root_annotator_end(request: Request):
         logger.info(f"Output received a request: {request_json}")
 
         pubsub_message_data = PubSubMessage.from_request(request_json)
+        enter_stage(pubsub_message_data, "output")
         output_url = pubsub_message_data.output_url
-        results = pubsub_message_data.results
+        results = await resolve_results_async(pubsub_message_data)
 
         if "annotation" in results:
             response_obj = {
@@ -120,20 +131,27 @@ async def read_root_annotator_end(request: Request):
             write_log("api", {"message": "Error: unexpected output"})
             raise HTTPException(status_code=400, detail="Unexpected output")
 
-        send_output(output_url, response_obj)
+        with traced(pubsub_message_data, "output.webhook"):
+            await send_output(output_url, response_obj, pubsub_message_data.task_id)
+        await complete_task(pubsub_message_data)
         return PlainTextResponse("Processed successfully", status_code=200)
 
     except Exception as e:
         handle_error(request_json, e, 204)
 
 
-def send_output(output_url: str, response_obj: Dict):
-    headers = {"content-type": "application/json"}
+async def send_output(output_url: str, response_obj: Dict, task_id: str):
+    """Delivers the response to the client's output URL, raising if it could not be delivered after retries."""
     write_log("api", {"message": f"Posting response: {response_obj}"})
-    
-    try:
-        response = requests.post(output_url, headers=headers, json=response_obj)
-        response.raise_for_status()  # Ensure HTTP errors are raised
-        write_log("api", {"message": "Output sent successfully"})
-    except requests.exceptions.RequestException as e:
-         handle_error(request_json, e, 500)
+    await get_webhook_client().post_json(output_url, response_obj, task_id=task_id)
+    write_log("api", {"message": "Output sent successfully"})
+
+
+async def complete_task(pubsub_message_data: PubSubMessage):
+    """Tells the Controller the task is done, then ends its trace and logs how long it spent in each stage."""
+    await publish_task_end(pubsub_message_data)
+    finish_trace(pubsub_message_data)
+    timing = timing_breakdown(pubsub_message_data)
+    if timing:
+        logger.info(f"Task {pubsub_message_data.task_id} completed in {timing['total_ms']} ms")
+        write_log("api", {"message": "Task timing", "timing": timing})
@@ -1,23 +1,85 @@
-import json
+import asyncio
+import base64
 import os
+from functools import lru_cache
 from typing import Dict, Optional
 
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import PlainTextResponse
 from loguru import logger
 
+from cont_intel.api.pipeline.src.utils.idempotency import AuditWriter, IdempotencyStore, idempotency_store_from_env
+from cont_intel.api.pipeline.src.utils.vertex_supervisor import (
+    JobRecordStore,
+    VertexJobSupervisor,
+    extract_pipeline_results,
+)
 from cont_intel.api.utils.api_utils import (
+    flush_clients,
+    get_bucket_name,
+    get_project,
     handle_error,
-    publish_message,
+    publish_pubsub_message_async,
     update_results_with_sampled_predictions,
     write_log,
 )
+from cont_intel.api.utils.claim_check import attach_results_async
 from cont_intel.api.utils.data_classes import PubSubMessage
-from cont_intel.api.vertex.vertex_pred import get_job
-from cont_intel.utils.gcp_utils import message_id_stored_in_bq, store_message_id_to_bq
-from cont_intel.wrapper import main_new as wrapper_main_new
+from cont_intel.api.utils.metrics import instrument_app
+from cont_intel.api.utils.topics import Topic
+from cont_intel.api.utils.tracing import enter_stage, finish_stage, start_span, traced
 
 app = FastAPI()
+instrument_app(app, "pipeline")
+
+# Supervises Vertex jobs submitted in async mode (VERTEX_JOB_MODE=async) until they complete
+vertex_supervisor = VertexJobSupervisor(
+    poll_interval=float(os.getenv("VERTEX_POLL_INTERVAL", "30")),
+    max_poll_interval=float(os.getenv("VERTEX_MAX_POLL_INTERVAL", "300")),
+    max_concurrent_jobs=int(os.getenv("VERTEX_MAX_CONCURRENT_JOBS", "50")),
+)
+_background_tasks = set()
+
+
+def async_vertex_jobs() -> bool:
+    return (
+        os.getenv("USE_VERTEX", "false").lower() == "true"
+        and os.getenv("VERTEX_JOB_MODE", "async").lower() == "async"
+    )
+
+
+@app.on_event("startup")
+async def resume_vertex_jobs():
+    """
+    Records the supervised Vertex jobs in GCS and adopts the recorded jobs of instances that are gone, at startup and
+    then every VERTEX_RESUME_INTERVAL seconds (default 300). Configured from the environment:
+    - VERTEX_JOB_BUCKET: bucket of the records (default the project's input bucket)
+    - VERTEX_JOB_PREFIX: object prefix of the records (default vertex_jobs/pipeline)
+    A record is adopted once it has not been refreshed for three times VERTEX_MAX_POLL_INTERVAL.
+    """
+    if not async_vertex_jobs():
+        return
+    vertex_supervisor.records = JobRecordStore(
+        os.getenv("VERTEX_JOB_BUCKET", get_bucket_name(get_project())),
+        os.getenv("VERTEX_JOB_PREFIX", "vertex_jobs/pipeline"),
+        stale_after=3 * vertex_supervisor.max_poll_interval,
+    )
+    task = asyncio.create_task(
+        vertex_supervisor.run_resumer(
+            load_pipeline_job,
+            publish_pipeline_results,
+            report_vertex_failure,
+            interval=float(os.getenv("VERTEX_RESUME_INTERVAL", "300")),
+        )
+    )
+    _background_tasks.add(task)
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """Flush pending Pub/Sub batches and log entries before the instance is stopped."""
+    flush_clients()
+
 
 def extract_custom_args_from_pub_sub_message(pubsub_message_data: PubSubMessage) -> str:
     """
@@ -52,20 +114,37 @@ def extract_custom_args_from_pub_sub_message(pubsub_message_data: PubSubMessage)
     return custom_args
 
 
+@lru_cache(maxsize=None)
+def get_idempotency_store(project_id: str) -> IdempotencyStore:
+    return idempotency_store_from_env(os.getenv("IDEMPOTENCY_BUCKET", get_bucket_name(project_id)))
+
+
+@lru_cache(maxsize=None)
+def get_audit_writer(project_id: str) -> AuditWriter:
+    """BigQuery record of processed messages, written in background batches."""
+    from cont_intel.utils.gcp_utils import store_message_id_to_bq
+
+    return AuditWriter(
+        project_id,
+        table=os.getenv("BQ_AUDIT_TABLE"),
+        store_row=lambda message_id: store_message_id_to_bq(message_id, project_id=project_id),
+    )
+
+
 def msg_already_processed(request_json: dict, project_id: str) -> bool:
     """
     Checks if the message has already been processed based on the message_id.
+    The check atomically claims the message id, so of two concurrent redeliveries only one is processed.
     """
     try:
         message_id = int(request_json["message"]["message_id"])
         logger.info(f"Checking whether the message {message_id} has already been processed...")
-        
-        already_processed = message_id_stored_in_bq(message_id, project_id=project_id)
-        if already_processed:
+
+        if not get_idempotency_store(project_id).claim(str(message_id)):
             logger.warning(f"Skipping message {message_id} as it was already processed.")
             return True
 
-        store_message_id_to_bq(message_id, project_id=project_id)
+        get_audit_writer(project_id).record(message_id)
         return False
     except Exception as e:
         logger.error(f"Error checking message processing status: {e}")
@@ -73,6 +152,30 @@ def msg_already_processed(request_json: dict, project_id: str) -> bool:
         return False
 
 
+async def publish_pipeline_results(pubsub_message_data: PubSubMessage, results: dict) -> None:
+    """Attaches the pipeline results to the message and publishes it to "pipeline_end"."""
+    # Update results with sampled predictions; large results are stored in the task folder and passed by reference
+    await attach_results_async(pubsub_message_data, update_results_with_sampled_predictions(results))
+    finish_stage(pubsub_message_data)
+    write_log("api", {"message": "Pipeline ended", "pipe_request": pubsub_message_data.to_json()})
+
+    logger.info("Publishing message indicating pipeline completion")
+    await publish_pubsub_message_async(Topic.PIPELINE_END, pubsub_message_data)
+
+
+def load_pipeline_job(resource_name: str):
+    from google.cloud import aiplatform
+
+    return aiplatform.PipelineJob.get(resource_name)
+
+
+async def report_vertex_failure(pubsub_message_data: PubSubMessage, error: Exception) -> None:
+    """Reports a task whose Vertex job failed after its push was acknowledged."""
+    data, attributes = pubsub_message_data.encode()
+    request_json = {"message": {"data": base64.b64encode(data).decode("ascii"), "attributes": attributes}}
+    handle_error(request_json, error, 204)
+
+
 @app.post("/", response_class=PlainTextResponse)
 async def read_root(request: Request):
     request_json = await request.json()
@@ -80,6 +183,7 @@ async def read_root(request: Request):
     try:
         logger.info(f"Pipeline received a request: {request_json}")
         pubsub_message_data = PubSubMessage.from_request(request_json)
+        enter_stage(pubsub_message_data, "pipeline")
         logger.info(f"PubSubMessage created: {pubsub_message_data}")
 
         if msg_already_processed(request_json, project_id=pubsub_message_data.project_id):
@@ -91,30 +195,46 @@ async def read_root(request: Request):
         # Start main pipeline process
         custom_args = extract_custom_args_from_pub_sub_message(pubsub_message_data)
         use_vertex = os.getenv("USE_VERTEX", "false").lower() == "true"
-        
-        if use_vertex:
-            logger.info("Running pipeline using Vertex AI")
-            pipeline_job = get_job(custom_args, project_id=pubsub_message_data.project_id)
-            pipeline_job.submit()
-            pipeline_job.wait()
-            task_details = pipeline_job.to_dict().get("jobDetail", {}).get("taskDetails", [])
-            pipeline_results = next(
-                (task["execution"]["metadata"]["output:Output"] for task in task_details if "output:Output" in task["execution"]["metadata"]),
-                None
+
+        if async_vertex_jobs():
+            logger.info("Submitting pipeline to Vertex AI")
+
+            from cont_intel.api.vertex.vertex_pred import get_job
+
+            # Closed by publish_pipeline_results once the supervisor sees the job complete
+            start_span(pubsub_message_data, "pipeline.vertex_job")
+            resource_name = await vertex_supervisor.submit(
+                lambda: get_job(custom_args, project_id=pubsub_message_data.project_id),
+                pubsub_message_data,
+                on_success=publish_pipeline_results,
+                on_failure=report_vertex_failure,
             )
-            if pipeline_results is None:
-                raise ValueError("No pipeline results found.")
-            results = json.loads(pipeline_results)
-        else:
-            logger.info("Running pipeline using Cloud Run")
-            results = wrapper_main_new.main(custom_args, project_id=pubsub_message_data.project_id)
+            write_log(
+                "api",
+                {
+                    "message": "Vertex pipeline job submitted",
+                    "task_id": pubsub_message_data.task_id,
+                    "job": resource_name,
+                },
+            )
+            return PlainTextResponse("Pipeline job submitted", status_code=200)
+
+        with traced(pubsub_message_data, "pipeline.run"):
+            if use_vertex:
+                logger.info("Running pipeline using Vertex AI")
+                from cont_intel.api.vertex.vertex_pred import get_job
 
-        # Update results with sampled predictions and log results
-        pubsub_message_data.results = update_results_with_sampled_predictions(results)
-        write_log("api", {"message": "Pipeline ended", "pipe_request": pubsub_message_data.to_json()})
+                pipeline_job = get_job(custom_args, project_id=pubsub_message_data.project_id)
+                pipeline_job.submit()
+                pipeline_job.wait()
+                results = extract_pipeline_results(pipeline_job)
+            else:
+                logger.info("Running pipeline using Cloud Run")
+                from cont_intel.wrapper import main_new as wrapper_main_new
 
-        logger.info("Publishing message indicating pipeline completion")
-        publish_message(pubsub_message_data.project_id, "pipeline_end", pubsub_message_data.to_json())
+                results = wrapper_main_new.main(custom_args, project_id=pubsub_message_data.project_id)
+
+        await publish_pipeline_results(pubsub_message_data, results)
 
         return PlainTextResponse("Pipeline completed successfully", status_code=200)
 
@@ -123,3 +243,8 @@ async def read_root(request: Request):
         handle_error(request_json, e, 204)
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
+
+@app.get("/jobs")
+async def read_jobs() -> Dict[str, str]:
+    """Vertex jobs this instance is currently supervising, by task_id."""
+    return vertex_supervisor.jobs
@@ -0,0 +1,204 @@
+import hashlib
+import math
+import queue
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timezone
+from os import getenv
+from typing import Callable, List, Optional
+
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud import bigquery, storage
+from loguru import logger
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings. No false negatives; false positives at about `error_rate`."""
+
+    def __init__(self, capacity: int = 1_000_000, error_rate: float = 0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.sha256(key.encode("utf-8")).digest()
+        first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:16], "big")
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position // 8] & (1 << (position % 8)) for position in self._positions(key))
+
+
+class ClaimBackend(ABC):
+    """Durable store of claimed message ids."""
+
+    @abstractmethod
+    def claim(self, message_id: str) -> bool:
+        """Atomically records `message_id`. Returns True only for the first caller to claim it."""
+
+
+class GCSClaimBackend(ClaimBackend):
+    """
+    Claims are empty objects created with `if_generation_match=0`, which GCS only lets succeed if the object does not
+    exist yet, so concurrent redeliveries cannot both win. They are deleted by a lifecycle rule on the bucket, set by
+    the pipeline's deploy (pipeline/cloudbuild.yaml), once they are older than Pub/Sub can redeliver a message.
+    """
+
+    def __init__(self, bucket_name: str, prefix: str = "idempotency/pipeline"):
+        self.bucket = storage.Client().bucket(bucket_name)
+        self.prefix = prefix.strip("/")
+
+    def claim(self, message_id: str) -> bool:
+        try:
+            self.bucket.blob(f"{self.prefix}/{message_id}").upload_from_string("", if_generation_match=0)
+            return True
+        except PreconditionFailed:
+            return False
+
+
+class SQLiteClaimBackend(ClaimBackend):
+    """Local stand-in for the durable backend, for tests and single-instance runs."""
+
+    def __init__(self, path: str = ":memory:"):
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS claims (message_id TEXT PRIMARY KEY, claimed_at TEXT NOT NULL)"
+        )
+        self._lock = threading.Lock()
+
+    def claim(self, message_id: str) -> bool:
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO claims (message_id, claimed_at) VALUES (?, ?)",
+                (message_id, datetime.now(timezone.utc).isoformat()),
+            )
+            return cursor.rowcount == 1
+
+
+class IdempotencyStore:
+    """
+    Decides whether a message is being seen for the first time.
+
+    Ids this instance has already claimed are answered in memory: the Bloom filter rejects unseen ids without taking
+    a lock, and the LRU confirms recent ones. Everything else goes to the backend's atomic claim, which is the
+    source of truth across instances. So only duplicates are answered in memory: every first delivery, which is the
+    common case, still waits for one claim write (a GCS object insert with the GCS backend, tens of milliseconds).
+    """
+
+    def __init__(self, backend: ClaimBackend, lru_size: int = 100_000, bloom_capacity: int = 1_000_000):
+        self.backend = backend
+        self.lru_size = lru_size
+        self._bloom = BloomFilter(bloom_capacity)
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _seen_locally(self, message_id: str) -> bool:
+        if message_id not in self._bloom:
+            return False
+        with self._lock:
+            if message_id in self._recent:
+                self._recent.move_to_end(message_id)
+                return True
+        return False
+
+    def _remember(self, message_id: str) -> None:
+        self._bloom.add(message_id)
+        with self._lock:
+            self._recent[message_id] = None
+            if len(self._recent) > self.lru_size:
+                self._recent.popitem(last=False)
+
+    def claim(self, message_id: str) -> bool:
+        """Returns True if the caller should process the message, False if it is a duplicate."""
+        if self._seen_locally(message_id):
+            return False
+        claimed = self.backend.claim(message_id)
+        self._remember(message_id)
+        return claimed
+
+
+class AuditWriter:
+    """
+    Writes processed message ids to BigQuery in batches from a background thread. The writes are for auditing only
+    and never delay the request.
+
+    If `table` is set, rows are streamed to it with `insert_rows_json`; otherwise every id is passed to `store_row`.
+    """
+
+    def __init__(
+        self,
+        project_id: str,
+        table: Optional[str] = None,
+        store_row: Optional[Callable[[int], None]] = None,
+        batch_size: int = 500,
+        flush_interval: float = 5.0,
+    ):
+        self.project_id = project_id
+        self.table = table
+        self.store_row = store_row
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._client: Optional[bigquery.Client] = None
+        self._queue: "queue.Queue[int]" = queue.Queue(maxsize=100_000)
+        self._thread = threading.Thread(target=self._run, name="bq-audit-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, message_id: int) -> None:
+        try:
+            self._queue.put_nowait(message_id)
+        except queue.Full:
+            logger.warning(f"Audit queue full, message id {message_id} is not recorded in BigQuery")
+
+    def _run(self) -> None:
+        while True:
+            batch: List[int] = [self._queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+            self._write(batch)
+
+    def _write(self, batch: List[int]) -> None:
+        try:
+            if self.table:
+                rows = [{"message_id": message_id} for message_id in batch]
+                if self._client is None:
+                    self._client = bigquery.Client(project=self.project_id)
+                errors = self._client.insert_rows_json(self.table, rows)
+                if errors:
+                    logger.error(f"Failed to write {len(errors)} audit rows to {self.table}: {errors}")
+            else:
+                for message_id in batch:
+                    self.store_row(message_id)
+        except Exception as e:  # NOSONAR
+            logger.error(f"Failed to write {len(batch)} audit rows: {e}")
+
+
+def idempotency_store_from_env(bucket_name: str) -> IdempotencyStore:
+    """
+    Builds the idempotency store configured by the environment:
+    - IDEMPOTENCY_BACKEND: "gcs" (default) or "sqlite"
+    - IDEMPOTENCY_PREFIX: object prefix of the claims in `bucket_name` (default idempotency/pipeline)
+    - IDEMPOTENCY_SQLITE_PATH: database file of the sqlite backend (default in-memory)
+    - IDEMPOTENCY_LRU_SIZE, IDEMPOTENCY_BLOOM_CAPACITY
+    """
+    backend_name = getenv("IDEMPOTENCY_BACKEND", "gcs").lower()
+    if backend_name == "gcs":
+        backend = GCSClaimBackend(bucket_name, getenv("IDEMPOTENCY_PREFIX", "idempotency/pipeline"))
+    elif backend_name == "sqlite":
+        backend = SQLiteClaimBackend(getenv("IDEMPOTENCY_SQLITE_PATH", ":memory:"))
+    else:
+        raise ValueError(f"Unknown idempotency backend {backend_name}")
+
+    return IdempotencyStore(
+        backend,
+        lru_size=int(getenv("IDEMPOTENCY_LRU_SIZE", "100000")),
+        bloom_capacity=int(getenv("IDEMPOTENCY_BLOOM_CAPACITY", "1000000")),
+    )
@@ -0,0 +1,237 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google.cloud import storage
+from loguru import logger
+
+from cont_intel.api.utils.data_classes import PubSubMessage, decode_json, encode_json
+
+
+def extract_pipeline_results(pipeline_job) -> dict:
+    """Reads the `output:Output` execution metadata written by the pipeline's output task."""
+    task_details = pipeline_job.to_dict().get("jobDetail", {}).get("taskDetails", [])
+    pipeline_results = next(
+        (
+            task["execution"]["metadata"]["output:Output"]
+            for task in task_details
+            if "output:Output" in task.get("execution", {}).get("metadata", {})
+        ),
+        None,
+    )
+    if pipeline_results is None:
+        raise ValueError("No pipeline results found.")
+    return json.loads(pipeline_results)
+
+
+class JobRecordStore:
+    """
+    Durable record of the Vertex jobs being supervised: one object per task under `prefix` in the bucket, holding the
+    job's resource name and the message it was submitted for, so supervision survives the instance.
+
+    The supervising instance refreshes the record's metadata every time it polls the job. A record that has not been
+    refreshed for `stale_after` seconds belongs to an instance that is gone, and the next instance that scans the
+    records adopts it. Adopting rewrites the record with a generation precondition, so only one instance wins it, and
+    the refreshes of a previous owner that is still alive fail from then on, so it stops supervising the job.
+    """
+
+    def __init__(self, bucket_name: str, prefix: str = "vertex_jobs/pipeline", stale_after: float = 900):
+        self.bucket = storage.Client().bucket(bucket_name)
+        self.prefix = prefix.strip("/")
+        self.stale_after = stale_after
+
+    def _name(self, task_id: str) -> str:
+        return f"{self.prefix}/{task_id}.json"
+
+    def save(self, resource_name: str, pubsub_message: PubSubMessage) -> int:
+        """Records the job of `pubsub_message`'s task. Returns the record's generation."""
+        blob = self.bucket.blob(self._name(pubsub_message.task_id))
+        record = {"resource_name": resource_name, "message": pubsub_message.to_dict()}
+        blob.upload_from_string(encode_json(record), content_type="application/json")
+        return blob.generation
+
+    def refresh(self, task_id: str, generation: int) -> bool:
+        """Marks the record as supervised. Returns False if another instance has adopted it."""
+        blob = self.bucket.blob(self._name(task_id))
+        blob.metadata = {"refreshed_at": datetime.now(timezone.utc).isoformat()}
+        try:
+            blob.patch(if_generation_match=generation)
+            return True
+        except (NotFound, PreconditionFailed):
+            return False
+
+    def delete(self, task_id: str, generation: int) -> None:
+        try:
+            self.bucket.blob(self._name(task_id)).delete(if_generation_match=generation)
+        except (NotFound, PreconditionFailed):
+            pass
+
+    def adopt_stale(self) -> List[Tuple[str, PubSubMessage, int]]:
+        """Takes over the records nobody refreshed lately. Returns their resource names, messages and generations."""
+        adopted = []
+        for blob in self.bucket.list_blobs(prefix=f"{self.prefix}/"):
+            if blob.updated is None or time.time() - blob.updated.timestamp() < self.stale_after:
+                continue
+            try:
+                data = blob.download_as_bytes(if_generation_match=blob.generation)
+                claimed = self.bucket.blob(blob.name)
+                claimed.upload_from_string(data, content_type="application/json", if_generation_match=blob.generation)
+            except (NotFound, PreconditionFailed):
+                # Finished or adopted by another instance in the meantime
+                continue
+            record = decode_json(data)
+            adopted.append((record["resource_name"], PubSubMessage.from_dict(record["message"]), claimed.generation))
+        return adopted
+
+
+class VertexJobSupervisor:
+    """
+    Runs Vertex pipeline jobs without holding the request that started them.
+
+    `submit` starts the job and returns once Vertex has accepted it; a background task then polls the job, starting
+    every `poll_interval` seconds and backing off to `max_poll_interval`, and calls `on_success` with the pipeline
+    results or `on_failure` with the error. At most `max_concurrent_jobs` jobs are supervised at once; further
+    submits wait for a slot.
+
+    With `records`, every job is recorded until its callback has run, and `resume` adopts the jobs whose instance
+    stopped supervising them (see `JobRecordStore`).
+    """
+
+    def __init__(
+        self,
+        poll_interval: float = 30,
+        max_poll_interval: float = 300,
+        max_concurrent_jobs: int = 50,
+        records: Optional[JobRecordStore] = None,
+    ):
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.records = records
+        # task_id -> Vertex job resource name
+        self.jobs: Dict[str, str] = {}
+
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks = set()
+
+    def _ensure_slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent_jobs)
+        return self._slots
+
+    async def submit(
+        self,
+        create_job: Callable[[], object],
+        pubsub_message_data: PubSubMessage,
+        on_success: Callable[[PubSubMessage, dict], Awaitable[None]],
+        on_failure: Callable[[PubSubMessage, Exception], Awaitable[None]],
+    ) -> str:
+        """Creates and submits the job built by `create_job`, returns its resource name."""
+        slots = self._ensure_slots()
+        await slots.acquire()
+
+        loop = asyncio.get_running_loop()
+        try:
+            pipeline_job = await loop.run_in_executor(None, create_job)
+            await loop.run_in_executor(None, pipeline_job.submit)
+        except Exception:
+            slots.release()
+            raise
+
+        generation = None
+        if self.records is not None:
+            try:
+                generation = await loop.run_in_executor(
+                    None, self.records.save, pipeline_job.resource_name, pubsub_message_data
+                )
+            except Exception as e:  # NOSONAR
+                # Still supervised by this instance, but not resumed if it stops
+                logger.error(f"Failed to record Vertex job {pipeline_job.resource_name}: {e}")
+
+        self._start(pipeline_job, pubsub_message_data, generation, on_success, on_failure)
+        return pipeline_job.resource_name
+
+    async def resume(
+        self,
+        load_job: Callable[[str], object],
+        on_success: Callable[[PubSubMessage, dict], Awaitable[None]],
+        on_failure: Callable[[PubSubMessage, Exception], Awaitable[None]],
+    ) -> int:
+        """Adopts the recorded jobs nobody supervises and supervises them. Returns the number of adopted jobs."""
+        if self.records is None:
+            return 0
+        loop = asyncio.get_running_loop()
+        adopted = await loop.run_in_executor(None, self.records.adopt_stale)
+        for resource_name, pubsub_message_data, generation in adopted:
+            logger.info(f"Resuming supervision of Vertex job {resource_name} for task {pubsub_message_data.task_id}")
+            slots = self._ensure_slots()
+            await slots.acquire()
+            try:
+                pipeline_job = await loop.run_in_executor(None, load_job, resource_name)
+            except Exception as e:
+                slots.release()
+                await on_failure(pubsub_message_data, e)
+                await loop.run_in_executor(None, self.records.delete, pubsub_message_data.task_id, generation)
+                continue
+            self._start(pipeline_job, pubsub_message_data, generation, on_success, on_failure)
+        return len(adopted)
+
+    async def run_resumer(self, load_job, on_success, on_failure, interval: float) -> None:
+        """Calls `resume` every `interval` seconds, for as long as the instance runs."""
+        while True:
+            try:
+                await self.resume(load_job, on_success, on_failure)
+            except Exception as e:  # NOSONAR
+                logger.error(f"Failed to resume recorded Vertex jobs: {e}")
+            await asyncio.sleep(interval)
+
+    def _start(
+        self, pipeline_job, pubsub_message_data: PubSubMessage, generation: Optional[int], on_success, on_failure
+    ) -> None:
+        self.jobs[pubsub_message_data.task_id] = pipeline_job.resource_name
+        task = asyncio.create_task(
+            self._supervise(pipeline_job, pubsub_message_data, generation, on_success, on_failure)
+        )
+        # Keep a reference so the task is not garbage collected while it runs
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _supervise(
+        self, pipeline_job, pubsub_message_data: PubSubMessage, generation: Optional[int], on_success, on_failure
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        task_id = pubsub_message_data.task_id
+        # The record is kept until a callback has run, so a job whose supervision is cancelled (e.g. because the
+        # instance stops) is resumed by another instance
+        reported = False
+        try:
+            interval = self.poll_interval
+            while not await loop.run_in_executor(None, pipeline_job.done):
+                if generation is not None:
+                    if not await loop.run_in_executor(None, self.records.refresh, task_id, generation):
+                        logger.warning(f"Vertex job for task {task_id} was adopted by another instance")
+                        return
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, self.max_poll_interval)
+
+            # Reading the job state is a Vertex API call, keep it off the event loop
+            if await loop.run_in_executor(None, lambda: pipeline_job.has_failed):
+                raise RuntimeError(f"Vertex pipeline job {pipeline_job.resource_name} failed")
+            results = await loop.run_in_executor(None, extract_pipeline_results, pipeline_job)
+            await on_success(pubsub_message_data, results)
+            reported = True
+        except Exception as e:
+            logger.error(f"Vertex job for task {task_id} did not complete: {e}")
+            await on_failure(pubsub_message_data, e)
+            reported = True
+        finally:
+            self.jobs.pop(task_id, None)
+            self._slots.release()
+            if generation is not None and reported:
+                try:
+                    await loop.run_in_executor(None, self.records.delete, task_id, generation)
+                except Exception as e:  # NOSONAR
+                    logger.error(f"Failed to delete the record of the Vertex job for task {task_id}: {e}")
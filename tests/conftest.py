@@ -0,0 +1,31 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The services import each other as cont_intel.api.*: this repository is checked out as cont_intel/api, so the
+# directory above cont_intel has to be importable
+ROOT = Path(__file__).absolute().parents[3]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+
+class FakeClock:
+    """Stands in for a module's `time`, so tests move `monotonic()` forward instead of sleeping."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
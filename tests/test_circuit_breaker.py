@@ -0,0 +1,80 @@
+import pytest
+
+from cont_intel.api.utils import webhook
+from cont_intel.api.utils.webhook import CircuitBreaker
+
+
+@pytest.fixture
+def breaker(monkeypatch, clock) -> CircuitBreaker:
+    monkeypatch.setattr(webhook, "time", clock)
+    return CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+
+def open_circuit(breaker: CircuitBreaker) -> None:
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+
+def test_opens_after_consecutive_failures(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_success_resets_the_failure_count(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_lets_a_single_trial_through_after_the_reset_timeout(breaker, clock):
+    open_circuit(breaker)
+    clock.advance(29)
+    assert not breaker.allow()
+
+    clock.advance(1)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+
+def test_successful_trial_closes_the_circuit(breaker, clock):
+    open_circuit(breaker)
+    clock.advance(30)
+    assert breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_failed_trial_reopens_the_circuit(breaker, clock):
+    open_circuit(breaker)
+    clock.advance(30)
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    clock.advance(30)
+    assert breaker.allow()
+
+
+def test_lost_trial_outcome_lets_another_trial_through(breaker, clock):
+    open_circuit(breaker)
+    clock.advance(30)
+    assert breaker.allow()
+
+    clock.advance(29)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
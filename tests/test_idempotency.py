@@ -0,0 +1,76 @@
+from typing import List
+
+from cont_intel.api.pipeline.src.utils.idempotency import (
+    BloomFilter,
+    ClaimBackend,
+    IdempotencyStore,
+    SQLiteClaimBackend,
+)
+
+
+class CountingBackend(ClaimBackend):
+    """Records every id that reaches the durable backend."""
+
+    def __init__(self):
+        self.inner = SQLiteClaimBackend(":memory:")
+        self.calls: List[str] = []
+
+    def claim(self, message_id: str) -> bool:
+        self.calls.append(message_id)
+        return self.inner.claim(message_id)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    keys = [f"message-{index}" for index in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+
+
+def test_bloom_filter_false_positives_stay_near_the_error_rate():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for index in range(1000):
+        bloom.add(f"message-{index}")
+    false_positives = sum(f"other-{index}" in bloom for index in range(10000))
+    assert false_positives < 300
+
+
+def test_sqlite_backend_claims_an_id_once():
+    backend = SQLiteClaimBackend(":memory:")
+    assert backend.claim("a")
+    assert not backend.claim("a")
+    assert backend.claim("b")
+
+
+def test_first_delivery_is_claimed_and_duplicates_are_rejected():
+    store = IdempotencyStore(SQLiteClaimBackend(":memory:"), lru_size=10, bloom_capacity=100)
+    assert store.claim("a")
+    assert not store.claim("a")
+    assert store.claim("b")
+
+
+def test_recent_duplicates_are_answered_without_the_backend():
+    backend = CountingBackend()
+    store = IdempotencyStore(backend, lru_size=10, bloom_capacity=100)
+    store.claim("a")
+    for _ in range(5):
+        assert not store.claim("a")
+    assert backend.calls == ["a"]
+
+
+def test_duplicates_evicted_from_the_lru_fall_back_to_the_backend():
+    backend = CountingBackend()
+    store = IdempotencyStore(backend, lru_size=2, bloom_capacity=100)
+    for message_id in ("a", "b", "c"):
+        store.claim(message_id)
+
+    assert not store.claim("a")
+    assert backend.calls == ["a", "b", "c", "a"]
+
+
+def test_ids_claimed_by_another_instance_are_rejected():
+    backend = SQLiteClaimBackend(":memory:")
+    first, second = IdempotencyStore(backend), IdempotencyStore(backend)
+    assert first.claim("a")
+    assert not second.claim("a")
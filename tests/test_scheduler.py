@@ -0,0 +1,243 @@
+import asyncio
+from collections import Counter
+from typing import List, Optional, Tuple
+
+from cont_intel.api.controller.src import scheduler as scheduler_module
+from cont_intel.api.controller.src.scheduler import Scheduler, SchedulerConfig
+from cont_intel.api.utils.config_source import ConfigSource
+from cont_intel.api.utils.data_classes import PubSubMessage, TaskType
+from cont_intel.api.utils.topics import Topic
+
+DOWNLOAD = Topic.DOWNLOADER_START
+ANNOTATION = TaskType.ANNOTATION.value
+TRAINING = TaskType.TRAINING.value
+
+
+def message(task_id: str, task_type: str = ANNOTATION, tenant: Optional[str] = None) -> PubSubMessage:
+    return PubSubMessage(
+        project_id="project",
+        task_id=task_id,
+        signed_file_url="https://example.com/file",
+        bucket_name="bucket",
+        task_type=task_type,
+        output_url="https://example.com/output",
+        tenant=tenant,
+    )
+
+
+class Harness:
+    """A scheduler whose publishes and failure reports are recorded."""
+
+    def __init__(self, config: dict, **kwargs):
+        self.published: List[Tuple[Topic, str]] = []
+        self.failures: List[str] = []
+        self.fail_publish = False
+        source = ConfigSource(None, SchedulerConfig.from_dict, SchedulerConfig.from_dict(config))
+        self.scheduler = Scheduler(source, self._publish, self._on_failure, **kwargs)
+
+    async def _publish(self, topic: Topic, pubsub_message: PubSubMessage) -> None:
+        if self.fail_publish:
+            raise RuntimeError("publish failed")
+        self.published.append((topic, pubsub_message.task_id))
+
+    async def _on_failure(self, pubsub_message: PubSubMessage, error: Exception) -> None:
+        self.failures.append(pubsub_message.task_id)
+
+    def task_ids(self) -> List[str]:
+        return [task_id for _, task_id in self.published]
+
+
+async def settle() -> None:
+    """Lets the background dispatches run."""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_dispatches_straight_away_without_budgets():
+    async def scenario():
+        harness = Harness({})
+        for index in range(5):
+            assert await harness.scheduler.submit(message(f"task-{index}"), DOWNLOAD)
+        assert harness.task_ids() == [f"task-{index}" for index in range(5)]
+        assert harness.scheduler.in_flight("downloader") == 5
+
+    asyncio.run(scenario())
+
+
+def test_budget_holds_tasks_until_a_place_is_released():
+    async def scenario():
+        harness = Harness({"budgets": {"downloader": 1}})
+        assert await harness.scheduler.submit(message("a"), DOWNLOAD)
+        assert not await harness.scheduler.submit(message("b"), DOWNLOAD)
+        assert not await harness.scheduler.submit(message("c"), DOWNLOAD)
+        assert harness.task_ids() == ["a"]
+        assert harness.scheduler.queued("downloader") == 2
+
+        harness.scheduler.release("a", ["downloader"])
+        await settle()
+        assert harness.task_ids() == ["a", "b"]
+        assert harness.scheduler.in_flight("downloader") == 1
+
+    asyncio.run(scenario())
+
+
+def test_releasing_another_stage_frees_no_place():
+    async def scenario():
+        harness = Harness({"budgets": {"downloader": 1}})
+        await harness.scheduler.submit(message("a"), DOWNLOAD)
+        await harness.scheduler.submit(message("b"), DOWNLOAD)
+        harness.scheduler.release("a", ["annotator"])
+        await settle()
+        assert harness.task_ids() == ["a"]
+
+    asyncio.run(scenario())
+
+
+def test_higher_priority_class_goes_first():
+    async def scenario():
+        harness = Harness({"budgets": {"downloader": 1}})
+        await harness.scheduler.submit(message("running", TRAINING), DOWNLOAD)
+        await harness.scheduler.submit(message("training", TRAINING), DOWNLOAD)
+        await harness.scheduler.submit(message("annotation", ANNOTATION), DOWNLOAD)
+
+        harness.scheduler.release("running")
+        await settle()
+        assert harness.task_ids()[-1] == "annotation"
+
+    asyncio.run(scenario())
+
+
+def test_class_that_waited_too_long_is_promoted(monkeypatch, clock):
+    monkeypatch.setattr(scheduler_module, "time", clock)
+
+    async def scenario():
+        harness = Harness(
+            {
+                "budgets": {"downloader": 1},
+                "classes": {
+                    "interactive": {"priority": 1, "task_types": [ANNOTATION]},
+                    "batch": {"priority": 0, "task_types": [TRAINING], "promote_after": 60},
+                },
+            }
+        )
+        await harness.scheduler.submit(message("running"), DOWNLOAD)
+        await harness.scheduler.submit(message("training", TRAINING), DOWNLOAD)
+        clock.advance(61)
+        await harness.scheduler.submit(message("annotation"), DOWNLOAD)
+
+        harness.scheduler.release("running")
+        await settle()
+        assert harness.task_ids()[-1] == "training"
+
+    asyncio.run(scenario())
+
+
+def test_tenants_share_a_class_by_weight():
+    async def scenario():
+        harness = Harness({"budgets": {"downloader": 1}, "tenants": {"acme": 3}})
+        await harness.scheduler.submit(message("running"), DOWNLOAD)
+        for index in range(8):
+            await harness.scheduler.submit(message(f"acme-{index}", tenant="acme"), DOWNLOAD)
+            await harness.scheduler.submit(message(f"bob-{index}", tenant="bob"), DOWNLOAD)
+
+        for _ in range(8):
+            harness.scheduler.release(harness.task_ids()[-1])
+            await settle()
+        shares = Counter(task_id.split("-")[0] for task_id in harness.task_ids()[1:])
+        assert shares == {"acme": 6, "bob": 2}
+
+    asyncio.run(scenario())
+
+
+def test_expired_lease_frees_its_place(monkeypatch, clock):
+    monkeypatch.setattr(scheduler_module, "time", clock)
+
+    async def scenario():
+        harness = Harness({"budgets": {"downloader": 1}, "leases": {"downloader": 10}}, tick=0.01)
+        await harness.scheduler.submit(message("a"), DOWNLOAD)
+        await harness.scheduler.submit(message("b"), DOWNLOAD)
+        await asyncio.sleep(0.05)
+        assert harness.task_ids() == ["a"]
+
+        clock.advance(11)
+        await asyncio.sleep(0.05)
+        assert harness.task_ids() == ["a", "b"]
+
+    asyncio.run(scenario())
+
+
+def test_duplicate_of_a_dispatched_task_is_not_dispatched_again():
+    async def scenario():
+        harness = Harness({})
+        assert await harness.scheduler.submit(message("a"), DOWNLOAD)
+        assert await harness.scheduler.submit(message("a"), DOWNLOAD)
+        assert harness.task_ids() == ["a"]
+
+    asyncio.run(scenario())
+
+
+def test_redelivered_task_waits_and_is_dispatched_once():
+    async def scenario():
+        harness = Harness({"budgets": {"downloader": 1}})
+        await harness.scheduler.submit(message("a"), DOWNLOAD)
+        assert not await harness.scheduler.submit(message("b"), DOWNLOAD, redelivered=True)
+        # Redelivered while it waits: still not dispatched, so the push stays unacknowledged
+        assert not await harness.scheduler.submit(message("b"), DOWNLOAD, redelivered=True)
+
+        harness.scheduler.release("a")
+        await settle()
+        assert harness.task_ids() == ["a", "b"]
+
+        # The redelivery after its dispatch is acknowledged, even once its place is released
+        harness.scheduler.release("b")
+        assert await harness.scheduler.submit(message("b"), DOWNLOAD, redelivered=True)
+        assert harness.task_ids() == ["a", "b"]
+
+    asyncio.run(scenario())
+
+
+def test_failed_dispatch_of_a_redelivered_task_is_left_to_redelivery():
+    async def scenario():
+        harness = Harness({"budgets": {"downloader": 1}})
+        await harness.scheduler.submit(message("a"), DOWNLOAD)
+        await harness.scheduler.submit(message("b"), DOWNLOAD, redelivered=True)
+
+        harness.fail_publish = True
+        harness.scheduler.release("a")
+        await settle()
+        assert harness.failures == []
+        assert harness.scheduler.in_flight("downloader") == 0
+
+        harness.fail_publish = False
+        assert await harness.scheduler.submit(message("b"), DOWNLOAD, redelivered=True)
+        assert harness.task_ids() == ["a", "b"]
+
+    asyncio.run(scenario())
+
+
+def test_failed_dispatch_of_an_acknowledged_task_is_reported():
+    async def scenario():
+        harness = Harness({"budgets": {"downloader": 1}})
+        await harness.scheduler.submit(message("a"), DOWNLOAD)
+        await harness.scheduler.submit(message("b"), DOWNLOAD)
+
+        harness.fail_publish = True
+        harness.scheduler.release("a")
+        await settle()
+        assert harness.failures == ["b"]
+
+    asyncio.run(scenario())
+
+
+def test_shutdown_dispatches_only_tasks_that_are_not_redelivered():
+    async def scenario():
+        harness = Harness({"budgets": {"downloader": 1}})
+        await harness.scheduler.submit(message("a"), DOWNLOAD)
+        await harness.scheduler.submit(message("acknowledged"), DOWNLOAD)
+        await harness.scheduler.submit(message("redelivered"), DOWNLOAD, redelivered=True)
+
+        await harness.scheduler.dispatch_all()
+        assert harness.task_ids() == ["a", "acknowledged"]
+        assert harness.scheduler.queued("downloader") == 0
+
+    asyncio.run(scenario())
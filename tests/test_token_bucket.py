@@ -0,0 +1,71 @@
+import math
+
+import pytest
+
+from cont_intel.api.endpoints.src import admission
+from cont_intel.api.endpoints.src.admission import RateLimit, TokenBucket
+
+
+@pytest.fixture(autouse=True)
+def fake_clock(monkeypatch, clock):
+    monkeypatch.setattr(admission, "time", clock)
+
+
+def test_rate_limit_burst_defaults_to_the_rate():
+    assert RateLimit.from_dict({"rate": 20}) == RateLimit(rate=20, burst=20)
+    assert RateLimit.from_dict({"rate": 0.1}) == RateLimit(rate=0.1, burst=1)
+    assert RateLimit.from_dict({"rate": 5, "burst": 50}) == RateLimit(rate=5, burst=50)
+
+
+def test_admits_a_burst_then_waits_for_a_token():
+    bucket = TokenBucket(RateLimit(rate=2, burst=3))
+    assert [bucket.take(1) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(1) == pytest.approx(0.5)
+
+
+def test_refills_at_the_rate_up_to_the_burst(clock):
+    bucket = TokenBucket(RateLimit(rate=2, burst=3))
+    for _ in range(3):
+        bucket.take(1)
+
+    clock.advance(0.5)
+    assert bucket.take(1) == 0
+    assert bucket.take(1) == pytest.approx(0.5)
+
+    clock.advance(60)
+    assert [bucket.take(1) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(1) > 0
+
+
+def test_batch_is_admitted_whole_and_leaves_the_bucket_in_debt(clock):
+    bucket = TokenBucket(RateLimit(rate=2, burst=3))
+    assert bucket.take(10) == 0
+    # 3 - 10 = -7 tokens: 8 tokens short of the next request, at 2 tokens per second
+    assert bucket.take(1) == pytest.approx(4)
+
+    clock.advance(4)
+    assert bucket.take(1) == 0
+
+
+def test_zero_rate_never_refills(clock):
+    bucket = TokenBucket(RateLimit(rate=0, burst=1))
+    assert bucket.take(1) == 0
+    clock.advance(3600)
+    assert bucket.take(1) == math.inf
+
+
+def test_lowering_the_limit_caps_the_tokens():
+    bucket = TokenBucket(RateLimit(rate=10, burst=10))
+    bucket.set_limit(RateLimit(rate=1, burst=2))
+    assert [bucket.take(1) for _ in range(2)] == [0, 0]
+    assert bucket.take(1) == pytest.approx(1)
+
+
+def test_raising_the_limit_keeps_the_tokens(clock):
+    bucket = TokenBucket(RateLimit(rate=1, burst=1))
+    bucket.take(1)
+    bucket.set_limit(RateLimit(rate=10, burst=10))
+    assert bucket.take(1) == pytest.approx(0.1)
+
+    clock.advance(1)
+    assert [bucket.take(1) for _ in range(10)] == [0] * 10
@@ -1,71 +1,248 @@
+import asyncio
+import atexit
+import dataclasses
+import socket
+import threading
+import time
 import traceback
+import urllib.error
 import urllib.request
+from functools import lru_cache
 from os import getenv
-from typing import Dict
+from typing import TYPE_CHECKING, Dict, Optional, Union
 
-from google.cloud import logging, pubsub_v1, storage
 from google.logging.type import log_severity_pb2 as severity
 from loguru import logger
 
 from cont_intel.api.utils.data_classes import PubSubMessage
+from cont_intel.api.utils.log_writer import close_log_writer, get_log_writer
+from cont_intel.api.utils.message_bus import bus_for, close_message_bus
+from cont_intel.api.utils.metrics import record_publish
+from cont_intel.api.utils.topics import Topic, topic_name
+from cont_intel.api.utils.tracing import flush_traces
+
+if TYPE_CHECKING:
+    from google.cloud import pubsub_v1, storage
+
+
+DEFAULT_PROJECT_ID = "x-contentintelligence-wpp-dev"
+
+# The project cannot change for the life of the process, so once it is known it is not looked up again. A lookup that
+# failed on a transient error (e.g. a slow metadata server during a cold start) is not remembered: the next call tries
+# again.
+_project_id: Optional[str] = None
 
 
 def get_project():
+    global _project_id
+    if _project_id is not None:
+        return _project_id
     # todo: seems to be not very reliable. i.e. can return some weird id's like ua8b6d4381aa313ebp-tp in vertex
     try:
         # get the Google Cloud Project ID
         url = "http://metadata.google.internal/computeMetadata/v1/project/project-id"
         req = urllib.request.Request(url)
         req.add_header("Metadata-Flavor", "Google")
-        project_id = urllib.request.urlopen(req).read().decode()
+        project_id = urllib.request.urlopen(req, timeout=float(getenv("METADATA_TIMEOUT", "10"))).read().decode()
         if project_id not in [
             "x-contentintelligence-wpp-dev",
             "x-contentintelligence-wpp-tst",
             "x-contentintelligence-wpp-prod",
         ]:
             # todo: in some cases might be better to crash instead, rather than fail silently
-            logger.error(f"Wrong google project id {project_id}, defaulting to 'x-contentintelligence-wpp-dev'")
-            raise ValueError(f"Wrong project id {project_id}")
+            logger.error(f"Wrong google project id {project_id}, defaulting to '{DEFAULT_PROJECT_ID}'")
+            project_id = DEFAULT_PROJECT_ID
+        _project_id = project_id
         return project_id
     except Exception as e:  # NOSONAR
-        logger.info(f"Error while getting project_id: {str(e)}. Defaulting to 'x-contentintelligence-wpp-dev'")
-        # in bitbucket the url can't be reached, so hardcode the project
-        return "x-contentintelligence-wpp-dev"
+        logger.info(f"Error while getting project_id: {str(e)}. Defaulting to '{DEFAULT_PROJECT_ID}'")
+        # in bitbucket the url can't be reached, so hardcode the project. The metadata server's name only resolves on
+        # GCP, so off GCP the default is kept; on GCP the lookup is tried again.
+        if isinstance(e, urllib.error.URLError) and isinstance(e.reason, socket.gaierror):
+            _project_id = DEFAULT_PROJECT_ID
+        return DEFAULT_PROJECT_ID
+
+
+@lru_cache(maxsize=None)
+def get_storage_client(project_id: Optional[str] = None) -> "storage.Client":
+    """Returns a process-wide storage client for `project_id`. The storage SDK is imported on first use."""
+    from google.cloud import storage
+
+    return storage.Client(project=project_id)
 
 
 def make_gcs_folder(project_id, task_id, bucket):
-    gcs_client = storage.Client(project=project_id)
-    bucket = gcs_client.get_bucket(bucket)
+    # Address the bucket directly; fetching its metadata is not needed to write to it
+    bucket = get_storage_client(project_id).bucket(bucket)
     blob = bucket.blob(task_id + "/")
 
     blob.upload_from_string("", content_type="application/x-www-form-urlencoded;charset=UTF-8")
 
 
-def publish_message(project_id: str, topic_id: str, data_str: str) -> None:
-    """Publishes message to a Pub/Sub topic."""
+# Process-wide publisher. Creating a PublisherClient opens a gRPC channel and performs the auth handshake, so it is
+# built once and shared by every publish in the process.
+_publisher: Optional["pubsub_v1.PublisherClient"] = None
+_publisher_lock = threading.Lock()
+
+
+def _ordering_enabled() -> bool:
+    return getenv("PUBSUB_ENABLE_ORDERING", "false").lower() == "true"
+
+
+def get_publisher() -> "pubsub_v1.PublisherClient":
+    """
+    Returns the shared Pub/Sub publisher, creating it on first use.
+
+    Batch settings are read from the environment:
+    - PUBSUB_BATCH_MAX_MESSAGES: max messages per batch (default 100)
+    - PUBSUB_BATCH_MAX_BYTES: max bytes per batch (default 1 MB)
+    - PUBSUB_BATCH_MAX_LATENCY: max seconds a message waits for its batch to fill (default 0.01)
+    - PUBSUB_ENABLE_ORDERING: "true" to enable ordering keys (default "false")
+    """
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                # Imported here: loading the gRPC stack costs several hundred milliseconds of cold start
+                from google.cloud import pubsub_v1
+
+                batch_settings = pubsub_v1.types.BatchSettings(
+                    max_messages=int(getenv("PUBSUB_BATCH_MAX_MESSAGES", "100")),
+                    max_bytes=int(getenv("PUBSUB_BATCH_MAX_BYTES", str(1024 * 1024))),
+                    max_latency=float(getenv("PUBSUB_BATCH_MAX_LATENCY", "0.01")),
+                )
+                publisher_options = pubsub_v1.types.PublisherOptions(enable_message_ordering=_ordering_enabled())
+                _publisher = pubsub_v1.PublisherClient(
+                    batch_settings=batch_settings, publisher_options=publisher_options
+                )
+    return _publisher
+
+
+def flush_publisher() -> None:
+    """Publishes all pending batches and shuts the shared publisher down. Safe to call more than once."""
+    global _publisher
+    with _publisher_lock:
+        publisher, _publisher = _publisher, None
+    if publisher is not None:
+        try:
+            publisher.stop()
+        except Exception as e:  # NOSONAR
+            logger.error(f"Failed to flush Pub/Sub publisher: {e}")
+
+
+atexit.register(flush_publisher)
+
+
+def publish_message(
+    project_id: str,
+    topic_id: str,
+    data_str: Union[str, bytes],
+    ordering_key: Optional[str] = None,
+    attributes: Optional[Dict[str, str]] = None,
+):
+    """
+    Publishes message to a Pub/Sub topic, with optional message `attributes`.
+
+    The message is handed to the shared, batching publisher and the returned future is not awaited; publish failures
+    are logged from the future's callback. Use `publish_message_async` when the caller needs to see the failure.
+    If ordering is enabled (PUBSUB_ENABLE_ORDERING), messages with the same `ordering_key` (e.g. a task_id) are
+    delivered in publish order.
+    """
 
-    publisher = pubsub_v1.PublisherClient()
+    publisher = get_publisher()
 
     # The `topic_path` method creates a fully qualified identifier
     # in the form `projects/{project_id}/topics/{topic_id}`
     topic_path = publisher.topic_path(project_id, topic_id)
 
     # Data must be a bytestring
-    data = "".join(data_str).encode("utf-8")
+    data = data_str if isinstance(data_str, bytes) else data_str.encode("utf-8")
 
-    # When you publish a message, the client returns a future.
+    kwargs = {}
+    if ordering_key and _ordering_enabled():
+        kwargs["ordering_key"] = ordering_key
 
-    publisher.publish(topic_path, data)
+    # When you publish a message, the client returns a future.
+    future = publisher.publish(topic_path, data, **kwargs, **(attributes or {}))
+    future.add_done_callback(lambda f: _on_publish_done(f, publisher, topic_path, kwargs.get("ordering_key")))
+    return future
+
+
+def _on_publish_done(future, publisher: "pubsub_v1.PublisherClient", topic_path: str, ordering_key: Optional[str]):
+    exception = future.exception()
+    if exception is None:
+        return
+    logger.error(f"Publishing to {topic_path} failed: {exception}")
+    if ordering_key:
+        # A failed publish pauses its ordering key; later messages for the key are rejected until it is resumed.
+        publisher.resume_publish(topic_path, ordering_key)
+
+
+async def publish_message_async(
+    project_id: str,
+    topic_id: str,
+    data_str: Union[str, bytes],
+    ordering_key: Optional[str] = None,
+    attributes: Optional[Dict[str, str]] = None,
+) -> str:
+    """Publishes message to a Pub/Sub topic and waits for the server ack. Returns the message id, raises on failure."""
+    return await asyncio.wrap_future(
+        publish_message(project_id, topic_id, data_str, ordering_key=ordering_key, attributes=attributes)
+    )
+
+
+def publish_pubsub_message(topic_id: Union[Topic, str], pubsub_message: PubSubMessage):
+    """
+    Encodes `pubsub_message` and publishes it to `topic_id` in its project, ordered by its task_id. The message goes
+    through the process' message bus (MESSAGE_BUS, see utils/message_bus.py), which is Pub/Sub by default.
+    """
+    started, topic = time.perf_counter(), topic_name(topic_id)
+    future = bus_for(topic_id).publish(topic_id, pubsub_message)
+    future.add_done_callback(
+        lambda f: record_publish(topic, started, failed=f.cancelled() or f.exception() is not None)
+    )
+    return future
+
+
+async def publish_pubsub_message_async(topic_id: Union[Topic, str], pubsub_message: PubSubMessage) -> str:
+    """Like `publish_pubsub_message`, but waits for the server ack. Returns the message id, raises on failure."""
+    started, failed = time.perf_counter(), True
+    try:
+        message_id = await bus_for(topic_id).publish_async(topic_id, pubsub_message)
+        failed = False
+        return message_id
+    finally:
+        record_publish(topic_name(topic_id), started, failed)
+
+
+async def publish_task_end(pubsub_message: PubSubMessage) -> None:
+    """
+    Tells the Controller that the task has finished, successfully or not, so it frees the task's place in the stage
+    budgets (see controller/src/scheduler.py). Failures are only logged: the Controller reclaims the place once its
+    lease expires.
+    """
+    try:
+        await publish_pubsub_message_async(
+            Topic.TASK_END, dataclasses.replace(pubsub_message, results=None, results_ref=None, spans=None)
+        )
+    except Exception as e:  # NOSONAR
+        logger.error(f"Failed to publish the end of task {pubsub_message.task_id}: {e}")
 
 
 def write_log(log_source: str, log_payload, log_severity: str = severity.INFO):
-    client = logging.Client()
-    logger = client.logger(log_source)
+    """Queues a Cloud Logging entry. Entries are written in batches by a background thread, so this never blocks."""
+    get_log_writer().write(log_source, log_payload, log_severity)
+
 
-    if isinstance(log_payload, Dict):
-        logger.log_struct(log_payload, severity=log_severity)
-    else:
-        logger.log_text(log_payload, severity=log_severity)
+def flush_clients() -> None:
+    """
+    Flushes pending Pub/Sub batches, message bus publishes and exported spans and drains queued log entries. Meant
+    for the services' shutdown hooks.
+    """
+    close_message_bus()
+    flush_publisher()
+    flush_traces()
+    close_log_writer()
 
 
 def handle_error(
@@ -85,19 +262,35 @@ def handle_error(
         pubsub_message.error_message = error_message
         pubsub_message.error_code = error_code
 
-        # Store the stack trace for internal debugging
-        error_message += f", {traceback.format_exc()}"
+        # Log the stack trace for internal debugging; the client only gets the error message. Formatted from `e` rather
+        # than the exception being handled, as callers may report errors from another thread (e.g. an executor)
+        stack_trace = None
+        if isinstance(e, BaseException):
+            stack_trace = "".join(traceback.format_exception(type(e), e, e.__traceback__))
 
         logger.info(f"Publish message to the pub/sub 'error' topic of the GCP project '{pubsub_message.project_id}'.")
-        publish_message(pubsub_message.project_id, "error", pubsub_message.to_json())
+        # Not waited for, as the services call this from their async handlers; a failed publish is logged
+        future = publish_pubsub_message(Topic.ERROR, pubsub_message)
+        future.add_done_callback(lambda f: _on_error_published(f, pubsub_message.task_id))
 
-        write_log("api", {"message": f"Error in {SERVICE_NAME}."})
+        write_log(
+            "api",
+            {"message": f"Error in {SERVICE_NAME}.", "task_id": pubsub_message.task_id, "stack_trace": stack_trace},
+            severity.ERROR,
+        )
 
     except Exception as e:
         write_log("api", {"message": "Error in handle_error routine!"})
         logger.error(f"handle_error routine failed: {e}")
 
 
+def _on_error_published(future, task_id: str) -> None:
+    if future.cancelled():
+        logger.error(f"Publishing the error of task {task_id} was cancelled")
+    elif future.exception() is not None:
+        logger.error(f"Failed to publish the error of task {task_id}: {future.exception()}")
+
+
 def get_bucket_name(project_id):
     return dict(
         {
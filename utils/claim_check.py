@@ -0,0 +1,103 @@
+import asyncio
+import hashlib
+from os import getenv
+from typing import Optional
+
+from cont_intel.api.utils.api_utils import get_storage_client
+from cont_intel.api.utils.data_classes import PubSubMessage, ResultsRef, decode_json, encode_json
+
+# Name of the results object in the task's GCS folder
+RESULTS_OBJECT_NAME = "results.json"
+
+
+def claim_check_threshold() -> int:
+    """Results whose JSON is larger than this many bytes are stored in GCS (CLAIM_CHECK_THRESHOLD, 0 disables)."""
+    return int(getenv("CLAIM_CHECK_THRESHOLD", str(256 * 1024)))
+
+
+def attach_results(pubsub_message: PubSubMessage, results: Optional[dict], threshold: Optional[int] = None) -> None:
+    """
+    Sets the results of `pubsub_message`. Results larger than `threshold` bytes are written to
+    `<task_id>/results.json` in the message's bucket and the message carries a `ResultsRef` to them instead.
+    """
+    if threshold is None:
+        threshold = claim_check_threshold()
+
+    if results is not None and threshold > 0:
+        data = encode_json(results)
+        if len(data) > threshold:
+            object_name = f"{pubsub_message.task_id}/{RESULTS_OBJECT_NAME}"
+            blob = get_storage_client(pubsub_message.project_id).bucket(pubsub_message.bucket_name).blob(object_name)
+            blob.upload_from_string(data, content_type="application/json")
+            pubsub_message.results = None
+            pubsub_message.results_ref = ResultsRef(
+                bucket_name=pubsub_message.bucket_name,
+                object_name=object_name,
+                size=len(data),
+                sha256=hashlib.sha256(data).hexdigest(),
+            )
+            return
+
+    pubsub_message.results = results
+    pubsub_message.results_ref = None
+
+
+def attach_stored_result(
+    pubsub_message: PubSubMessage, field: str, text: str, object_name: str, threshold: Optional[int] = None
+) -> None:
+    """
+    Sets the results of `pubsub_message` to `{field: text}`, where `text` has already been written to `object_name`
+    in the message's bucket. Results larger than `threshold` bytes refer to that object instead of being stored again.
+    """
+    if threshold is None:
+        threshold = claim_check_threshold()
+
+    results = {field: text}
+    if threshold > 0 and len(encode_json(results)) > threshold:
+        data = text.encode("utf-8")
+        pubsub_message.results = None
+        pubsub_message.results_ref = ResultsRef(
+            bucket_name=pubsub_message.bucket_name,
+            object_name=object_name,
+            size=len(data),
+            sha256=hashlib.sha256(data).hexdigest(),
+            field=field,
+        )
+        return
+
+    pubsub_message.results = results
+    pubsub_message.results_ref = None
+
+
+def resolve_results(pubsub_message: PubSubMessage) -> Optional[dict]:
+    """
+    Returns the results of `pubsub_message`, downloading them if the message carries a reference. Downloaded results
+    are kept on the message, so they are fetched at most once.
+    """
+    results_ref = pubsub_message.results_ref
+    if pubsub_message.results is None and results_ref is not None:
+        bucket = get_storage_client(pubsub_message.project_id).bucket(results_ref.bucket_name)
+        data = bucket.blob(results_ref.object_name).download_as_bytes()
+        if hashlib.sha256(data).hexdigest() != results_ref.sha256:
+            raise ValueError(
+                f"Results in gs://{results_ref.bucket_name}/{results_ref.object_name} do not match their reference"
+            )
+        if results_ref.field is not None:
+            pubsub_message.results = {results_ref.field: data.decode("utf-8")}
+        else:
+            pubsub_message.results = decode_json(data)
+    return pubsub_message.results
+
+
+async def attach_results_async(pubsub_message: PubSubMessage, results: Optional[dict]) -> None:
+    await asyncio.get_running_loop().run_in_executor(None, attach_results, pubsub_message, results)
+
+
+async def attach_stored_result_async(pubsub_message: PubSubMessage, field: str, text: str, object_name: str) -> None:
+    await asyncio.get_running_loop().run_in_executor(
+        None, attach_stored_result, pubsub_message, field, text, object_name
+    )
+
+
+async def resolve_results_async(pubsub_message: PubSubMessage) -> Optional[dict]:
+    return await asyncio.get_running_loop().run_in_executor(None, resolve_results, pubsub_message)
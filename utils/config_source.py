@@ -0,0 +1,64 @@
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Generic, Optional, TypeVar
+
+from loguru import logger
+
+Config = TypeVar("Config")
+
+
+class ConfigSource(Generic[Config]):
+    """
+    Reads a JSON config from a local file or a GCS object (gs://bucket/object) and reloads it every
+    `refresh_interval` seconds in the background, so settings change without a redeploy. `parse` turns the JSON into
+    the config; without a `location` the config is `default`. A config that fails to load or parse is logged and the
+    previous one is kept.
+    """
+
+    def __init__(
+        self,
+        location: Optional[str],
+        parse: Callable[[dict], Config],
+        default: Config,
+        refresh_interval: float = 30,
+    ):
+        self.location = location
+        self.parse = parse
+        self.config = default
+        self.refresh_interval = refresh_interval
+        self._raw: Optional[bytes] = None
+        self._loaded_at = 0.0
+        self._refreshing = False
+        if location:
+            self._reload()
+
+    def get(self) -> Config:
+        if self.location and not self._refreshing and time.monotonic() - self._loaded_at >= self.refresh_interval:
+            self._refreshing = True
+            threading.Thread(target=self._reload, name="config-reload", daemon=True).start()
+        return self.config
+
+    def _read(self) -> bytes:
+        if self.location.startswith("gs://"):
+            # Imported here: api_utils imports the modules that use this one
+            from cont_intel.api.utils.api_utils import get_storage_client
+
+            bucket_name, _, object_name = self.location[len("gs://"):].partition("/")
+            return get_storage_client().bucket(bucket_name).blob(object_name).download_as_bytes()
+        return Path(self.location).read_bytes()
+
+    def _reload(self) -> None:
+        try:
+            raw = self._read()
+            if raw != self._raw:
+                self.config = self.parse(json.loads(raw))
+                self._raw = raw
+                # Configs may name API keys, so their contents are not logged
+                logger.info(f"Loaded config from {self.location}")
+        except Exception as e:  # NOSONAR
+            logger.error(f"Failed to load the config from {self.location}: {e}")
+        finally:
+            self._loaded_at = time.monotonic()
+            self._refreshing = False
@@ -2,9 +2,40 @@ from __future__ import annotations  # noqa
 
 import base64
 import json
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass, fields
 from enum import Enum
-from typing import List, Optional
+from os import getenv
+from typing import Dict, List, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - plain json is used instead
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - messages are published uncompressed
+    zstandard = None
+
+# Version of the message layout, sent in the body and as a message attribute. Messages written before it existed
+# decode as version 1. Version 3 added the trace (trace_id and spans), version 4 the tenant, version 5 the field of a
+# results reference.
+SCHEMA_VERSION = 5
+SCHEMA_VERSION_ATTRIBUTE = "schema_version"
+CONTENT_ENCODING_ATTRIBUTE = "content_encoding"
+ZSTD_ENCODING = "zstd"
+
+
+def encode_json(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, sort_keys=True).encode("utf-8")
+
+
+def decode_json(data: Union[bytes, str]):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 
 class TaskType(str, Enum):
@@ -17,10 +48,47 @@ class TaskType(str, Enum):
     NONE = "NONE"
 
 
-@dataclass
+@dataclass(slots=True)
+class ResultsRef:
+    """
+    Claim check for results stored as a JSON object in GCS instead of in the message body. If `field` is set, the
+    object holds the text of that single field of the results instead.
+    """
+
+    bucket_name: str
+    object_name: str
+    size: int
+    sha256: str
+    field: Optional[str] = None
+
+
+@dataclass(slots=True)
+class Span:
+    """A timed step of a task's trace (see utils/tracing.py). Times are Unix timestamps in seconds."""
+
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    start: float
+    end: Optional[float] = None
+
+
+@dataclass(slots=True)
 class PubSubMessage:
     """
     A class containing all the required data that is passed around between Cloud Run components by PubSub.
+
+    Messages travel as JSON. `encode` optionally compresses large bodies with zstd (PUBSUB_COMPRESSION=zstd, for
+    bodies of at least PUBSUB_COMPRESSION_THRESHOLD bytes) and marks them with a `content_encoding` attribute, which
+    `from_request` uses to decode them; uncompressed messages are read exactly as before.
+
+    Large results can be carried by reference instead (see utils/claim_check.py): `results` is then None and
+    `results_ref` points to the stored JSON.
+
+    `trace_id` and `spans` carry the task's trace: every stage records when it started and finished working on the
+    message (see utils/tracing.py).
+
+    `tenant` identifies the client that initiated the task; the Controller shares the stages fairly between tenants.
     """
 
     project_id: str
@@ -37,33 +105,65 @@ class PubSubMessage:
     results: Optional[dict] = None
     error_message: Optional[str] = None
     error_code: Optional[int] = None
+    bypass_cache: bool = False
+    results_ref: Optional[ResultsRef] = None
+    trace_id: Optional[str] = None
+    spans: Optional[List[Span]] = None
+    tenant: Optional[str] = None
+    schema_version: int = SCHEMA_VERSION
 
     @staticmethod
     def from_request(request_json: dict) -> PubSubMessage:
-        pubsub_message_data = PubSubMessage.parse_pubsub_message_data(request_json)
-
-        return PubSubMessage(
-            project_id=pubsub_message_data["project_id"],
-            task_id=pubsub_message_data["task_id"],
-            signed_file_url=pubsub_message_data["signed_file_url"],
-            dataset_reference=pubsub_message_data["dataset_reference"],
-            bucket_name=pubsub_message_data["bucket_name"],
-            task_type=pubsub_message_data["task_type"],
-            output_url=pubsub_message_data["output_url"],
-            model_id=pubsub_message_data["model_id"],
-            input_data_type=pubsub_message_data["input_data_type"],
-            csv_data_config=pubsub_message_data["csv_data_config"],
-            explainability=pubsub_message_data["explainability"],
-            results=pubsub_message_data["results"],
-            error_message=pubsub_message_data.get("error_message", None),
-            error_code=pubsub_message_data.get("error_code", None),
-        )
+        return PubSubMessage.from_dict(PubSubMessage.parse_pubsub_message_data(request_json))
+
+    @staticmethod
+    def from_dict(message_data: dict) -> PubSubMessage:
+        # Fields added by newer versions are ignored, missing optional fields take their defaults
+        values = {name: message_data[name] for name in _FIELD_NAMES if name in message_data}
+        values["schema_version"] = message_data.get("schema_version", 1)
+        if values.get("results_ref") is not None:
+            values["results_ref"] = ResultsRef(**values["results_ref"])
+        if values.get("spans") is not None:
+            values["spans"] = [Span(**span) for span in values["spans"]]
+        return PubSubMessage(**values)
 
     @staticmethod
     def parse_pubsub_message_data(request_json: dict):
         pubsub_message = request_json["message"]
-        pubsub_message_data = base64.b64decode(pubsub_message["data"]).decode("utf-8").strip()
-        return json.loads(pubsub_message_data)
+        pubsub_message_data = base64.b64decode(pubsub_message["data"])
+        attributes = pubsub_message.get("attributes") or {}
+        if attributes.get(CONTENT_ENCODING_ATTRIBUTE) == ZSTD_ENCODING:
+            if zstandard is None:
+                raise RuntimeError("Received a zstd compressed message, but zstandard is not installed")
+            pubsub_message_data = zstandard.ZstdDecompressor().decompress(pubsub_message_data)
+        return decode_json(pubsub_message_data)
+
+    def to_dict(self) -> dict:
+        message_data = {name: getattr(self, name) for name in _FIELD_NAMES}
+        # Re-encoded messages are written in the current layout
+        message_data["schema_version"] = SCHEMA_VERSION
+        if self.results_ref is not None:
+            message_data["results_ref"] = asdict(self.results_ref)
+        if self.spans is not None:
+            message_data["spans"] = [asdict(span) for span in self.spans]
+        return message_data
+
+    def to_json(self) -> str:
+        return encode_json(self.to_dict()).decode("utf-8")
+
+    def encode(self) -> Tuple[bytes, Dict[str, str]]:
+        """Returns the Pub/Sub message body and attributes."""
+        data = encode_json(self.to_dict())
+        attributes = {SCHEMA_VERSION_ATTRIBUTE: str(SCHEMA_VERSION)}
+        if (
+            zstandard is not None
+            and getenv("PUBSUB_COMPRESSION", "none").lower() == ZSTD_ENCODING
+            and len(data) >= int(getenv("PUBSUB_COMPRESSION_THRESHOLD", str(64 * 1024)))
+        ):
+            level = int(getenv("PUBSUB_COMPRESSION_LEVEL", "3"))
+            data = zstandard.ZstdCompressor(level=level).compress(data)
+            attributes[CONTENT_ENCODING_ATTRIBUTE] = ZSTD_ENCODING
+        return data, attributes
+
 
-    def to_json(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True)
+_FIELD_NAMES = tuple(field.name for field in fields(PubSubMessage))
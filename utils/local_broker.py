@@ -0,0 +1,119 @@
+"""
+Local stand-in for Pub/Sub push delivery, for running and load-testing the services on one machine.
+
+The broker accepts publishes on the Pub/Sub REST path (POST /v1/projects/<project>/topics/<topic>:publish) and pushes
+each message to the route subscribed to its topic (see utils/topics.py) as a push envelope, through the in-memory
+bus' bounded queues and retries. Services publish to it with MESSAGE_BUS=local and MESSAGE_BUS_URL set to its address.
+Messages for topics whose service is not running are dropped, like messages to a topic without subscriptions.
+
+Run the services yourself and point the broker at them:
+
+    python -m cont_intel.api.utils.local_broker --service controller=http://127.0.0.1:8081 \\
+        --service downloader=http://127.0.0.1:8082 ...
+
+or let it start them, each under uvicorn on the next port after its own:
+
+    python -m cont_intel.api.utils.local_broker --launch endpoints controller downloader annotator output error-handler
+
+GET /stats reports queue depths, deliveries and end-to-end task latency percentiles.
+"""
+import argparse
+import base64
+import os
+import signal
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+from loguru import logger
+
+from cont_intel.api.utils.message_bus import InMemoryBus, Route
+from cont_intel.api.utils.topics import Topic, subscriptions_for
+
+
+def build_app(service_urls: Dict[str, str], workers: int = 4, queue_size: int = 1000, max_attempts: int = 5) -> FastAPI:
+    """The broker for the services listening at `service_urls` (service name -> base URL)."""
+    routes = [
+        Route(topic=topic, path=subscription.path, url=service_urls[subscription.service], workers=workers)
+        for topic, subscription in subscriptions_for(service_urls).items()
+    ]
+    bus = InMemoryBus(routes, queue_size=queue_size, max_attempts=max_attempts)
+    dropped: Dict[str, int] = {}
+
+    broker = FastAPI()
+    broker.on_event("startup")(bus.start)
+    broker.on_event("shutdown")(bus.stop)
+
+    @broker.post("/v1/projects/{project_id}/topics/{topic_id}:publish")
+    async def publish(project_id: str, topic_id: str, request: Request):
+        try:
+            topic = Topic(topic_id)
+        except ValueError:
+            raise HTTPException(status_code=404, detail=f"Topic not found: {topic_id}")
+
+        message_ids: List[str] = []
+        for message in (await request.json()).get("messages", []):
+            data = base64.b64decode(message.get("data", ""))
+            if not bus.handles(topic):
+                dropped[topic.value] = dropped.get(topic.value, 0) + 1
+                message_ids.append("0")
+                continue
+            message_ids.append(
+                await bus.enqueue(topic, data, message.get("attributes") or {}, message.get("orderingKey", ""))
+            )
+        return JSONResponse({"messageIds": message_ids})
+
+    @broker.get("/stats")
+    def stats():
+        return JSONResponse({**bus.stats(), "dropped": dropped})
+
+    return broker
+
+
+def launch(services: List[str], broker_url: str, first_port: int) -> Dict[str, subprocess.Popen]:
+    """Starts each service under uvicorn on consecutive ports, publishing to the broker."""
+    environment = {**os.environ, "MESSAGE_BUS": "local", "MESSAGE_BUS_URL": broker_url}
+    processes = {}
+    for port, service in enumerate(services, start=first_port):
+        command = [sys.executable, "-m", "uvicorn", f"cont_intel.api.{service}.src.api:app", "--port", str(port)]
+        processes[service] = subprocess.Popen(command, env={**environment, "K_SERVICE": service})
+        logger.info(f"Started {service} on http://127.0.0.1:{port}")
+    return processes
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8085)
+    parser.add_argument("--service", action="append", default=[], metavar="NAME=URL", help="A running service")
+    parser.add_argument("--launch", nargs="+", default=[], metavar="NAME", help="Services to start")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent deliveries per topic")
+    parser.add_argument("--queue-size", type=int, default=1000, help="Capacity of each topic's queue")
+    parser.add_argument("--max-attempts", type=int, default=5, help="Delivery attempts per message")
+    args = parser.parse_args(argv)
+
+    import uvicorn
+
+    service_urls = dict(service.split("=", 1) for service in args.service)
+    service_urls.update(
+        {service: f"http://127.0.0.1:{port}" for port, service in enumerate(args.launch, start=args.port + 1)}
+    )
+    processes = launch(args.launch, f"http://127.0.0.1:{args.port}", args.port + 1)
+    # uvicorn re-raises SIGTERM after its shutdown; exit normally instead, so the launched services are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        uvicorn.run(
+            build_app(service_urls, args.workers, args.queue_size, args.max_attempts),
+            host="127.0.0.1",
+            port=args.port,
+        )
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
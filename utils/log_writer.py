@@ -0,0 +1,184 @@
+import atexit
+import queue
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from os import getenv
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
+
+from google.logging.type import log_severity_pb2 as severity
+from loguru import logger
+
+if TYPE_CHECKING:
+    from google.cloud import logging
+
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_BLOCK = "block"
+
+
+@dataclass
+class LogEntry:
+    log_source: str
+    payload: Union[Dict, str]
+    severity: int
+
+
+class BackgroundLogWriter:
+    """
+    Queues log entries in memory and writes them to Cloud Logging in batches from a background thread, so callers
+    never wait on the logging API.
+
+    - `max_queue_size` bounds the buffer. When it is full, `overflow_policy` decides what happens to a new entry:
+      "drop_newest" discards it, "drop_oldest" discards the oldest queued entry, "block" waits up to
+      `block_timeout` seconds for room and then discards it.
+    - Entries below `min_severity` are discarded on enqueue.
+    - A batch is written when `batch_size` entries are queued or `flush_interval` seconds have passed.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = 10000,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        overflow_policy: str = OVERFLOW_DROP_NEWEST,
+        min_severity: int = severity.DEFAULT,
+        block_timeout: float = 0.1,
+    ):
+        if overflow_policy not in (OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, OVERFLOW_BLOCK):
+            raise ValueError(f"Unknown overflow policy {overflow_policy}")
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.min_severity = min_severity
+        self.block_timeout = block_timeout
+        self.dropped = 0
+
+        self._queue: "queue.Queue[LogEntry]" = queue.Queue(maxsize=max_queue_size)
+        self._client: Optional["logging.Client"] = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_env(cls) -> "BackgroundLogWriter":
+        """
+        Builds a writer configured from the environment:
+        LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_OVERFLOW_POLICY and LOG_MIN_SEVERITY (e.g. "WARNING").
+        """
+        return cls(
+            max_queue_size=int(getenv("LOG_QUEUE_SIZE", "10000")),
+            batch_size=int(getenv("LOG_BATCH_SIZE", "100")),
+            flush_interval=float(getenv("LOG_FLUSH_INTERVAL", "1.0")),
+            overflow_policy=getenv("LOG_OVERFLOW_POLICY", OVERFLOW_DROP_NEWEST),
+            min_severity=severity.LogSeverity.Value(getenv("LOG_MIN_SEVERITY", "DEFAULT").upper()),
+        )
+
+    def write(self, log_source: str, log_payload: Union[Dict, str], log_severity: int = severity.INFO) -> bool:
+        """Queues an entry. Returns False if it was filtered out or dropped."""
+        if log_severity < self.min_severity or self._stopped.is_set():
+            return False
+
+        entry = LogEntry(log_source, log_payload, log_severity)
+        try:
+            if self.overflow_policy == OVERFLOW_BLOCK:
+                self._queue.put(entry, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(entry)
+            return True
+        except queue.Full:
+            pass
+
+        if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+            try:
+                self._queue.get_nowait()
+                self.dropped += 1
+                self._queue.put_nowait(entry)
+                return True
+            except (queue.Empty, queue.Full):
+                pass
+
+        self.dropped += 1
+        return False
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Stops accepting entries and drains the queue, waiting at most `timeout` seconds."""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join(timeout)
+        if self.dropped:
+            logger.warning(f"Log writer dropped {self.dropped} entries")
+
+    def _run(self) -> None:
+        while not (self._stopped.is_set() and self._queue.empty()):
+            batch = self._collect_batch()
+            if batch:
+                self._commit(batch)
+
+    def _collect_batch(self) -> List[LogEntry]:
+        batch: List[LogEntry] = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (self._stopped.is_set() and self._queue.empty()):
+                break
+            try:
+                batch.append(self._queue.get(timeout=min(remaining, 0.1)))
+            except queue.Empty:
+                continue
+        return batch
+
+    def _commit(self, batch: List[LogEntry]) -> None:
+        try:
+            if self._client is None:
+                # Imported on the writer thread, so the logging SDK never adds to a service's import time
+                from google.cloud import logging
+
+                self._client = logging.Client()
+
+            # One API call per log name in the batch
+            entries_by_source: Dict[str, List[LogEntry]] = defaultdict(list)
+            for entry in batch:
+                entries_by_source[entry.log_source].append(entry)
+
+            for log_source, entries in entries_by_source.items():
+                log_batch = self._client.logger(log_source).batch()
+                for entry in entries:
+                    if isinstance(entry.payload, Dict):
+                        log_batch.log_struct(entry.payload, severity=entry.severity)
+                    else:
+                        log_batch.log_text(entry.payload, severity=entry.severity)
+                log_batch.commit()
+        except Exception as e:  # NOSONAR
+            # Never let a logging failure kill the writer thread
+            logger.error(f"Failed to write {len(batch)} log entries: {e}")
+
+
+_writer: Optional[BackgroundLogWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_log_writer() -> BackgroundLogWriter:
+    """Returns the process-wide log writer, starting it on first use."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = BackgroundLogWriter.from_env()
+    return _writer
+
+
+def close_log_writer(timeout: float = 5.0) -> None:
+    """Drains and stops the process-wide log writer. Safe to call more than once."""
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.close(timeout)
+
+
+atexit.register(close_log_writer)
+
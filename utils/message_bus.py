@@ -0,0 +1,402 @@
+import asyncio
+import base64
+import itertools
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from os import getenv
+from typing import TYPE_CHECKING, Deque, Dict, Iterable, List, Optional, Union
+
+from loguru import logger
+
+from cont_intel.api.utils.data_classes import PubSubMessage
+from cont_intel.api.utils.topics import Topic, topic_name
+
+if TYPE_CHECKING:
+    import httpx
+
+
+class MessageBus(ABC):
+    """
+    Carries PubSubMessages between the services. A bus delivers every message published to a topic to the route
+    subscribed to it as a Pub/Sub push envelope, so the services' handlers do not depend on the backend.
+    """
+
+    def handles(self, topic: Union[Topic, str]) -> bool:
+        """Whether this bus carries `topic`. Topics it does not carry are published to Pub/Sub."""
+        return True
+
+    @abstractmethod
+    def publish(self, topic: Union[Topic, str], pubsub_message: PubSubMessage) -> Future:
+        """Publishes `pubsub_message` and returns a future of its message id."""
+
+    async def publish_async(self, topic: Union[Topic, str], pubsub_message: PubSubMessage) -> str:
+        """Publishes `pubsub_message` and waits until the bus has accepted it. Returns the message id."""
+        return await asyncio.wrap_future(self.publish(topic, pubsub_message))
+
+    def in_flight_tasks(self) -> Optional[int]:
+        """The number of tasks the bus has carried that have not finished yet, or None if it does not track them."""
+        return None
+
+    def close(self) -> None:
+        """Releases the bus' clients. Safe to call more than once."""
+
+
+class PubSubBus(MessageBus):
+    """Google Cloud Pub/Sub, through the shared batching publisher. Messages are ordered by task_id."""
+
+    def publish(self, topic: Union[Topic, str], pubsub_message: PubSubMessage) -> Future:
+        # Imported here: api_utils imports this module
+        from cont_intel.api.utils.api_utils import publish_message
+
+        data, attributes = pubsub_message.encode()
+        return publish_message(
+            pubsub_message.project_id,
+            topic_name(topic),
+            data,
+            ordering_key=pubsub_message.task_id,
+            attributes=attributes,
+        )
+
+
+@dataclass
+class Route:
+    """
+    Delivers messages published to `topic` to `path`, like a Pub/Sub push subscription. The subscriber is either an
+    ASGI `app` in this process or a service listening at `url`.
+    """
+
+    topic: Topic
+    path: str = "/"
+    app: Optional[object] = None
+    url: Optional[str] = None
+    workers: int = 4
+
+
+@dataclass
+class _Delivery:
+    message_id: str
+    task_id: str
+    data: bytes
+    attributes: Dict[str, str]
+    enqueued_at: float
+
+
+def percentiles(values: Iterable[float]) -> dict:
+    """Count and p50/p95/p99 of `values` (in seconds), in milliseconds."""
+    values = sorted(values)
+
+    def percentile(p: float) -> Optional[float]:
+        if not values:
+            return None
+        return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 1)
+
+    return {"count": len(values), "p50": percentile(50), "p95": percentile(95), "p99": percentile(99)}
+
+
+class InMemoryBus(MessageBus):
+    """
+    Connects subscribers with asyncio queues instead of Pub/Sub. It runs on the event loop it is started on.
+
+    Each routed topic has a bounded queue and its own number of workers. A worker takes a message off the queue and
+    posts it to the subscribing route as a Pub/Sub push envelope, so the handlers run exactly as they do behind
+    Pub/Sub. When a queue is full, publishers wait: the downstream stage throttles the upstream one instead of
+    buffering without limit. A delivery that fails or is answered with an error status is retried up to
+    `max_attempts` times with exponential backoff, as Pub/Sub redelivers unacknowledged messages.
+
+    The time from a task's first message on `entry_topic` until one of `terminal_topics` has been handled is recorded
+    as its end-to-end latency. Tasks are only tracked if the bus routes one of `terminal_topics`, and a task whose end
+    the bus never carries is forgotten `task_ttl` seconds after it started. Per topic, the time messages wait in the
+    queue and the time the handler takes are recorded too.
+    """
+
+    def __init__(
+        self,
+        routes: Iterable[Route],
+        queue_size: int = 100,
+        max_attempts: int = 1,
+        min_backoff: float = 0.1,
+        max_backoff: float = 10,
+        entry_topic: Topic = Topic.CONTROLLER_START,
+        # Every task, finished or failed, ends with a task_end message to the Controller
+        terminal_topics: Iterable[Topic] = (Topic.TASK_END,),
+        latency_window: int = 10000,
+        task_ttl: float = 24 * 3600,
+    ):
+        self.routes: Dict[str, Route] = {topic_name(route.topic): route for route in routes}
+        self.queue_size = queue_size
+        self.max_attempts = max_attempts
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.entry_topic = topic_name(entry_topic)
+        self.terminal_topics = {topic_name(topic) for topic in terminal_topics}
+        self.task_ttl = task_ttl
+        self._tracks_tasks = not self.terminal_topics.isdisjoint(self.routes)
+
+        self.processed: Dict[str, int] = dict.fromkeys(self.routes, 0)
+        self.failed: Dict[str, int] = dict.fromkeys(self.routes, 0)
+        self.latencies: Deque[float] = deque(maxlen=latency_window)
+        self.wait_times: Dict[str, Deque[float]] = {topic: deque(maxlen=latency_window) for topic in self.routes}
+        self.handler_times: Dict[str, Deque[float]] = {topic: deque(maxlen=latency_window) for topic in self.routes}
+
+        self._message_ids = itertools.count(1)
+        self._started_at: Dict[str, float] = {}
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._clients: Dict[int, "httpx.AsyncClient"] = {}
+        self._workers: List[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def handles(self, topic: Union[Topic, str]) -> bool:
+        return topic_name(topic) in self.routes
+
+    async def start(self) -> None:
+        import httpx
+
+        self._loop = asyncio.get_running_loop()
+        for topic, route in self.routes.items():
+            self._queues[topic] = asyncio.Queue(maxsize=self.queue_size)
+            subscriber = route.app if route.app is not None else route.url
+            if id(subscriber) not in self._clients:
+                if route.app is not None:
+                    client = httpx.AsyncClient(
+                        transport=httpx.ASGITransport(app=route.app), base_url="http://message-bus", timeout=None
+                    )
+                else:
+                    client = httpx.AsyncClient(base_url=route.url, timeout=None)
+                self._clients[id(subscriber)] = client
+            for index in range(route.workers):
+                self._workers.append(asyncio.create_task(self._work(route, topic), name=f"{topic}-{index}"))
+        logger.info(
+            "In-memory message bus started: "
+            + ", ".join(f"{topic} x{route.workers}" for topic, route in self.routes.items())
+        )
+
+    async def stop(self, timeout: float = 30) -> None:
+        """Waits up to `timeout` seconds for the queued messages to be handled, then stops the workers."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues.values())), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.queued()} queued messages were not handled before shutdown")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        await asyncio.gather(*(client.aclose() for client in self._clients.values()))
+        self._workers, self._clients = [], {}
+
+    async def enqueue(self, topic: Union[Topic, str], data: bytes, attributes: Dict[str, str], task_id: str) -> str:
+        """Queues an encoded message for `topic`, waiting while the queue is full. Returns the message id."""
+        name = topic_name(topic)
+        delivery = self._delivery(name, data, attributes, task_id)
+        await self._queues[name].put(delivery)
+        return delivery.message_id
+
+    async def publish_async(self, topic: Union[Topic, str], pubsub_message: PubSubMessage) -> str:
+        """Queues `pubsub_message` for `topic`, waiting while the queue is full. Returns the message id."""
+        data, attributes = pubsub_message.encode()
+        return await self.enqueue(topic, data, attributes, pubsub_message.task_id)
+
+    def publish(self, topic: Union[Topic, str], pubsub_message: PubSubMessage) -> Future:
+        """
+        Queues `pubsub_message` for `topic` from synchronous code and returns a future of the message id.
+
+        From another thread the future resolves once there is room in the queue. On the bus' own loop the caller
+        cannot be made to wait without stalling the loop, so a full queue fails the future instead.
+        """
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if not on_loop:
+            return asyncio.run_coroutine_threadsafe(self.publish_async(topic, pubsub_message), self._loop)
+
+        future: Future = Future()
+        data, attributes = pubsub_message.encode()
+        name = topic_name(topic)
+        delivery = self._delivery(name, data, attributes, pubsub_message.task_id)
+        try:
+            self._queues[name].put_nowait(delivery)
+            future.set_result(delivery.message_id)
+        except asyncio.QueueFull as e:
+            future.set_exception(e)
+        return future
+
+    def _delivery(self, topic: str, data: bytes, attributes: Dict[str, str], task_id: str) -> _Delivery:
+        if topic == self.entry_topic and self._tracks_tasks:
+            self._expire_tasks()
+            self._started_at.setdefault(task_id, time.perf_counter())
+        return _Delivery(str(next(self._message_ids)), task_id, data, attributes, time.perf_counter())
+
+    async def _work(self, route: Route, topic: str) -> None:
+        queue = self._queues[topic]
+        client = self._clients[id(route.app if route.app is not None else route.url)]
+        while True:
+            delivery = await queue.get()
+            started_handling = time.perf_counter()
+            self.wait_times[topic].append(started_handling - delivery.enqueued_at)
+            try:
+                envelope = {
+                    "message": {
+                        "data": base64.b64encode(delivery.data).decode("ascii"),
+                        "attributes": delivery.attributes,
+                        "message_id": delivery.message_id,
+                    },
+                    "subscription": f"message-bus/{topic}",
+                }
+                for attempt in range(1, self.max_attempts + 1):
+                    try:
+                        response = await client.post(route.path, json=envelope)
+                        if response.status_code < 400:
+                            self.processed[topic] += 1
+                            break
+                        error = f"answered {response.status_code}"
+                    except Exception as e:  # NOSONAR
+                        error = f"failed: {e}"
+                    if attempt < self.max_attempts:
+                        await asyncio.sleep(min(self.max_backoff, self.min_backoff * 2 ** (attempt - 1)))
+                else:
+                    self.failed[topic] += 1
+                    logger.error(f"{topic} handler {error} for task {delivery.task_id}")
+            finally:
+                queue.task_done()
+                self.handler_times[topic].append(time.perf_counter() - started_handling)
+                if topic in self.terminal_topics:
+                    started_at = self._started_at.pop(delivery.task_id, None)
+                    if started_at is not None:
+                        self.latencies.append(time.perf_counter() - started_at)
+
+    def queued(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    def _expire_tasks(self) -> None:
+        # Tasks are kept in the order they started, so the expired ones are at the front
+        deadline = time.perf_counter() - self.task_ttl
+        while self._started_at:
+            task_id, started_at = next(iter(self._started_at.items()))
+            if started_at > deadline:
+                break
+            del self._started_at[task_id]
+
+    def in_flight_tasks(self) -> Optional[int]:
+        if not self._tracks_tasks:
+            return None
+        self._expire_tasks()
+        return len(self._started_at)
+
+    def stats(self) -> dict:
+        return {
+            "queues": {
+                topic: {"depth": queue.qsize(), "capacity": self.queue_size, "workers": self.routes[topic].workers}
+                for topic, queue in self._queues.items()
+            },
+            "processed": self.processed,
+            "failed": self.failed,
+            "in_flight_tasks": self.in_flight_tasks(),
+            "wait_ms": {topic: percentiles(times) for topic, times in self.wait_times.items()},
+            "handler_ms": {topic: percentiles(times) for topic, times in self.handler_times.items()},
+            "end_to_end_ms": percentiles(self.latencies),
+        }
+
+
+class LocalBrokerBus(MessageBus):
+    """
+    Publishes to a local broker (see utils/local_broker.py) through its Pub/Sub-style REST API. The broker pushes the
+    messages to the services' routes, so a set of services can run on one machine without GCP.
+    """
+
+    def __init__(self, url: str, max_workers: int = 16, timeout: float = 30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="message-bus")
+        self._client: Optional["httpx.Client"] = None
+        self._client_lock = threading.Lock()
+
+    def _http(self) -> "httpx.Client":
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import httpx
+
+                    self._client = httpx.Client(timeout=self.timeout)
+        return self._client
+
+    def publish(self, topic: Union[Topic, str], pubsub_message: PubSubMessage) -> Future:
+        data, attributes = pubsub_message.encode()
+        url = f"{self.url}/v1/projects/{pubsub_message.project_id}/topics/{topic_name(topic)}:publish"
+        body = {
+            "messages": [
+                {
+                    "data": base64.b64encode(data).decode("ascii"),
+                    "attributes": attributes,
+                    "orderingKey": pubsub_message.task_id,
+                }
+            ]
+        }
+        return self._executor.submit(self._post, url, body)
+
+    def _post(self, url: str, body: dict) -> str:
+        response = self._http().post(url, json=body)
+        response.raise_for_status()
+        return response.json()["messageIds"][0]
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        with self._client_lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+
+def message_bus_from_env() -> MessageBus:
+    """
+    Builds the bus selected by MESSAGE_BUS:
+    - "pubsub" (default): Google Cloud Pub/Sub
+    - "local": the local broker at MESSAGE_BUS_URL (default http://127.0.0.1:8085)
+
+    The in-memory bus connects services running in one process and is installed with `set_message_bus` by the process
+    that hosts them (see monolith/src/api.py).
+    """
+    backend = getenv("MESSAGE_BUS", "pubsub").lower()
+    if backend == "pubsub":
+        return PubSubBus()
+    if backend == "local":
+        return LocalBrokerBus(getenv("MESSAGE_BUS_URL", "http://127.0.0.1:8085"))
+    raise ValueError(f"Unknown MESSAGE_BUS '{backend}', expected 'pubsub' or 'local'")
+
+
+_pubsub_bus = PubSubBus()
+_message_bus: Optional[MessageBus] = None
+_message_bus_lock = threading.Lock()
+
+
+def get_message_bus() -> MessageBus:
+    """Returns the process' message bus, building it from the environment on first use."""
+    global _message_bus
+    if _message_bus is None:
+        with _message_bus_lock:
+            if _message_bus is None:
+                _message_bus = message_bus_from_env()
+    return _message_bus
+
+
+def set_message_bus(bus: Optional[MessageBus]) -> None:
+    """Replaces the process' message bus. With None the next publish builds it from the environment again."""
+    global _message_bus
+    with _message_bus_lock:
+        _message_bus = bus
+
+
+def bus_for(topic: Union[Topic, str]) -> MessageBus:
+    """The bus that carries `topic`: the process' bus if it handles the topic, Pub/Sub otherwise."""
+    bus = get_message_bus()
+    return bus if bus.handles(topic) else _pubsub_bus
+
+
+def close_message_bus() -> None:
+    """Closes the process' message bus, if one was built."""
+    with _message_bus_lock:
+        bus = _message_bus
+    if bus is not None:
+        bus.close()
@@ -0,0 +1,160 @@
+import time
+from os import getenv
+from typing import Dict, Optional, Tuple
+
+from fastapi import FastAPI
+from fastapi.responses import Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Pub/Sub pushes and pipeline runs can take minutes, so the buckets go past the client library's default 10 seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle an HTTP request, by route template.",
+    ["service", "method", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    "http_requests", "HTTP requests handled, by response status.", ["service", "method", "route", "status"]
+)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being handled.", ["service"])
+
+PUBLISH_LATENCY = Histogram(
+    "pubsub_publish_duration_seconds",
+    "Time from publishing a message until the message bus acknowledged it.",
+    ["topic"],
+    buckets=LATENCY_BUCKETS,
+)
+PUBLISH_FAILURES = Counter(
+    "pubsub_publish_failures", "Publishes the message bus rejected or that timed out.", ["topic"]
+)
+
+TRANSFERRED_BYTES = Counter(
+    "data_transfer_bytes", "Bytes copied from source URLs to GCS by the downloader, by transfer mode.", ["mode"]
+)
+REVERSE_IMAGE_SEARCH_LATENCY = Histogram(
+    "reverse_image_search_duration_seconds",
+    "Duration of the annotator's reverse image searches.",
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_LOOKUPS = Counter("cache_lookups", "Cache lookups, by cache and result (hit or miss).", ["cache", "result"])
+ADMISSION_REJECTIONS = Counter(
+    "admission_rejections", "Requests Endpoints rejected with 429, by task type and reason.", ["task_type", "reason"]
+)
+SCHEDULER_QUEUED = Gauge(
+    "scheduler_queued_tasks",
+    "Tasks the Controller holds back for a stage, by priority class.",
+    ["stage", "priority_class"],
+)
+SCHEDULER_IN_FLIGHT = Gauge("scheduler_in_flight_tasks", "Tasks counted against a stage's budget.", ["stage"])
+SCHEDULER_WAIT = Histogram(
+    "scheduler_wait_seconds",
+    "Time tasks waited in the Controller for a place in a stage's budget.",
+    ["stage", "priority_class"],
+    buckets=LATENCY_BUCKETS,
+)
+
+# Requests that match no route are counted under one label, so unknown paths cannot grow the number of series
+UNMATCHED_ROUTE = "unmatched"
+# Bound on the request paths whose route template is remembered; paths with parameters are not limited in number
+MAX_CACHED_PATHS = 1024
+
+
+def metrics_enabled() -> bool:
+    return getenv("METRICS_ENABLED", "true").lower() == "true"
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def record_publish(topic: str, started: float, failed: bool) -> None:
+    """Records a publish to `topic` that started at `started` (a `time.perf_counter()` value)."""
+    PUBLISH_LATENCY.labels(topic=topic).observe(time.perf_counter() - started)
+    if failed:
+        PUBLISH_FAILURES.labels(topic=topic).inc()
+
+
+def _route_template(scope: Scope) -> str:
+    app = scope.get("app")
+    for route in getattr(app, "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request and counts it by route template and status. A plain ASGI middleware that remembers the
+    route of each path and the series of each route, so it adds a few microseconds per request and stays enabled in
+    production.
+    """
+
+    def __init__(self, app: ASGIApp, service: str):
+        self.app = app
+        self.service = service
+        self.in_flight = REQUESTS_IN_FLIGHT.labels(service=service)
+        self._routes: Dict[Tuple[str, str], str] = {}
+        self._series: Dict[Tuple[str, str, int], Tuple[Histogram, Counter]] = {}
+
+    def _route(self, scope: Scope) -> str:
+        key = (scope["method"], scope["path"])
+        route = self._routes.get(key)
+        if route is None:
+            route = _route_template(scope)
+            # Unmatched paths are not remembered: the routes of Endpoints are only added at startup
+            if route != UNMATCHED_ROUTE and len(self._routes) < MAX_CACHED_PATHS:
+                self._routes[key] = route
+        return route
+
+    def _observe(self, scope: Scope, status: int, duration: float) -> None:
+        method, route = scope["method"], self._route(scope)
+        series = self._series.get((method, route, status))
+        if series is None:
+            series = self._series[(method, route, status)] = (
+                REQUEST_LATENCY.labels(service=self.service, method=method, route=route),
+                REQUESTS.labels(service=self.service, method=method, route=route, status=str(status)),
+            )
+        latency, requests = series
+        latency.observe(duration)
+        requests.inc()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        self.in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.in_flight.dec()
+            self._observe(scope, status, time.perf_counter() - started)
+
+
+def metrics_response() -> Response:
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+
+def instrument_app(app: FastAPI, service: Optional[str] = None) -> None:
+    """
+    Times the requests `app` handles and serves all metrics of the process at GET /metrics, unless METRICS_ENABLED
+    is "false". `service` labels the request metrics; it defaults to K_SERVICE.
+    """
+    if not metrics_enabled():
+        return
+    app.add_middleware(MetricsMiddleware, service=service or getenv("K_SERVICE", "unknown"))
+    app.add_api_route("/metrics", metrics_response, methods=["GET"], include_in_schema=False)
@@ -1,14 +1,20 @@
+import asyncio
 from datetime import timedelta
-from google.cloud import storage
-from google.auth.transport import requests
-from google import auth
-from typing import Optional
+from os import getenv
+from typing import Dict, List, Tuple
 
 from fastapi import FastAPI, Request
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from cont_intel.api.utils.signing import get_url_signer
 
 app = FastAPI()
 
+# V4 signed URLs are valid for at most 7 days
+MAX_EXPIRATION_SECONDS = 7 * 24 * 3600
+MAX_BATCH_SIZE = int(getenv("SIGNED_URL_MAX_BATCH_SIZE", "500"))
+
+
 @app.post("/", response_class=PlainTextResponse)
 async def generate_signed_url(request: Request):
     request_json = await request.json()
@@ -25,48 +31,51 @@ async def generate_signed_url(request: Request):
     except ValueError:
         return PlainTextResponse("Invalid timedelta value", status_code=400)
 
-    return make_signed_url(request_json['bucket'], request_json['objectname'], exp=expiration_time)
+    return await get_url_signer().sign_async(request_json['bucket'], request_json['objectname'], exp=expiration_time)
 
-def make_signed_url(bucket: str, objectname: str, *, exp: Optional[timedelta] = None) -> str:
-    """
-    Generate a signed URL for a Google Cloud Storage object, valid for the specified duration.
-    
-    Parameters:
-    - bucket: Name of the GCS bucket.
-    - objectname: Name of the object (file) within the bucket.
-    - exp: Expiration time for the signed URL (default is 1 hour).
-    
-    Returns:
-    - A signed URL as a string.
-    """
-    # Default expiration time
-    if exp is None:
-        exp = timedelta(hours=1)
 
-    # Set the required Google Cloud Storage and IAM scopes
-    SCOPES = [
-        "https://www.googleapis.com/auth/devstorage.read_write",
-        "https://www.googleapis.com/auth/iam"
-    ]
-
-    # Get the default credentials for the service account
-    credentials, project_id = auth.default(scopes=SCOPES)
+@app.post("/batch")
+async def generate_signed_urls(request: Request):
+    """
+    Signs a list of objects in one call.
 
-    # Refresh the credentials if the token is not available
-    if credentials.token is None:
-        credentials.refresh(requests.Request())
+    Request body: {"objects": [{"bucket": ..., "objectname": ..., "expires_in": <seconds>, "key": <optional>}, ...]}
+    Response: {"urls": {key: signed url}, "errors": {key: reason}}, where key defaults to "<bucket>/<objectname>".
+    """
+    request_json = await request.json()
+    objects = request_json.get("objects") if isinstance(request_json, dict) else None
+    if not isinstance(objects, list) or not objects:
+        return PlainTextResponse("Missing required field: objects", status_code=400)
+    if len(objects) > MAX_BATCH_SIZE:
+        return PlainTextResponse(f"At most {MAX_BATCH_SIZE} objects can be signed per request", status_code=400)
 
-    # Initialize the Google Cloud Storage client with the credentials
-    client = storage.Client(credentials=credentials)
+    urls: Dict[str, str] = {}
+    errors: Dict[str, str] = {}
+    to_sign: List[Tuple[str, str, str, timedelta]] = []
+    for index, item in enumerate(objects):
+        if not isinstance(item, dict) or not item.get("bucket") or not item.get("objectname"):
+            errors[str(index)] = "bucket and objectname are required"
+            continue
+        key = str(item.get("key") or f"{item['bucket']}/{item['objectname']}")
+        try:
+            expires_in = int(item.get("expires_in", 3600))
+        except (TypeError, ValueError):
+            errors[key] = "Invalid expires_in value"
+            continue
+        if not 0 < expires_in <= MAX_EXPIRATION_SECONDS:
+            errors[key] = f"expires_in must be between 1 and {MAX_EXPIRATION_SECONDS} seconds"
+            continue
+        to_sign.append((key, item["bucket"], item["objectname"], timedelta(seconds=expires_in)))
 
-    # Fetch the bucket and blob objects
-    bucket_obj = client.get_bucket(bucket)
-    blob = bucket_obj.blob(objectname)
+    if to_sign:
+        signer = get_url_signer()
+        results = await asyncio.gather(
+            *(signer.sign_async(bucket, name, exp=exp) for _, bucket, name, exp in to_sign), return_exceptions=True
+        )
+        for (key, *_), result in zip(to_sign, results):
+            if isinstance(result, Exception):
+                errors[key] = str(result)
+            else:
+                urls[key] = result
 
-    # Generate and return the signed URL
-    return blob.generate_signed_url(
-        version="v4",
-        expiration=exp,
-        service_account_email=credentials.service_account_email,
-        access_token=credentials.token,
-    )
+    return JSONResponse({"urls": urls, "errors": errors})
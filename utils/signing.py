@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from os import getenv
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from google import auth
+from google.auth.transport import requests
+from google.cloud import storage
+from google.oauth2 import service_account
+
+# Scopes needed to sign with the IAM signBlob API when no private key is available
+SCOPES = [
+    "https://www.googleapis.com/auth/devstorage.read_write",
+    "https://www.googleapis.com/auth/iam",
+]
+
+
+class UrlSigner:
+    """
+    Generates V4 signed URLs for GCS objects.
+
+    Credentials and the storage client are created once and reused. Access tokens are refreshed `refresh_margin`
+    before they expire rather than on every call. Blobs are addressed directly, without a bucket metadata lookup.
+    Service account key credentials sign locally; other credentials (e.g. the Cloud Run metadata server) sign
+    through the IAM signBlob API.
+
+    With `cache_ttl` > 0, a URL signed for the same object, method and expiration within the last `cache_ttl`
+    seconds is served again instead of signing a new one, so a served URL is valid for at least `exp - cache_ttl`.
+    """
+
+    # Expired entries are only swept once the cache grows past this many URLs
+    MAX_CACHED_URLS = 10000
+
+    def __init__(
+        self, refresh_margin: timedelta = timedelta(minutes=5), max_workers: int = 8, cache_ttl: float = 0.0
+    ):
+        self.refresh_margin = refresh_margin
+        self.cache_ttl = cache_ttl
+        self._credentials = None
+        self._client: Optional[storage.Client] = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="url-signer")
+        # (bucket, object name, method, expiration seconds) -> (signed url, unix time it was signed at)
+        self._url_cache: Dict[Tuple[str, str, str, float], Tuple[str, float]] = {}
+
+    def _get_credentials(self):
+        with self._lock:
+            if self._credentials is None:
+                self._credentials, project_id = auth.default(scopes=SCOPES)
+                self._client = storage.Client(credentials=self._credentials, project=project_id)
+
+            if not isinstance(self._credentials, service_account.Credentials) and self._needs_refresh():
+                self._credentials.refresh(requests.Request())
+            return self._credentials
+
+    def _needs_refresh(self) -> bool:
+        credentials = self._credentials
+        if credentials.token is None:
+            return True
+        if credentials.expiry is None:
+            return False
+        # google-auth expiry times are naive UTC
+        return credentials.expiry - datetime.utcnow() < self.refresh_margin
+
+    def sign(self, bucket: str, object_name: str, exp: Optional[timedelta] = None, method: str = "GET") -> str:
+        """Returns a signed URL for `object_name` in `bucket`, valid for `exp` (default 1 hour)."""
+        if exp is None:
+            exp = timedelta(hours=1)
+
+        now = time.time()
+        cache_key = (bucket, object_name, method, exp.total_seconds())
+        if self.cache_ttl > 0:
+            cached = self._url_cache.get(cache_key)
+            if cached is not None and now - cached[1] <= self.cache_ttl:
+                return cached[0]
+
+        credentials = self._get_credentials()
+        blob = self._client.bucket(bucket).blob(object_name)
+
+        if isinstance(credentials, service_account.Credentials):
+            url = blob.generate_signed_url(version="v4", expiration=exp, method=method, credentials=credentials)
+        else:
+            url = blob.generate_signed_url(
+                version="v4",
+                expiration=exp,
+                method=method,
+                service_account_email=credentials.service_account_email,
+                access_token=credentials.token,
+            )
+
+        if self.cache_ttl > 0:
+            self._url_cache[cache_key] = (url, now)
+            if len(self._url_cache) > self.MAX_CACHED_URLS:
+                self._evict_expired_urls(now)
+        return url
+
+    def _evict_expired_urls(self, now: float) -> None:
+        for key, (_, signed_at) in list(self._url_cache.items()):
+            if now - signed_at > self.cache_ttl:
+                self._url_cache.pop(key, None)
+
+    async def sign_async(
+        self, bucket: str, object_name: str, exp: Optional[timedelta] = None, method: str = "GET"
+    ) -> str:
+        """Runs `sign` on the signer's executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.sign, bucket, object_name, exp, method)
+
+    def sign_many(self, objects: Sequence[Tuple[str, str]], exp: Optional[timedelta] = None) -> List[str]:
+        """Signs (bucket, object_name) pairs concurrently, returning the URLs in the same order."""
+        # Refresh once up front rather than racing in every worker
+        self._get_credentials()
+        return list(self._executor.map(lambda item: self.sign(item[0], item[1], exp=exp), objects))
+
+    async def sign_many_async(self, objects: Sequence[Tuple[str, str]], exp: Optional[timedelta] = None) -> List[str]:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._get_credentials)
+        return list(
+            await asyncio.gather(
+                *(loop.run_in_executor(self._executor, self.sign, bucket, name, exp) for bucket, name in objects)
+            )
+        )
+
+
+_signer: Optional[UrlSigner] = None
+_signer_lock = threading.Lock()
+
+
+def get_url_signer() -> UrlSigner:
+    """
+    Returns the process-wide URL signer.
+
+    SIGNED_URL_WORKERS sets the size of its signing pool and SIGNED_URL_CACHE_TTL (seconds, default 0 = off) how long
+    a signed URL is reused.
+    """
+    global _signer
+    if _signer is None:
+        with _signer_lock:
+            if _signer is None:
+                _signer = UrlSigner(
+                    max_workers=int(getenv("SIGNED_URL_WORKERS", "8")),
+                    cache_ttl=float(getenv("SIGNED_URL_CACHE_TTL", "0")),
+                )
+    return _signer
@@ -0,0 +1,54 @@
+from dataclasses import dataclass
+from enum import Enum
+from typing import Dict, Iterable, Tuple, Union
+
+
+class Topic(str, Enum):
+    """Every topic the services publish to. Publishing to a name that is not listed here is an error."""
+
+    CONTROLLER_START = "controller_start"
+    DOWNLOADER_START = "downloader_start"
+    DOWNLOADER_END = "downloader_end"
+    PIPELINE_START = "pipeline_start"
+    PIPELINE_END = "pipeline_end"
+    ANNOTATOR_START = "annotator_start"
+    ANNOTATOR_END = "annotator_end"
+    ERROR = "error"
+    TASK_END = "task_end"
+
+
+def topic_name(topic: Union[Topic, str]) -> str:
+    """The topic's name, e.g. for a Pub/Sub topic path. Raises ValueError for topics missing from the registry."""
+    return Topic(topic).value
+
+
+@dataclass(frozen=True)
+class Subscription:
+    """A push subscription: messages published to `topic` are posted to `path` of `service`."""
+
+    topic: Topic
+    service: str
+    path: str = "/"
+
+
+# The push subscriptions of the deployment, i.e. which service route handles each topic
+SUBSCRIPTIONS: Tuple[Subscription, ...] = (
+    Subscription(Topic.CONTROLLER_START, "controller"),
+    Subscription(Topic.DOWNLOADER_START, "downloader"),
+    Subscription(Topic.DOWNLOADER_END, "controller", "/downloader_end"),
+    Subscription(Topic.PIPELINE_START, "pipeline"),
+    Subscription(Topic.PIPELINE_END, "output"),
+    Subscription(Topic.ANNOTATOR_START, "annotator"),
+    Subscription(Topic.ANNOTATOR_END, "output", "/annotator_end"),
+    Subscription(Topic.ERROR, "error-handler"),
+    Subscription(Topic.TASK_END, "controller", "/task_end"),
+)
+
+# Services in the order a task passes through them
+SERVICES: Tuple[str, ...] = ("controller", "downloader", "pipeline", "annotator", "output", "error-handler")
+
+
+def subscriptions_for(services: Iterable[str]) -> Dict[Topic, Subscription]:
+    """The subscriptions handled by `services`, by topic."""
+    services = set(services)
+    return {subscription.topic: subscription for subscription in SUBSCRIPTIONS if subscription.service in services}
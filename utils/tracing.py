@@ -0,0 +1,232 @@
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from os import getenv
+from typing import Dict, Iterator, List, Optional
+
+from loguru import logger
+
+from cont_intel.api.utils.data_classes import PubSubMessage, Span
+
+# Name of the span that covers the whole task, from the request to Endpoints until the output is delivered
+TASK_SPAN = "task"
+
+
+def tracing_enabled() -> bool:
+    return getenv("TRACING_ENABLED", "true").lower() == "true"
+
+
+def _new_span(pubsub_message: PubSubMessage, name: str, parent_id: Optional[str]) -> Span:
+    span = Span(name=name, span_id=secrets.token_hex(8), parent_id=parent_id, start=time.time())
+    pubsub_message.spans.append(span)
+    return span
+
+
+def start_trace(pubsub_message: PubSubMessage) -> Optional[Span]:
+    """Starts the trace of a new task: sets its trace_id and opens the task span."""
+    if not tracing_enabled():
+        return None
+    pubsub_message.trace_id = secrets.token_hex(16)
+    pubsub_message.spans = []
+    return _new_span(pubsub_message, TASK_SPAN, None)
+
+
+def _task_span(pubsub_message: PubSubMessage) -> Span:
+    if pubsub_message.trace_id is None or not pubsub_message.spans:
+        # Published before tracing existed or with tracing disabled upstream: the trace starts here
+        start_trace(pubsub_message)
+    return pubsub_message.spans[0]
+
+
+def enter_stage(pubsub_message: PubSubMessage, stage: str) -> Optional[Span]:
+    """Opens the span of a stage (a service handling the message). Called when the stage receives the message."""
+    if not tracing_enabled():
+        return None
+    return _new_span(pubsub_message, stage, _task_span(pubsub_message).span_id)
+
+
+def _open_stage(pubsub_message: PubSubMessage) -> Optional[Span]:
+    for span in reversed(pubsub_message.spans or []):
+        if span.end is None and span.name != TASK_SPAN:
+            return span
+    return None
+
+
+def start_span(pubsub_message: PubSubMessage, name: str) -> Optional[Span]:
+    """Opens a span for a step of the current stage, e.g. "downloader.transfer". `end_span` closes it."""
+    if not tracing_enabled():
+        return None
+    stage = _open_stage(pubsub_message)
+    parent_id = stage.span_id if stage is not None else _task_span(pubsub_message).span_id
+    return _new_span(pubsub_message, name, parent_id)
+
+
+def end_span(pubsub_message: PubSubMessage, span: Optional[Span]) -> None:
+    if span is not None and span.end is None:
+        span.end = time.time()
+        export_span(pubsub_message, span)
+
+
+@contextmanager
+def traced(pubsub_message: PubSubMessage, name: str) -> Iterator[Optional[Span]]:
+    """Records the enclosed block as a step of the current stage."""
+    span = start_span(pubsub_message, name)
+    try:
+        yield span
+    finally:
+        end_span(pubsub_message, span)
+
+
+def finish_stage(pubsub_message: PubSubMessage) -> None:
+    """Closes the open spans of the current stage. Called when the stage publishes the message to the next one."""
+    for span in pubsub_message.spans or []:
+        if span.end is None and span.name != TASK_SPAN:
+            end_span(pubsub_message, span)
+
+
+def finish_trace(pubsub_message: PubSubMessage) -> None:
+    """Closes every open span, including the task span. Called once the task's output has been delivered."""
+    finish_stage(pubsub_message)
+    if pubsub_message.spans:
+        end_span(pubsub_message, pubsub_message.spans[0])
+
+
+def timing_breakdown(pubsub_message: PubSubMessage) -> Dict:
+    """
+    The task's timing by stage, in milliseconds: for every stage the time the message waited before the stage
+    received it (Pub/Sub delivery and queueing), the time the stage spent on it and its steps.
+
+    Stages run on different instances, so the waits include the clock differences between them.
+    """
+    spans: List[Span] = pubsub_message.spans or []
+    if not spans:
+        return {}
+
+    def ms(seconds: float) -> float:
+        return round(seconds * 1000, 1)
+
+    task = spans[0]
+    now = time.time()
+    stages, previous_end = [], task.start
+    for stage in (span for span in spans if span.parent_id == task.span_id):
+        end = stage.end if stage.end is not None else now
+        stages.append(
+            {
+                "stage": stage.name,
+                "wait_ms": ms(stage.start - previous_end),
+                "duration_ms": ms(end - stage.start),
+                "steps": {
+                    step.name: ms((step.end if step.end is not None else now) - step.start)
+                    for step in spans
+                    if step.parent_id == stage.span_id
+                },
+            }
+        )
+        previous_end = end
+    return {
+        "trace_id": pubsub_message.trace_id,
+        "task_id": pubsub_message.task_id,
+        "total_ms": ms((task.end if task.end is not None else now) - task.start),
+        "stages": stages,
+    }
+
+
+class _OtlpExporter:
+    """
+    Sends finished spans to an OpenTelemetry collector over OTLP/HTTP, with the trace and span ids recorded on the
+    message, so the spans of all services join into one trace.
+    """
+
+    def __init__(self):
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.trace.id_generator import IdGenerator
+
+        class PresetIdGenerator(IdGenerator):
+            """Hands the SDK the ids of the span being exported instead of generating new ones."""
+
+            def __init__(self):
+                self.ids = threading.local()
+
+            def generate_span_id(self) -> int:
+                return self.ids.span_id
+
+            def generate_trace_id(self) -> int:
+                return self.ids.trace_id
+
+        self._trace = trace
+        self._ids = PresetIdGenerator()
+        # The exporter reads OTEL_EXPORTER_OTLP_ENDPOINT and the other standard OTEL_* variables
+        self._provider = TracerProvider(
+            resource=Resource.create({"service.name": getenv("K_SERVICE", "cont-intel-api")}),
+            id_generator=self._ids,
+        )
+        self._provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        self._tracer = self._provider.get_tracer(__name__)
+
+    def export(self, pubsub_message: PubSubMessage, span: Span) -> None:
+        trace = self._trace
+        trace_id = int(pubsub_message.trace_id, 16)
+        self._ids.ids.trace_id, self._ids.ids.span_id = trace_id, int(span.span_id, 16)
+        context = None
+        if span.parent_id is not None:
+            parent = trace.SpanContext(
+                trace_id,
+                int(span.parent_id, 16),
+                is_remote=True,
+                trace_flags=trace.TraceFlags(trace.TraceFlags.SAMPLED),
+            )
+            context = trace.set_span_in_context(trace.NonRecordingSpan(parent))
+        otel_span = self._tracer.start_span(
+            span.name,
+            context=context,
+            start_time=int(span.start * 1e9),
+            attributes={"task_id": pubsub_message.task_id, "task_type": pubsub_message.task_type},
+        )
+        otel_span.end(end_time=int(span.end * 1e9))
+
+    def shutdown(self) -> None:
+        self._provider.shutdown()
+
+
+_exporter: Optional[_OtlpExporter] = None
+_exporter_failed = False
+_exporter_lock = threading.Lock()
+
+
+def _get_exporter() -> Optional[_OtlpExporter]:
+    """The OTLP exporter if TRACE_EXPORTER is "otlp" and the OpenTelemetry SDK is installed, otherwise None."""
+    global _exporter, _exporter_failed
+    if _exporter is None and not _exporter_failed and getenv("TRACE_EXPORTER", "none").lower() == "otlp":
+        with _exporter_lock:
+            if _exporter is None and not _exporter_failed:
+                try:
+                    _exporter = _OtlpExporter()
+                except ImportError as e:
+                    _exporter_failed = True
+                    logger.warning(f"TRACE_EXPORTER is otlp, but the OpenTelemetry SDK is not installed: {e}")
+    return _exporter
+
+
+def export_span(pubsub_message: PubSubMessage, span: Span) -> None:
+    exporter = _get_exporter()
+    if exporter is None or pubsub_message.trace_id is None:
+        return
+    try:
+        exporter.export(pubsub_message, span)
+    except Exception as e:  # NOSONAR
+        # Tracing must never fail a request
+        logger.error(f"Failed to export span {span.name}: {e}")
+
+
+def flush_traces() -> None:
+    """Sends the spans still buffered by the exporter. Safe to call more than once."""
+    global _exporter
+    with _exporter_lock:
+        exporter, _exporter = _exporter, None
+    if exporter is not None:
+        exporter.shutdown()
@@ -0,0 +1,202 @@
+import asyncio
+import random
+import threading
+import time
+from os import getenv
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from loguru import logger
+
+from cont_intel.api.utils.api_utils import write_log
+
+# Responses worth retrying: the endpoint is overloaded or failing, not rejecting the payload
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a host whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a host after `failure_threshold` consecutive failures. After `reset_timeout` seconds a single
+    trial call is let through: its success closes the circuit again, its failure re-opens it. A trial call whose
+    outcome was never recorded does not hold the circuit half open: another one is let through `reset_timeout`
+    seconds later.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if (
+                self.state in (self.OPEN, self.HALF_OPEN)
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                self.state = self.HALF_OPEN
+                # Times the trial call, so a lost outcome lets another one through after `reset_timeout`
+                self._opened_at = time.monotonic()
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class WebhookClient:
+    """
+    Delivers JSON payloads to client endpoints.
+
+    Each destination host gets its own keep-alive connection pool and circuit breaker, so one slow or failing
+    endpoint cannot use up the connections or time of the others. Failed attempts (connection errors, timeouts and
+    retryable status codes) are retried up to `max_attempts` times with full-jitter exponential backoff. Every
+    delivery is logged with its task_id, attempt count and latency.
+    """
+
+    def __init__(
+        self,
+        timeout: Optional[httpx.Timeout] = None,
+        max_attempts: int = 4,
+        backoff_base: float = 0.5,
+        backoff_max: float = 10,
+        max_connections_per_host: int = 20,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+    ):
+        self.timeout = timeout or httpx.Timeout(10, connect=5)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limits = httpx.Limits(
+            max_connections=max_connections_per_host, max_keepalive_connections=max_connections_per_host
+        )
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    @classmethod
+    def from_env(cls) -> "WebhookClient":
+        """
+        Builds a client configured from the environment: WEBHOOK_TIMEOUT, WEBHOOK_CONNECT_TIMEOUT (seconds),
+        WEBHOOK_MAX_ATTEMPTS, WEBHOOK_MAX_CONNECTIONS_PER_HOST, WEBHOOK_FAILURE_THRESHOLD and WEBHOOK_RESET_TIMEOUT.
+        """
+        return cls(
+            timeout=httpx.Timeout(
+                float(getenv("WEBHOOK_TIMEOUT", "10")), connect=float(getenv("WEBHOOK_CONNECT_TIMEOUT", "5"))
+            ),
+            max_attempts=int(getenv("WEBHOOK_MAX_ATTEMPTS", "4")),
+            max_connections_per_host=int(getenv("WEBHOOK_MAX_CONNECTIONS_PER_HOST", "20")),
+            failure_threshold=int(getenv("WEBHOOK_FAILURE_THRESHOLD", "5")),
+            reset_timeout=float(getenv("WEBHOOK_RESET_TIMEOUT", "30")),
+        )
+
+    def _client_for(self, host: str) -> httpx.AsyncClient:
+        if host not in self._clients:
+            self._clients[host] = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self._clients[host]
+
+    def _breaker_for(self, host: str) -> CircuitBreaker:
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return self._breakers[host]
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    async def post_json(self, url: str, payload: dict, task_id: Optional[str] = None) -> httpx.Response:
+        """Posts `payload` to `url`, raising if it could not be delivered."""
+        host = urlsplit(url).netloc
+        client, breaker = self._client_for(host), self._breaker_for(host)
+        started = time.perf_counter()
+        attempts, status_code, outcome = 0, None, "failed"
+
+        try:
+            while True:
+                if not breaker.allow():
+                    outcome = "circuit_open"
+                    raise CircuitOpenError(f"Circuit breaker for {host} is open")
+
+                attempts += 1
+                try:
+                    response = await client.post(url, json=payload)
+                except httpx.TransportError as e:
+                    error: Exception = e
+                except BaseException:
+                    # E.g. too many redirects, an invalid URL or a cancellation: not retried, but still recorded,
+                    # so a trial call that ends this way does not leave the circuit half open
+                    breaker.record_failure()
+                    raise
+                else:
+                    status_code = response.status_code
+                    if status_code not in RETRYABLE_STATUS_CODES:
+                        # The endpoint answered; a 4xx is a problem with the request, not with the endpoint
+                        breaker.record_success()
+                        response.raise_for_status()
+                        outcome = "delivered"
+                        return response
+                    error = httpx.HTTPStatusError(
+                        f"Retryable status {status_code} from {host}", request=response.request, response=response
+                    )
+
+                breaker.record_failure()
+                if attempts >= self.max_attempts:
+                    raise error
+                logger.warning(f"Delivery to {host} failed (attempt {attempts}): {error}")
+                await asyncio.sleep(self._backoff(attempts))
+        finally:
+            write_log(
+                "api",
+                {
+                    "message": "Webhook delivery",
+                    "task_id": task_id,
+                    "host": host,
+                    "outcome": outcome,
+                    "attempts": attempts,
+                    "status_code": status_code,
+                    "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+                },
+            )
+
+    async def aclose(self) -> None:
+        clients, self._clients = self._clients, {}
+        await asyncio.gather(*(client.aclose() for client in clients.values()))
+
+
+_webhook_client: Optional[WebhookClient] = None
+
+
+def get_webhook_client() -> WebhookClient:
+    """Returns the process-wide webhook client."""
+    global _webhook_client
+    if _webhook_client is None:
+        _webhook_client = WebhookClient.from_env()
+    return _webhook_client
+
+
+async def close_webhook_client() -> None:
+    """Closes the pooled connections of the process-wide webhook client."""
+    global _webhook_client
+    if _webhook_client is not None:
+        client, _webhook_client = _webhook_client, None
+        await client.aclose()